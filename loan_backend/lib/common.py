@@ -1,9 +1,23 @@
 import calendar
-from datetime import date
+from itertools import islice
+from datetime import date, datetime
 
 def add_months(sourcedate, months):
     month = sourcedate.month - 1 + months
     year = sourcedate.year + month // 12
     month = month % 12 + 1
     day = min(sourcedate.day, calendar.monthrange(year, month)[1])
-    return date(year, month, day)
\ No newline at end of file
+    return date(year, month, day)
+
+def to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
\ No newline at end of file
@@ -0,0 +1,86 @@
+import json
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# execute_wrapper counting the queries of a request and the time spent in them
+class QueryRecorder:
+    def __init__(self):
+        self.statements = Counter()
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started_at
+            self.statements[(sql, repr(params))] += 1
+
+    @property
+    def queries(self):
+        return sum(self.statements.values())
+
+    # executions of a statement with the same parameters after the first one
+    @property
+    def duplicates(self):
+        return sum(count - 1 for count in self.statements.values())
+
+    # executions of a statement with other parameters after the first one, N+1 queries show up here
+    @property
+    def similar(self):
+        by_sql = Counter()
+        for (sql, _), count in self.statements.items():
+            by_sql[sql] += count
+        return sum(count - 1 for count in by_sql.values())
+
+# Wall time, database time, query count and duplicate queries of every sampled request, added to the
+# response as a Server-Timing header and logged as one JSON line. Configured by REQUEST_INSTRUMENTATION,
+# the middleware removes itself from the chain when it is disabled.
+class RequestInstrumentationMiddleware:
+    def __init__(self, get_response):
+        config = getattr(settings, 'REQUEST_INSTRUMENTATION', {})
+        if not config.get('ENABLED'):
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+        self.sample_rate = config.get('SAMPLE_RATE', 1)
+
+    def __call__(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        started_at = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started_at
+
+        response['Server-Timing'] = ', '.join([
+            f'total;dur={elapsed * 1000:.2f}',
+            f'db;dur={recorder.duration * 1000:.2f}',
+            f'queries;desc="{recorder.queries}"',
+            f'duplicate-queries;desc="{recorder.duplicates}"',
+        ])
+        match = request.resolver_match
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'wall_ms': round(elapsed * 1000, 2),
+            'db_ms': round(recorder.duration * 1000, 2),
+            'queries': recorder.queries,
+            'duplicate_queries': recorder.duplicates,
+            'similar_queries': recorder.similar,
+        }))
+        return response
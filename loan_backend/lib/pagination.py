@@ -0,0 +1,17 @@
+import base64
+import json
+
+# opaque keyset cursors, values is a list of json serializable sort key values
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (ValueError, UnicodeError):
+        raise ValueError("malformed cursor")
+
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("malformed cursor")
+
+    return values
@@ -0,0 +1,36 @@
+from django.db.backends.sqlite3 import base
+
+# applied to every new connection, OPTIONS['pragmas'] overrides single values
+DEFAULT_PRAGMAS = {
+    # readers and the writer do not block each other
+    'journal_mode': 'WAL',
+    # fsync at checkpoints only, the database stays consistent with WAL
+    'synchronous': 'NORMAL',
+    # milliseconds to wait for the write lock before failing with "database is locked"
+    'busy_timeout': 20000,
+    'mmap_size': 268435456,
+    # negative is in KiB, 64MB page cache per connection
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+
+# SQLite backend for single node deployments, use 'ENGINE': 'lib.sqlite'.
+# Besides the PRAGMAs every transaction is started with BEGIN IMMEDIATE (OPTIONS['transaction_mode']),
+# so it takes the write lock up front and waits busy_timeout for it. With the default deferred BEGIN a
+# transaction that read first and then writes fails at once with "database is locked" when another
+# connection is writing, as sqlite cannot wait for the lock without risking a deadlock.
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = {**DEFAULT_PRAGMAS, **kwargs.pop('pragmas', {})}
+        self.transaction_mode = kwargs.pop('transaction_mode', 'IMMEDIATE')
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute(f"BEGIN {self.transaction_mode}")
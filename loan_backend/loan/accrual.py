@@ -0,0 +1,52 @@
+from datetime import timedelta
+from decimal import Decimal
+from loan_backend.constants import DEFAULT_PENALTY_MULTIPLIER
+
+# new penalty amount added everyday as a percentage of amount remaining in an installment
+def daily_penalty(remaining_amount, multiplier):
+    if not multiplier:
+        multiplier = DEFAULT_PENALTY_MULTIPLIER
+
+    multiplier = Decimal(str(multiplier))
+    return Decimal(str(round(remaining_amount * multiplier, 5)))
+
+# Penalty accrued at a constant balance every day after last_date through final_date. The balance of an
+# installment only changes with a payment, so between two payments the cumulative penalty on any day is
+# last_amount + days * daily_penalty, which is exactly what adding daily_penalty once per day gives as
+# decimal addition of 5 place amounts does not round. Nothing is written, see Penalty.materialize and
+# PenaltySegment.accrued_segment for turning an accrual into rows.
+class PenaltyAccrual:
+    def __init__(self, last_date, last_amount, final_date, daily_penalty):
+        self.last_date = last_date
+        self.last_amount = last_amount
+        self.final_date = final_date
+        self.daily_penalty = daily_penalty
+
+    @property
+    def days(self):
+        return max((self.final_date - self.last_date).days, 0)
+
+    # cumulative penalty on final_date
+    @property
+    def amount(self):
+        return self.amount_on(self.final_date)
+
+    def amount_on(self, on_date):
+        days = min(max((on_date - self.last_date).days, 0), self.days)
+        return self.last_amount + days * self.daily_penalty
+
+    # (date, cumulative penalty) for every day of the accrual
+    def daily_amounts(self):
+        for day in range(1, self.days + 1):
+            yield self.last_date + timedelta(days=day), self.last_amount + day * self.daily_penalty
+
+# accrual from the (last_date, last_amount) watermark through final_date, None when no penalty accrues
+def accrue(balance_remaining, last_date, last_amount, final_date, multiplier):
+    if last_date >= final_date or balance_remaining <= 0:
+        return None
+
+    penalty_amount = daily_penalty(balance_remaining, multiplier)
+    if penalty_amount <= 0:
+        return None
+
+    return PenaltyAccrual(last_date, last_amount, final_date, penalty_amount)
@@ -1,36 +1,101 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db.models import Count, Prefetch
+from django.forms.models import BaseInlineFormSet
+from django.utils.html import format_html, format_html_join
 from django.utils.safestring import mark_safe
 from django.urls import reverse
-from loan.models import Loan, LoanShare, Installment, InstallmentDetail, LoanRepayment, Penalty
+from loan_backend.constants import ADMIN_INSTALLMENTS_PER_PAGE
+from loan.models import quantize_amount, Loan, LoanShare, Installment, InstallmentDetail, LoanRepayment, Penalty, PenaltyCheckpoint, PenaltySegment
+
+# installments of a loanshare one page at a time, the page is read from the installment_page query param
+class PaginatedInstallmentFormSet(BaseInlineFormSet):
+    page_number = 1
+
+    def get_queryset(self):
+        if not hasattr(self, '_page'):
+            paginator = Paginator(super().get_queryset(), ADMIN_INSTALLMENTS_PER_PAGE)
+            self._page = paginator.get_page(self.page_number)
+        return self._page.object_list
+
+class InstallmentInline(admin.TabularInline):
+    model = Installment
+    formset = PaginatedInstallmentFormSet
+    fields = ('order', 'due_date', 'suggested_emi', 'amount_paid', 'penalty_paid', 'status')
+    readonly_fields = fields
+    ordering = ('order',)
+    extra = 0
+    can_delete = False
+    show_change_link = True
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    # inline instances are created per request, so the heading can carry the page links
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super().get_formset(request, obj, **kwargs)
+        formset.page_number = request.GET.get('installment_page', 1)
+        if obj is not None:
+            paginator = Paginator(range(obj.installment_count), ADMIN_INSTALLMENTS_PER_PAGE)
+            page = paginator.get_page(formset.page_number)
+            if paginator.num_pages > 1:
+                self.verbose_name_plural = format_html(
+                    'installments {} - {} of {} : {}', page.start_index(), page.end_index(), paginator.count,
+                    format_html_join(' ', '<a href="?installment_page={0}">{0}</a>', ((n,) for n in paginator.page_range))
+                )
+        return formset
 
 @admin.register(Loan)
 class LoanAdmin(admin.ModelAdmin):
     list_filter = ('status',)
-    list_display = ('id', 'amount', 'tenure', 'users', 'status')
-    readonly_fields = ('link_to_installments', 'users')
+    list_display = ('id', 'amount', 'tenure', 'users', 'status', 'outstanding_balance', 'total_paid', 'penalty_due')
+    readonly_fields = ('link_to_installments', 'users', 'outstanding_balance', 'total_paid', 'penalty_due')
 
-    def users(self, loan):
-        users = []
-        loanshares = LoanShare.objects.filter(loan=loan)
-        for ls in loanshares:
-            users.append(ls.user.username)
+    # loanshares with their users are prefetched and the balances annotated, so the changelist runs the
+    # same queries whatever the page size
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('loanshare_set', queryset=LoanShare.objects.select_related('user').order_by('id'))
+        ).with_balances()
 
-        return ", ".join(users)
+    def users(self, loan):
+        return ", ".join([ls.user.username for ls in loan.loanshare_set.all()])
     users.short_description = 'Users Liable'
 
+    def outstanding_balance(self, loan):
+        return quantize_amount(loan.outstanding_balance)
+    outstanding_balance.admin_order_field = 'outstanding_balance'
+
+    def total_paid(self, loan):
+        return quantize_amount(loan.total_paid)
+    total_paid.admin_order_field = 'total_paid'
+
+    def penalty_due(self, loan):
+        return quantize_amount(loan.penalty_due)
+    penalty_due.admin_order_field = 'penalty_due'
+
+    # first page of installments, every loanshare page lists all its installments page by page
     def link_to_installments(self, loan):
         links = []
-        for i in Installment.objects.filter(loanshare__loan=loan).order_by('order'):
+        installments = Installment.objects.filter(loanshare__loan=loan).select_related('loanshare__user').order_by('order', 'loanshare')
+        for i in installments[:ADMIN_INSTALLMENTS_PER_PAGE]:
             url = reverse("admin:loan_installment_change", args=[i.id])
             link = '<a href="%s">%s</a>' % (url, f"{str(i.due_date)} : {i.suggested_emi} : {i.loanshare.user.username} : {i.status}")
             links.append(link)
 
+        for ls in loan.loanshare_set.all():
+            url = reverse("admin:loan_loanshare_change", args=[ls.id])
+            links.append('<a href="%s">%s</a>' % (url, f"all installments of {ls.user.username}"))
+
         return mark_safe(' || '.join(links))
     link_to_installments.short_description = 'Installments'
 
 @admin.register(LoanShare)
 class LoanShareAdmin(admin.ModelAdmin):
-    pass
+    inlines = [InstallmentInline]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('loan', 'user').annotate(installment_count=Count('installment'))
 
 @admin.register(Installment)
 class InstallmentAdmin(admin.ModelAdmin):
@@ -38,8 +103,11 @@ class InstallmentAdmin(admin.ModelAdmin):
     list_display = ('id', 'suggested_emi', 'loan_id', 'amount_remaining', 'status')
     readonly_fields = ('amount_remaining', 'penalty_remaining')
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('loanshare')
+
     def loan_id(self, installment):
-        return installment.loanshare.loan.id
+        return installment.loanshare.loan_id
     loan_id.short_description = 'Loan ID'
 
 @admin.register(InstallmentDetail)
@@ -53,3 +121,11 @@ class LoanRepaymentAdmin(admin.ModelAdmin):
 @admin.register(Penalty)
 class PenaltyAdmin(admin.ModelAdmin):
     pass
+
+@admin.register(PenaltySegment)
+class PenaltySegmentAdmin(admin.ModelAdmin):
+    pass
+
+@admin.register(PenaltyCheckpoint)
+class PenaltyCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['final_date', 'first_loanshare', 'last_loanshare', 'last_installment', 'installments_scanned', 'rows_written', 'completed_at']
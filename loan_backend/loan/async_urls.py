@@ -0,0 +1,8 @@
+from django.urls import path
+from loan import views
+
+# async read paths served under ASGI, every other url falls through to loan.urls
+urlpatterns = [
+    path('loan/', views.AsyncLoanView.as_view(), name='loan_view'),
+    path('loan/<int:loan_id>/', views.AsyncLoanDetailView.as_view(), name='loan_detail_view'),
+]
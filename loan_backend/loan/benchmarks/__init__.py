@@ -0,0 +1,48 @@
+import json
+import math
+import time
+from contextlib import contextmanager
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Benchmarks run against a throw away copy of the database, created the same way as the test database,
+# so they can be run against any configured backend without touching its data.
+@contextmanager
+def benchmark_database(keepdb=False, alias=DEFAULT_DB_ALIAS):
+    connection = connections[alias]
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=keepdb)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=keepdb)
+
+class Timer:
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started_at
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_samples)) - 1)
+    return sorted_samples[index]
+
+# latency samples in seconds to a summary in milliseconds
+def summarize(samples):
+    ordered = sorted(samples)
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'count': len(ordered),
+        'mean_ms': to_ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': to_ms(percentile(ordered, 0.50)),
+        'p95_ms': to_ms(percentile(ordered, 0.95)),
+        'p99_ms': to_ms(percentile(ordered, 0.99)),
+        'max_ms': to_ms(ordered[-1]) if ordered else None,
+    }
+
+def write_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
@@ -0,0 +1,88 @@
+from datetime import date, timedelta
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+from loan.benchmarks import Timer, summarize
+from loan.models import Loan, Installment, Penalty
+
+help = "catching up penalties after a cron outage, day by day loop vs closed form accrual"
+
+def add_arguments(parser):
+    parser.add_argument('--outage-days', type=int, default=90, help='days of penalty to catch up')
+    parser.add_argument('--loans', type=int, default=5)
+    parser.add_argument('--tenure', type=int, default=4)
+
+# Penalty.create_penalty as it was before the closed form accrual, one row per day
+def legacy_create_penalty(installment, penalty_date, last_penalty_amount, penalty_multiplier):
+    balance_remaining = installment.amount_remaining
+    penalty_amount = Penalty.compute_penalty(balance_remaining, penalty_multiplier)
+    if balance_remaining > 0 and penalty_amount > 0:
+        penalty = Penalty(
+            installment=installment,
+            date=penalty_date,
+            amount=last_penalty_amount + penalty_amount
+        )
+        penalty.full_clean()
+        penalty.save()
+        return penalty.amount
+
+    return last_penalty_amount
+
+# Installment.update_penalty as it was before the closed form accrual, kept as the baseline
+def legacy_update_penalty(installment, final_date, penalty_multiplier=None):
+    if installment.due_date >= final_date or installment.installment_paid():
+        return
+
+    last_penalty = Penalty.objects.filter(installment=installment).order_by('date').last()
+    if last_penalty:
+        last_penalty_date = last_penalty.date
+        last_penalty_amount = last_penalty.amount
+    else:
+        last_penalty_date = installment.due_date
+        last_penalty_amount = 0
+
+    while last_penalty_date < final_date:
+        last_penalty_date += timedelta(days=1)
+        last_penalty_amount = legacy_create_penalty(installment, last_penalty_date, last_penalty_amount, penalty_multiplier)
+
+def run(options, stdout):
+    user = User.objects.create_user(username='benchmark-accrual', password='benchmark')
+    approval_date = date.today() - timedelta(days=options['outage_days'] + 7 * options['tenure'])
+    final_date = date.today()
+    results = []
+    snapshots = []
+    for mode, update_penalty in [('daily_loop', legacy_update_penalty), ('closed_form', Installment.update_penalty)]:
+        for _ in range(options['loans']):
+            loan = Loan.create_loan({'amount': 10000, 'tenure': options['tenure'], 'periodicity': 'weekly'}, user)
+            loan.approve_loan(approval_date)
+
+        installments = list(Installment.objects.filter(loanshare__user=user, penalty__isnull=True).distinct())
+        samples = []
+        queries = 0
+        for installment in installments:
+            reset_queries()
+            with CaptureQueriesContext(connection) as captured, Timer() as timer:
+                update_penalty(installment, final_date)
+            samples.append(timer.elapsed)
+            queries += len(captured)
+
+        snapshots.append([
+            [(p.date - i.due_date, p.amount) for p in Penalty.objects.filter(installment=i).order_by('date')]
+            for i in installments
+        ])
+        result = {
+            'mode': mode,
+            'installments': len(installments),
+            'rows_written': Penalty.objects.filter(installment__in=installments).count(),
+            'queries_per_installment': round(queries / len(installments), 1),
+        }
+        result.update(summarize(samples))
+        results.append(result)
+        stdout.write(
+            f"{mode:>12}: {result['rows_written']} rows, p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms, "
+            f"{result['queries_per_installment']} queries per installment"
+        )
+
+    if snapshots[0] != snapshots[1]:
+        raise AssertionError("closed form accrual differs from the daily loop")
+    return results
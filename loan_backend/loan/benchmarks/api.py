@@ -0,0 +1,157 @@
+import json
+import threading
+from datetime import date
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from loan import tasks
+from loan.benchmarks import Timer, summarize
+from loan.benchmarks.data import seed_loans
+from loan.models import Loan, LoanShare, Installment, LoanRepayment, InstallmentDetail, Penalty, PenaltySegment
+from loan_backend.config import LoanStatus
+
+help = "load test of the loan API, latency, queries and rows written per request at a given concurrency"
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+COUNTED_MODELS = [Loan, LoanShare, Installment, LoanRepayment, InstallmentDetail, Penalty, PenaltySegment]
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--loans-per-user', type=int, default=5)
+    parser.add_argument('--max-tenure', type=int, default=24)
+    parser.add_argument('--requests', type=int, default=100, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=1, help='clients sending requests at the same time')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data and the requests')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+
+def row_counts():
+    return {model._meta.db_table: model.objects.count() for model in COUNTED_MODELS}
+
+# requests is a list of (user, method, url, data), spread round robin over concurrency threads
+# each with its own client and database connection
+def drive(requests, concurrency):
+    samples = []
+    lock = threading.Lock()
+
+    def client_loop(share):
+        client = APIClient(raise_request_exception=False)
+        try:
+            for user, method, url, data in share:
+                client.force_authenticate(user)
+                with CaptureQueriesContext(connection) as captured, Timer() as timer:
+                    response = getattr(client, method)(url, data, format='json' if method == 'post' else None)
+                writes = len([q for q in captured.captured_queries if q['sql'].lstrip().upper().startswith(WRITE_STATEMENTS)])
+                with lock:
+                    samples.append((timer.elapsed, len(captured), writes, response.status_code))
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=client_loop, args=(requests[n::concurrency],)) for n in range(concurrency)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return samples, timer.elapsed
+
+def measure(endpoint, requests, concurrency):
+    before = row_counts()
+    samples, elapsed = drive(requests, concurrency)
+    after = row_counts()
+    queries = [s[1] for s in samples]
+    result = {
+        'endpoint': endpoint,
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'errors': len([s for s in samples if s[3] >= 400]),
+        'requests_per_second': round(len(samples) / elapsed, 1) if elapsed else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'max_queries': max(queries) if queries else None,
+        'write_queries_per_request': round(sum(s[2] for s in samples) / len(samples), 2) if samples else None,
+        'rows_written': {table: after[table] - before[table] for table in after if after[table] != before[table]},
+    }
+    result.update(summarize([s[0] for s in samples]))
+    return result
+
+def penalty_cron():
+    before = row_counts()
+    with CaptureQueriesContext(connection) as captured, Timer() as timer:
+        tasks.update_penalty(final_date=date.today())
+    after = row_counts()
+    result = {
+        'endpoint': 'tasks.update_penalty',
+        'concurrency': 1,
+        'requests': 1,
+        'errors': 0,
+        'queries_per_request': len(captured),
+        'max_queries': len(captured),
+        'write_queries_per_request': len([q for q in captured.captured_queries if q['sql'].lstrip().upper().startswith(WRITE_STATEMENTS)]),
+        'rows_written': {table: after[table] - before[table] for table in after if after[table] != before[table]},
+    }
+    result.update(summarize([timer.elapsed]))
+    return result
+
+def compare(results, baseline_path, stdout):
+    with open(baseline_path) as f:
+        baseline = {row['endpoint']: row for row in json.load(f)['results']}
+
+    for row in results:
+        old = baseline.get(row['endpoint'])
+        if old is None:
+            continue
+        stdout.write(
+            f"{row['endpoint']:>22}: p95 {old['p95_ms']}ms -> {row['p95_ms']}ms, "
+            f"queries {old['queries_per_request']} -> {row['queries_per_request']}"
+        )
+
+def run(options, stdout):
+    if connection.vendor == 'sqlite' and options['concurrency'] > 1 and connection.is_in_memory_db():
+        stdout.write("the in memory sqlite database locks whole tables, set DB_TEST_NAME (and SQLITE_PERFORMANCE_MODE=1) for concurrent runs")
+    data = seed_loans(options['users'], options['loans_per_user'], max_tenure=options['max_tenure'], seed=options['seed'])
+    rng = data['rng']
+    users = data['users']
+    loanshares = data['loanshares']
+    staff = User.objects.create_user(username='load-staff', password='!', is_staff=True)
+    count = options['requests']
+    stdout.write(f"seeded {len(users)} users, {len(loanshares)} loans, {Installment.objects.count()} installments")
+
+    phases = [
+        ('POST loan/', lambda: [
+            (rng.choice(users), 'post', reverse('loan_view'), {
+                'amount': rng.randrange(1000, 100000), 'tenure': rng.randint(2, options['max_tenure']), 'periodicity': 'weekly'
+            }) for _ in range(count)
+        ]),
+        ('GET loan/', lambda: [
+            (rng.choice(users), 'get', reverse('loan_view'), {'limit': 20}) for _ in range(count)
+        ]),
+        ('POST approve/', lambda: [
+            (staff, 'post', reverse('approve_loan_view'), {'loan_id': loan_id})
+            for loan_id in Loan.objects.filter(loanshare__user__in=users, status=LoanStatus.PENDING.name).values_list('id', flat=True)[:count]
+        ]),
+        ('POST add-payment/', lambda: [
+            (ls.user, 'post', reverse('add_payment_view'), {
+                'loan_id': ls.id, 'amount': rng.randrange(100, 5000), 'payment_id': f'LOAD-{n}'
+            }) for n, ls in enumerate(rng.choice(loanshares) for _ in range(count))
+        ]),
+    ]
+
+    results = []
+    for endpoint, build_requests in phases:
+        result = measure(endpoint, build_requests(), options['concurrency'])
+        results.append(result)
+        stdout.write(
+            f"{endpoint:>22}: p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms p99 {result['p99_ms']}ms, "
+            f"{result['queries_per_request']} queries/request, {result['errors']} errors, rows {result['rows_written']}"
+        )
+
+    result = penalty_cron()
+    results.append(result)
+    stdout.write(f"{result['endpoint']:>22}: {result['mean_ms']}ms, {result['queries_per_request']} queries, rows {result['rows_written']}")
+
+    if options['baseline']:
+        compare(results, options['baseline'], stdout)
+
+    return results
@@ -0,0 +1,70 @@
+from datetime import date
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+from loan.benchmarks import Timer, summarize
+from loan.models import Loan, Installment
+from loan_backend.config import LoanStatus, Periodicity
+
+help = "loan approval latency against tenure and periodicity, per installment inserts vs bulk_create"
+
+def add_arguments(parser):
+    parser.add_argument('--tenures', default='6,12,24,60', help='comma separated tenures')
+    parser.add_argument('--periodicities', default=','.join(p.name for p in Periodicity))
+    parser.add_argument('--repeat', type=int, default=10, help='approvals per combination')
+
+# Installment.create_installment as it was before installments were bulk created
+def legacy_create_installment(loanshare, emi_data, order):
+    installment = Installment(
+        order=order,
+        loanshare=loanshare,
+        due_date=emi_data['due_date'],
+        suggested_emi=emi_data['suggested_emi']
+    )
+    installment.full_clean()
+    installment.save()
+
+# approval as it was done before installments were bulk created, kept as the baseline
+def approve_per_installment(loan, approval_date):
+    with transaction.atomic():
+        loan.status = LoanStatus.APPROVED.name
+        loan.approval_date = approval_date
+        loan.full_clean()
+        loan.save()
+
+        for ls in loan.loanshare_set.all():
+            ls.status = LoanStatus.APPROVED.name
+            ls.full_clean()
+            ls.save()
+            for i, emi in enumerate(ls.calculate_emis(approval_date)):
+                legacy_create_installment(ls, emi, i + 1)
+
+def approve_bulk(loan, approval_date):
+    loan.approve_loan(approval_date)
+
+def run(options, stdout):
+    user = User.objects.create_user(username='benchmark-approval', password='benchmark')
+    approval_date = date.today()
+    results = []
+    for periodicity in options['periodicities'].split(','):
+        for tenure in [int(t) for t in options['tenures'].split(',')]:
+            for mode, approve in [('per_installment', approve_per_installment), ('bulk', approve_bulk)]:
+                samples = []
+                queries = 0
+                for _ in range(options['repeat']):
+                    loan = Loan.create_loan({'amount': 100000, 'tenure': tenure, 'periodicity': periodicity}, user)
+                    reset_queries()
+                    with CaptureQueriesContext(connection) as captured, Timer() as timer:
+                        approve(loan, approval_date)
+                    samples.append(timer.elapsed)
+                    queries = len(captured)
+
+                result = {'periodicity': periodicity, 'tenure': tenure, 'mode': mode, 'queries': queries}
+                result.update(summarize(samples))
+                results.append(result)
+                stdout.write(
+                    f"{periodicity:>8} tenure {tenure:>3} {mode:>15}: p50 {result['p50_ms']}ms "
+                    f"p95 {result['p95_ms']}ms, {queries} queries"
+                )
+
+    return results
@@ -0,0 +1,131 @@
+import asyncio
+import io
+import threading
+from urllib.parse import urlencode
+from wsgiref.util import setup_testing_defaults
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+from loan.benchmarks import Timer, summarize
+from loan.benchmarks.data import seed_loans
+
+help = "loan read path served by the WSGI application with sync views vs the ASGI application with async views"
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--loans-per-user', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and server')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight at the same time')
+    parser.add_argument('--seed', type=int, default=0)
+
+# requests are (path, query, token), sent straight to the application callables so that no server or
+# network is measured, concurrency threads for WSGI and concurrency tasks on one event loop for ASGI
+def wsgi_request(application, path, query, token):
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': urlencode(query),
+        'HTTP_AUTHORIZATION': f'Bearer {token}',
+        'wsgi.input': io.BytesIO(),
+    }
+    setup_testing_defaults(environ)
+    status = []
+    body = b''.join(application(environ, lambda response_status, headers: status.append(response_status)))
+    return int(status[0].split()[0]), body
+
+async def asgi_request(application, path, query, token):
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': urlencode(query).encode(),
+        'root_path': '',
+        'headers': [(b'host', b'localhost'), (b'authorization', f'Bearer {token}'.encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    return messages[0]['status'], b''.join(m.get('body', b'') for m in messages[1:])
+
+def run_wsgi(requests, concurrency):
+    from loan_backend.wsgi import application
+    samples = []
+    lock = threading.Lock()
+
+    def client_loop(share):
+        for request in share:
+            with Timer() as timer:
+                status, _ = wsgi_request(application, *request)
+            with lock:
+                samples.append((timer.elapsed, status))
+
+    threads = [threading.Thread(target=client_loop, args=(requests[n::concurrency],)) for n in range(concurrency)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return samples, timer.elapsed
+
+def run_asgi(requests, concurrency):
+    from loan_backend.asgi import application
+
+    async def drive():
+        samples = []
+        slots = asyncio.Semaphore(concurrency)
+
+        async def send(request):
+            async with slots:
+                with Timer() as timer:
+                    status, _ = await asgi_request(application, *request)
+                samples.append((timer.elapsed, status))
+
+        await asyncio.gather(*[send(request) for request in requests])
+        return samples
+
+    with Timer() as timer:
+        samples = asyncio.run(drive())
+
+    return samples, timer.elapsed
+
+def run(options, stdout):
+    data = seed_loans(options['users'], options['loans_per_user'], seed=options['seed'])
+    rng = data['rng']
+    tokens = {user.id: str(AccessToken.for_user(user)) for user in data['users']}
+    endpoints = {
+        'GET loan/': lambda ls: (reverse('loan_view'), {'limit': 20}, tokens[ls.user_id]),
+        'GET loan/<id>/': lambda ls: (reverse('loan_detail_view', args=[ls.loan_id]), {}, tokens[ls.user_id]),
+    }
+
+    results = []
+    for endpoint, build_request in endpoints.items():
+        requests = [build_request(rng.choice(data['loanshares'])) for _ in range(options['requests'])]
+        for server, serve in [('wsgi', run_wsgi), ('asgi', run_asgi)]:
+            samples, elapsed = serve(requests, options['concurrency'])
+            result = {
+                'endpoint': endpoint,
+                'server': server,
+                'concurrency': options['concurrency'],
+                'errors': len([s for s in samples if s[1] >= 400]),
+                'requests_per_second': round(len(samples) / elapsed, 1) if elapsed else None,
+            }
+            result.update(summarize([s[0] for s in samples]))
+            results.append(result)
+            stdout.write(
+                f"{endpoint:>15} {server}: {result['requests_per_second']} requests/s, p50 {result['p50_ms']}ms "
+                f"p95 {result['p95_ms']}ms p99 {result['p99_ms']}ms, {result['errors']} errors"
+            )
+
+    return results
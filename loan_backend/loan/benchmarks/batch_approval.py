@@ -0,0 +1,35 @@
+from datetime import date
+from django.contrib.auth.models import User
+from loan.benchmarks import Timer
+from loan.models import Loan
+
+help = "batch loan approval throughput in loans per second"
+
+def add_arguments(parser):
+    parser.add_argument('--loans', type=int, default=1000, help='pending loans approved per run')
+    parser.add_argument('--chunk-sizes', default='50,200,1000', help='comma separated approval chunk sizes')
+    parser.add_argument('--tenure', type=int, default=12)
+
+def run(options, stdout):
+    user = User.objects.create_user(username='benchmark-batch-approval', password='benchmark')
+    results = []
+    for chunk_size in [int(c) for c in options['chunk_sizes'].split(',')]:
+        loan_ids = [
+            Loan.create_loan({'amount': 10000, 'tenure': options['tenure']}, user).id
+            for _ in range(options['loans'])
+        ]
+        with Timer() as timer:
+            outcome = Loan.approve_loans(loan_ids, date.today(), chunk_size=chunk_size)
+
+        approved = len([error for error in outcome.values() if error is None])
+        result = {
+            'chunk_size': chunk_size,
+            'loans': len(loan_ids),
+            'approved': approved,
+            'elapsed_seconds': round(timer.elapsed, 3),
+            'loans_per_second': round(len(loan_ids) / timer.elapsed, 1),
+        }
+        results.append(result)
+        stdout.write(f"chunk size {chunk_size:>5}: {approved} loans approved at {result['loans_per_second']} loans/s")
+
+    return results
@@ -0,0 +1,33 @@
+import random
+from datetime import date, timedelta
+from django.contrib.auth.models import User
+from loan.models import Loan, LoanShare
+from loan_backend.config import Periodicity
+
+# Synthetic data for load tests, the same seed always generates the same users, loans and schedules.
+# Users get unusable passwords so that seeding does not spend its time hashing.
+def seed_loans(users, loans_per_user, max_tenure=24, history_days=180, seed=0, prefix='load'):
+    rng = random.Random(seed)
+    User.objects.bulk_create([User(username=f'{prefix}-{n}', password='!') for n in range(users)])
+    seeded_users = list(User.objects.filter(username__startswith=f'{prefix}-').order_by('id'))
+
+    approvals = {}
+    for user in seeded_users:
+        for _ in range(loans_per_user):
+            loan = Loan.create_loan({
+                'amount': rng.randrange(1000, 100000),
+                'tenure': rng.randint(2, max_tenure),
+                'periodicity': rng.choice([p.name for p in Periodicity]),
+            }, user)
+            # approved on one of a few dates, so that some installments are overdue and accrue penalty
+            approval_date = date.today() - timedelta(days=rng.choice(range(0, history_days + 1, 30)))
+            approvals.setdefault(approval_date, []).append(loan.id)
+
+    for approval_date, loan_ids in approvals.items():
+        Loan.approve_loans(loan_ids, approval_date)
+
+    return {
+        'users': seeded_users,
+        'loanshares': list(LoanShare.objects.filter(user__in=seeded_users).select_related('user').order_by('id')),
+        'rng': rng,
+    }
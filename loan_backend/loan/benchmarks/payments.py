@@ -0,0 +1,182 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries, transaction
+from django.test.utils import CaptureQueriesContext
+from loan import errors
+from loan.benchmarks import Timer, summarize
+from loan.models import Loan, LoanShare, LoanRepayment, Installment, InstallmentDetail, Penalty
+from loan_backend.config import InstallmentStatus
+
+help = "payment allocation latency and queries, per installment allocation vs single pass allocation"
+
+def add_arguments(parser):
+    parser.add_argument('--tenure', type=int, default=24)
+    parser.add_argument('--installments-per-payment', type=int, default=6)
+    parser.add_argument('--repeat', type=int, default=10)
+
+# The Installment, InstallmentDetail and Penalty methods LoanShare.add_payment went through before the single pass
+# allocation, kept as the baseline. Balances are summed from the InstallmentDetail ledger and the penalty is the
+# latest daily Penalty row, every installment is locked, allocated, saved and corrected on its own.
+def legacy_amount_remaining(installment):
+    amount_paid = 0
+    for ins in InstallmentDetail.objects.filter(installment=installment):
+        amount_paid += ins.amount
+    return installment.suggested_emi - amount_paid
+
+def legacy_penalty(installment):
+    penalty = Penalty.objects.filter(installment=installment).order_by('date').last()
+    return penalty.amount if penalty else 0
+
+def legacy_penalty_remaining(installment):
+    penalty_paid = 0
+    for ins in InstallmentDetail.objects.filter(installment=installment):
+        penalty_paid += ins.penalty
+    return legacy_penalty(installment) - penalty_paid
+
+def legacy_modify_penalty_after(installment, last_penalty_date):
+    successive_penalties = Penalty.objects.filter(installment=installment, date__gt=last_penalty_date).order_by('date')
+    if not successive_penalties:
+        return
+
+    balance_remaining = legacy_amount_remaining(installment)
+    penalty_amount = Penalty.compute_penalty(balance_remaining, None)
+    if balance_remaining <= 0 or penalty_amount <= 0:
+        successive_penalties.delete()
+        return
+
+    try:
+        last_penalty = Penalty.objects.get(installment=installment, date=last_penalty_date)
+        last_penalty_amount = last_penalty.amount
+    except Penalty.DoesNotExist:
+        last_penalty_amount = 0
+
+    for penalty in successive_penalties:
+        last_penalty_amount += penalty_amount
+        penalty.amount = last_penalty_amount
+        penalty.full_clean()
+        penalty.save()
+
+def legacy_update_installment_status(installment, payment_date):
+    if legacy_amount_remaining(installment) >= installment.suggested_emi:
+        installment.status = InstallmentStatus.UNPAID.name
+    elif legacy_amount_remaining(installment) > 0 and legacy_amount_remaining(installment) < installment.suggested_emi:
+        installment.status = InstallmentStatus.PARTIALLY_PAID.name
+    elif legacy_amount_remaining(installment) == 0:
+        if legacy_penalty_remaining(installment) > 0:
+            installment.status = InstallmentStatus.PAID_WITHOUT_PENALTY.name
+        else:
+            installment.status = InstallmentStatus.PAID.name
+
+    installment.full_clean()
+    installment.save()
+
+    if payment_date is not None:
+        legacy_modify_penalty_after(installment, payment_date)
+
+def legacy_installment_detail(installment, loan_repayment, amount_ddt=None, penalty_ddt=None, additional_penalty=None):
+    ins_detail, created = InstallmentDetail.objects.get_or_create(
+        installment=installment,
+        loan_repayment=loan_repayment,
+    )
+    if amount_ddt is not None:
+        ins_detail.amount = amount_ddt
+    if penalty_ddt is not None:
+        ins_detail.penalty = penalty_ddt
+    if additional_penalty is not None:
+        ins_detail.penalty = ins_detail.penalty + additional_penalty if ins_detail.penalty else additional_penalty
+
+    ins_detail.full_clean()
+    ins_detail.save()
+    legacy_update_installment_status(installment, loan_repayment.payment_date)
+
+def legacy_fulfill_loan_amount(installment, amount_paid, loan_repayment):
+    amount_ddt = 0
+    if installment.installment_paid() or amount_paid <= 0:
+        return amount_paid
+
+    locked_ins = Installment.objects.select_for_update(of=('self',)).get(pk=installment.pk)
+    amount_remaining = legacy_amount_remaining(locked_ins)
+    if amount_remaining > 0:
+        amount_ddt = min(amount_remaining, amount_paid)
+        amount_paid -= amount_ddt
+
+    legacy_installment_detail(locked_ins, loan_repayment, amount_ddt=amount_ddt)
+    return amount_paid
+
+def legacy_fulfill_penalty(installment, amount_paid, loan_repayment):
+    penalty_ddt = 0
+    if installment.status != InstallmentStatus.PAID_WITHOUT_PENALTY.name or amount_paid <= 0:
+        return amount_paid
+
+    locked_ins = Installment.objects.select_for_update(of=('self',)).get(pk=installment.pk)
+    penalty_remaining = legacy_penalty_remaining(locked_ins)
+    if penalty_remaining > 0:
+        penalty_ddt = min(penalty_remaining, amount_paid)
+        amount_paid -= penalty_ddt
+
+    legacy_installment_detail(locked_ins, loan_repayment, penalty_ddt=penalty_ddt)
+    return amount_paid
+
+# LoanShare.add_payment as it was before the single pass allocation, kept as the baseline
+def legacy_add_payment(loanshare, amount_paid, payment_id, payment_date):
+    if not loanshare.loan.is_active:
+        raise errors.InactiveLoan()
+
+    amount_paid = Decimal(str(round(amount_paid, 5)))
+    with transaction.atomic():
+        loan_repayment = LoanRepayment.create_loan_repayment(loanshare, payment_id, payment_date, amount_paid)
+        installments = Installment.objects.filter(
+            loanshare=loanshare
+        ).exclude(
+            status__in=[InstallmentStatus.PAID.name, InstallmentStatus.PAID_WITHOUT_PENALTY.name]
+        ).order_by('order')
+
+        for i in installments:
+            if amount_paid > 0:
+                amount_paid = legacy_fulfill_loan_amount(i, amount_paid, loan_repayment)
+
+        if amount_paid > 0:
+            installments = Installment.objects.filter(
+                loanshare=loanshare,
+                status=InstallmentStatus.PAID_WITHOUT_PENALTY.name,
+            ).order_by('order')
+            for i in installments:
+                if amount_paid > 0:
+                    amount_paid = legacy_fulfill_penalty(i, amount_paid, loan_repayment)
+
+        if amount_paid > 0:
+            last_ins = Installment.objects.select_for_update(of=('self',)).filter(
+                loanshare=loanshare,
+            ).order_by('order').last()
+            legacy_installment_detail(last_ins, loan_repayment, additional_penalty=amount_paid)
+
+        loanshare.update_loanshare_status()
+
+def run(options, stdout):
+    user = User.objects.create_user(username='benchmark-payments', password='benchmark')
+    approval_date = date.today() - timedelta(days=365)
+    results = []
+    for mode, add_payment in [('per_installment', legacy_add_payment), ('single_pass', LoanShare.add_payment)]:
+        samples = []
+        queries = 0
+        for n in range(options['repeat']):
+            loan = Loan.create_loan({'amount': 100000, 'tenure': options['tenure'], 'periodicity': 'weekly'}, user)
+            loan.approve_loan(approval_date)
+            loanshare = LoanShare.objects.get(loan=loan)
+            for i in Installment.objects.filter(loanshare=loanshare, order__lte=options['installments_per_payment']):
+                i.update_penalty(final_date=date.today())
+
+            amount = sum(i.suggested_emi for i in Installment.objects.filter(loanshare=loanshare)[:options['installments_per_payment']])
+            reset_queries()
+            with CaptureQueriesContext(connection) as captured, Timer() as timer:
+                add_payment(loanshare, amount, f'BENCHMARK-{mode}-{n}', approval_date + timedelta(days=30))
+            samples.append(timer.elapsed)
+            queries = len(captured)
+
+        result = {'mode': mode, 'queries': queries}
+        result.update(summarize(samples))
+        results.append(result)
+        stdout.write(f"{mode:>16}: p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms, {queries} queries")
+
+    return results
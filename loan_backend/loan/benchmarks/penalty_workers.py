@@ -0,0 +1,55 @@
+from django.db import connection
+from loan.benchmarks import Timer
+from loan.benchmarks.data import seed_loans
+from loan.models import Installment, Penalty, PenaltyCheckpoint, PenaltySegment
+from loan.penalty import ParallelPenaltyRunner
+
+help = "penalty cron throughput in installments per second against the number of worker processes"
+
+def add_arguments(parser):
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--loans-per-user', type=int, default=10)
+    parser.add_argument('--max-tenure', type=int, default=24)
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--dry-run', action='store_true', help='compute the penalties without writing them')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+
+# every worker count starts from the same state, nothing accrued yet
+def reset_penalties():
+    Penalty.objects.all().delete()
+    PenaltySegment.objects.all().delete()
+    PenaltyCheckpoint.objects.all().delete()
+    Installment.objects.update(penalty_accrued_through=None, penalty_accrued=0)
+
+def run(options, stdout):
+    worker_counts = [int(w) for w in options['workers'].split(',')]
+    if connection.vendor == 'sqlite' and max(worker_counts) > 1:
+        if not options['dry_run']:
+            stdout.write("sqlite allows a single writer, runs with more workers fall back to one process, use --dry-run or postgresql")
+        elif connection.is_in_memory_db():
+            stdout.write("worker processes cannot open the in memory sqlite database, set DB_TEST_NAME to run them")
+
+    seed_loans(options['users'], options['loans_per_user'], options['max_tenure'], seed=options['seed'], prefix='penalty-workers')
+    results = []
+    for workers in worker_counts:
+        reset_penalties()
+        with Timer() as timer:
+            summary = ParallelPenaltyRunner(workers=workers, dry_run=options['dry_run']).run()
+
+        result = {
+            'workers': workers,
+            'workers_used': summary['workers'],
+            'shards': len(summary['shards']),
+            'failed_shards': len(summary['failed_shards']),
+            'installments_scanned': summary['installments_scanned'],
+            'rows_written': summary['rows_written'],
+            'elapsed_seconds': round(timer.elapsed, 3),
+            'installments_per_second': round(summary['installments_scanned'] / timer.elapsed, 1),
+        }
+        results.append(result)
+        stdout.write(
+            f"{workers:>2} workers ({summary['workers']} used): {result['installments_scanned']} installments, "
+            f"{result['rows_written']} rows at {result['installments_per_second']} installments/s"
+        )
+
+    return results
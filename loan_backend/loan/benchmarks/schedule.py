@@ -0,0 +1,88 @@
+import random
+from datetime import date
+from django.contrib.auth.models import User
+from loan.benchmarks import Timer
+from loan.models import Loan, LoanShare
+from loan.schedule import due_dates, emi_schedules
+from loan_backend.config import Periodicity
+from loan_backend.constants import DEFAULT_DECIMAL_PLACES
+
+help = "emi schedule generation, per row loop vs the batched schedule engine"
+
+def add_arguments(parser):
+    parser.add_argument('--loanshares', type=int, default=2000, help='pending loanshares to generate schedules for')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+
+# LoanShare.calculate_emis as it was before the schedule engine, kept as the baseline
+def legacy_calculate_emis(loanshare, start_date):
+    loan = loanshare.loan
+    total_amount = round(
+        loanshare.share +
+        (loanshare.share * loan.tenure * (loan.interest / loan.calculate_periodicity_factor())) +
+        (loanshare.share * loan.processing_fee),
+        DEFAULT_DECIMAL_PLACES
+    )
+    int_total_amount = total_amount * (10 ** DEFAULT_DECIMAL_PLACES)
+    int_emi_amount = int_total_amount // loan.tenure
+    rem_amount = int_total_amount - (int_emi_amount * loan.tenure)
+    emis = []
+    for t in range(loan.tenure):
+        emi = {
+            'due_date': loan.effective_due_date(start_date, t),
+            'status': 'NOT_STARTED',
+            'paid_amount': 0
+        }
+        if rem_amount > 0:
+            suggested_emi = int_emi_amount + 1
+            rem_amount -= 1
+        else:
+            suggested_emi = int_emi_amount
+
+        emi['suggested_emi'] = suggested_emi / (10 ** DEFAULT_DECIMAL_PLACES)
+        emis.append(emi)
+
+    return emis
+
+def run(options, stdout):
+    rng = random.Random(options['seed'])
+    user = User.objects.create_user(username='benchmark-schedule', password='benchmark')
+    periodicities = [p.name for p in Periodicity]
+    for _ in range(options['loanshares']):
+        Loan.create_loan({
+            'amount': rng.randint(1000, 500000) + rng.randint(0, 99) / 100,
+            'tenure': rng.randint(1, 60),
+            'periodicity': rng.choice(periodicities),
+        }, user)
+
+    loanshares = list(LoanShare.objects.select_related('loan'))
+    start_date = date.today()
+    legacy_samples = []
+    engine_samples = []
+    for _ in range(options['repeat']):
+        with Timer() as timer:
+            legacy = {ls.id: legacy_calculate_emis(ls, start_date) for ls in loanshares}
+        legacy_samples.append(timer.elapsed)
+
+        due_dates.cache_clear()
+        with Timer() as timer:
+            schedules = emi_schedules(loanshares, start_date)
+        engine_samples.append(timer.elapsed)
+
+    if schedules != legacy:
+        raise AssertionError("schedule engine output differs from the legacy loop")
+
+    legacy_best = min(legacy_samples)
+    engine_best = min(engine_samples)
+    result = {
+        'loanshares': len(loanshares),
+        'emis': sum(len(emis) for emis in schedules.values()),
+        'legacy_seconds': round(legacy_best, 4),
+        'engine_seconds': round(engine_best, 4),
+        'speedup': round(legacy_best / engine_best, 2),
+    }
+    stdout.write(
+        f"{result['loanshares']} schedules, {result['emis']} emis: loop {result['legacy_seconds']}s, "
+        f"engine {result['engine_seconds']}s ({result['speedup']}x)"
+    )
+    return [result]
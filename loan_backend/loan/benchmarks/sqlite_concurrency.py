@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+from datetime import date
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from loan.benchmarks import Timer, summarize
+from loan.models import Loan, LoanShare
+
+help = "concurrent payments against a sqlite file, stock backend vs lib.sqlite performance mode"
+
+MODES = {
+    'default': ('django.db.backends.sqlite3', {}),
+    'performance': ('lib.sqlite', {}),
+}
+
+def add_arguments(parser):
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--payments', type=int, default=25, help='payments per thread')
+
+# points the default alias at a new sqlite file with the given backend, every thread opens its own
+# connection from these settings
+def use_database(engine, options, name):
+    settings_dict = connections.settings['default']
+    connections['default'].close()
+    del connections['default']
+    settings_dict.update({'ENGINE': engine, 'NAME': name, 'OPTIONS': options})
+    call_command('migrate', verbosity=0)
+
+def pay(loanshare_ids, payments, samples, failures):
+    try:
+        for n in range(payments):
+            for loanshare_id in loanshare_ids:
+                with Timer() as timer:
+                    try:
+                        LoanShare.objects.select_related('loan').get(id=loanshare_id).add_payment(
+                            10, f'SQLITE-{loanshare_id}-{n}', date.today()
+                        )
+                    except OperationalError:
+                        failures.append(1)
+                        continue
+                samples.append(timer.elapsed)
+    finally:
+        connection.close()
+
+def run(options, stdout):
+    if connection.vendor != 'sqlite':
+        raise ValueError("this benchmark compares sqlite backends, run it with the sqlite configuration")
+
+    settings_dict = connections.settings['default']
+    original = {key: settings_dict[key] for key in ['ENGINE', 'NAME', 'OPTIONS']}
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for mode, (engine, db_options) in MODES.items():
+                use_database(engine, db_options, os.path.join(directory, f'{mode}.sqlite3'))
+                user = User.objects.create_user(username=f'benchmark-sqlite-{mode}', password='benchmark')
+                loanshare_ids = []
+                for _ in range(options['threads']):
+                    loan = Loan.create_loan({'amount': 100000, 'tenure': 52, 'periodicity': 'weekly'}, user)
+                    loan.approve_loan(date.today())
+                    loanshare_ids.append(LoanShare.objects.get(loan=loan).id)
+                connection.close()
+
+                samples = []
+                failures = []
+                threads = [
+                    threading.Thread(target=pay, args=([loanshare_id], options['payments'], samples, failures))
+                    for loanshare_id in loanshare_ids
+                ]
+                with Timer() as timer:
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+
+                attempted = len(samples) + len(failures)
+                result = {
+                    'mode': mode,
+                    'payments': attempted,
+                    'locked_errors': len(failures),
+                    'error_rate': round(len(failures) / attempted, 4) if attempted else 0,
+                    'payments_per_second': round(len(samples) / timer.elapsed, 1),
+                }
+                result.update(summarize(samples))
+                results.append(result)
+                stdout.write(
+                    f"{mode:>12}: {result['locked_errors']}/{attempted} database is locked errors, "
+                    f"p50 {result['p50_ms']}ms p95 {result['p95_ms']}ms p99 {result['p99_ms']}ms, "
+                    f"{result['payments_per_second']} payments/s"
+                )
+                connections['default'].close()
+    finally:
+        del connections['default']
+        settings_dict.update(original)
+
+    return results
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from loan.schedule import emi_schedules
+
+class LRUCacheBackend:
+    def __init__(self, max_size=10000, **kwargs):
+        self.max_size = max_size
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    @property
+    def size(self):
+        return len(self._data)
+
+# stores previews in one of settings.CACHES, to share them between processes
+class DjangoCacheBackend:
+    # evictions and size are not known for a shared cache
+    def __init__(self, alias='default', timeout=86400, **kwargs):
+        self.cache = caches[alias]
+        self.timeout = timeout
+        self.evictions = None
+        self.size = None
+
+    def cache_key(self, key):
+        return 'emi-preview:' + ':'.join(str(part) for part in key)
+
+    def get(self, key):
+        return self.cache.get(self.cache_key(key))
+
+    def set(self, key, value):
+        self.cache.set(self.cache_key(key), value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self.cache_key(key))
+
+# Schedule previews of loanshares that are not approved yet. A preview only depends on the loan terms and
+# the start date, so it is cached under those and stays valid until the day rolls over.
+class EmiPreviewCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    # decimals are normalized so that 0 and 0.00000 read from the database give the same key
+    @staticmethod
+    def key(loanshare, start_date):
+        loan = loanshare.loan
+        number = lambda value: format(Decimal(value).normalize(), 'f')
+        return (
+            number(loanshare.share),
+            loan.tenure,
+            loan.periodicity,
+            number(loan.interest),
+            number(loan.processing_fee),
+            start_date.isoformat(),
+        )
+
+    # returns {loanshare id: emis} like emi_schedules, computing only the missing previews
+    def schedules(self, loanshares, start_date):
+        schedules = {}
+        missing = []
+        for ls in loanshares:
+            cached = self.backend.get(self.key(ls, start_date))
+            if cached is None:
+                missing.append(ls)
+            else:
+                schedules[ls.id] = [dict(emi) for emi in cached]
+
+        computed = emi_schedules(missing, start_date)
+        for ls in missing:
+            self.backend.set(self.key(ls, start_date), computed[ls.id])
+            schedules[ls.id] = [dict(emi) for emi in computed[ls.id]]
+
+        with self._lock:
+            self.hits += len(schedules) - len(missing)
+            self.misses += len(missing)
+
+        return schedules
+
+    def invalidate(self, loanshares, start_date):
+        for ls in loanshares:
+            self.backend.delete(self.key(ls, start_date))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+            'size': self.backend.size,
+        }
+
+_emi_preview_cache = None
+
+def emi_preview_cache():
+    global _emi_preview_cache
+    if _emi_preview_cache is None:
+        config = dict(settings.EMI_PREVIEW_CACHE)
+        backend_class = import_string(config.pop('BACKEND'))
+        options = {k.lower(): v for k, v in config.items()}
+        _emi_preview_cache = EmiPreviewCache(backend_class(**options))
+    return _emi_preview_cache
+
+@receiver(setting_changed)
+def reset_emi_preview_cache(setting=None, **kwargs):
+    global _emi_preview_cache
+    if setting in (None, 'EMI_PREVIEW_CACHE'):
+        _emi_preview_cache = None
@@ -38,3 +38,27 @@ class InvalidPayment(APIException):
 
     def __init__(self, err):
         super().__init__(f"iinvalid payment details provided: {err}")
+
+class InvalidListingParams(APIException):
+    status_code = 400
+    default_detail = "invalid loan listing parameters:"
+    default_code = "invalid_listing_params"
+
+    def __init__(self, err):
+        super().__init__(f"invalid loan listing parameters: {err}")
+
+class InvalidBatchApproval(APIException):
+    status_code = 400
+    default_detail = "invalid batch approval request:"
+    default_code = "invalid_batch_approval"
+
+    def __init__(self, err):
+        super().__init__(f"invalid batch approval request: {err}")
+
+class InvalidBulkPayment(APIException):
+    status_code = 400
+    default_detail = "invalid bulk payment request:"
+    default_code = "invalid_bulk_payment"
+
+    def __init__(self, err):
+        super().__init__(f"invalid bulk payment request: {err}")
@@ -0,0 +1,137 @@
+import csv
+import json
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from lib.common import chunked
+from loan.models import LoanShare, LoanRepayment
+from loan_backend.constants import PAYMENT_INGEST_BATCH_SIZE
+
+APPLIED = 'applied'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+
+# json rows that are not objects are reported as failed rows instead of being parsed
+def payment_row(row):
+    return row if isinstance(row, dict) else {'error': "row should be a json object"}
+
+# rows of a reconciliation text stream as (line number, dict) without loading the whole file
+def read_payment_rows(stream, file_format):
+    if file_format == 'csv':
+        for line, row in enumerate(csv.DictReader(stream), start=2):
+            yield line, row
+    elif file_format == 'jsonl':
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                row = {'error': f"invalid json: {e}"}
+            yield line, payment_row(row)
+    else:
+        raise ValueError(f"unsupported file format {file_format}, use csv or jsonl")
+
+def parse_payment_row(row):
+    if row.get('error'):
+        raise ValueError(row['error'])
+
+    missing = [field for field in ['loan_id', 'payment_id', 'amount'] if row.get(field) in (None, '')]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+
+    try:
+        amount = Decimal(str(row['amount']))
+    except InvalidOperation:
+        raise ValueError(f"invalid amount {row['amount']}")
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError("amount should be positive")
+
+    payment_date = date.today()
+    if row.get('payment_date'):
+        payment_date = datetime.strptime(str(row['payment_date']), '%Y-%m-%d').date()
+
+    return {
+        'loan_id': int(row['loan_id']),
+        'payment_id': str(row['payment_id']),
+        'amount': amount,
+        'payment_date': payment_date,
+    }
+
+def result(line, payment_id, status, error=None):
+    return {'line': line, 'payment_id': payment_id, 'status': status, 'error': error}
+
+# Applies payments from (line, row) pairs. Every row is parsed first and the valid payments are ordered by loanshare
+# and payment date across the whole upload, so a payment is never applied after a later dated payment of the same
+# loanshare that happened to sit in an earlier batch. Payments are then applied batch_size at a time, one transaction
+# per batch and a savepoint per payment so that a failing payment does not roll back the others. Payments whose id
+# is already recorded are reported as duplicates, which makes re-ingesting a file safe. Yields one result per row in
+# input order once the upload is applied.
+def ingest_payments(rows, batch_size=PAYMENT_INGEST_BATCH_SIZE):
+    results = OrderedDict()
+    payments = []
+    seen = set()
+    for line, row in rows:
+        payment_id = row.get('payment_id') if isinstance(row, dict) else None
+        try:
+            payment = parse_payment_row(row)
+        except (ValueError, TypeError) as e:
+            results[line] = result(line, payment_id, FAILED, str(e))
+            continue
+
+        if payment['payment_id'] in seen:
+            results[line] = result(line, payment['payment_id'], DUPLICATE)
+            continue
+
+        seen.add(payment['payment_id'])
+        payment['line'] = line
+        results[line] = None
+        payments.append(payment)
+
+    payments.sort(key=lambda p: (p['loan_id'], p['payment_date'], p['line']))
+    for batch in chunked(payments, batch_size):
+        for r in ingest_batch(batch):
+            results[r['line']] = r
+
+    yield from results.values()
+
+def recorded_payments(payment_ids):
+    return set(LoanRepayment.objects.filter(payment__in=payment_ids).values_list('payment', flat=True))
+
+# payments are parsed and ordered by loanshare and payment date, returns their results in the same order
+def ingest_batch(payments):
+    results = []
+    recorded = recorded_payments([p['payment_id'] for p in payments])
+    loanshares = LoanShare.objects.select_related('loan').in_bulk({p['loan_id'] for p in payments})
+
+    with transaction.atomic():
+        for payment in payments:
+            if payment['payment_id'] in recorded:
+                status, error = DUPLICATE, None
+            elif payment['loan_id'] not in loanshares:
+                status, error = FAILED, f"invalid loan id {payment['loan_id']}"
+            else:
+                try:
+                    with transaction.atomic():
+                        loanshares[payment['loan_id']].add_payment(payment['amount'], payment['payment_id'], payment['payment_date'])
+                    status, error = APPLIED, None
+                except (IntegrityError, ValidationError) as e:
+                    # the unique payment id is only one of the constraints a payment can break, it is a
+                    # duplicate only when another transaction recorded the same id since the batch was read
+                    if LoanRepayment.objects.filter(payment=payment['payment_id']).exists():
+                        status, error = DUPLICATE, None
+                    else:
+                        status, error = FAILED, str(e)
+                except Exception as e:
+                    status, error = FAILED, str(e)
+            results.append(result(payment['line'], payment['payment_id'], status, error))
+
+    return results
+
+def summarize_results(results):
+    summary = {APPLIED: 0, DUPLICATE: 0, FAILED: 0}
+    for r in results:
+        summary[r['status']] += 1
+    return summary
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from loan.benchmarks import benchmark_database, write_results
+from loan.benchmarks import accrual, api, approval, asgi, batch_approval, payments, penalty_workers, schedule, sqlite_concurrency
+
+SCENARIOS = {
+    'accrual': accrual,
+    'api': api,
+    'approval': approval,
+    'asgi': asgi,
+    'batch_approval': batch_approval,
+    'payments': payments,
+    'penalty_workers': penalty_workers,
+    'schedule': schedule,
+    'sqlite_concurrency': sqlite_concurrency,
+}
+
+class Command(BaseCommand):
+    help = "Run a benchmark scenario against a throw away copy of the database"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='scenario', required=True)
+        for name, scenario in SCENARIOS.items():
+            subparser = subparsers.add_parser(name, help=scenario.help)
+            subparser.add_argument('--output', help='write results as JSON to this file')
+            subparser.add_argument('--keepdb', action='store_true', help='keep the benchmark database between runs')
+            scenario.add_arguments(subparser)
+
+    def handle(self, *args, **options):
+        scenario = SCENARIOS[options['scenario']]
+        with benchmark_database(keepdb=options['keepdb']):
+            results = scenario.run(options, self.stdout)
+
+        if options['output']:
+            write_results({'scenario': options['scenario'], 'results': results}, options['output'])
+            self.stdout.write(f"results written to {options['output']}")
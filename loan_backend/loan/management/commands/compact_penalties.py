@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from loan.models import Penalty
+from loan.penalty import compact_penalties, verify_penalty_segments
+
+class Command(BaseCommand):
+    help = "Rebuild penalty accrual segments from daily penalty rows and check that both give the same penalties"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true', help='only compare existing segments with daily rows')
+        parser.add_argument(
+            '--prune',
+            action='store_true',
+            help='delete daily penalty rows once segments are verified, only for PENALTY_STORAGE=SEGMENT deployments'
+        )
+
+    def handle(self, *args, **options):
+        if not options['verify_only']:
+            created = compact_penalties()
+            self.stdout.write(f"created {created} penalty segments from {Penalty.objects.count()} penalty rows")
+
+        mismatches = verify_penalty_segments()
+        for installment_id, penalty_date, penalty_amount, segment_amount in mismatches[:20]:
+            self.stderr.write(f"installment {installment_id} on {penalty_date}: row {penalty_amount} != segment {segment_amount}")
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} penalty rows do not match their segments")
+
+        self.stdout.write(self.style.SUCCESS("penalty segments match daily penalty rows"))
+        if options['prune']:
+            deleted, _ = Penalty.objects.all().delete()
+            self.stdout.write(f"deleted {deleted} daily penalty rows")
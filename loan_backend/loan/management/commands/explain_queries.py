@@ -0,0 +1,25 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from loan.query_plans import explain_hot_queries
+
+class Command(BaseCommand):
+    help = "Show the query plan of every hot query and check that it uses its index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='print the report as JSON')
+
+    def handle(self, *args, **options):
+        report = explain_hot_queries()
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            for row in report:
+                status = 'uses' if row['uses_index'] else 'does not use'
+                note = '' if row['expected'] else ' (partial index, used on postgresql)'
+                self.stdout.write(f"{row['query']}: {status} {row['index']}{note}")
+                for line in row['plan'].splitlines():
+                    self.stdout.write(f"    {line}")
+
+        missing = [row['query'] for row in report if row['expected'] and not row['uses_index']]
+        if missing:
+            raise CommandError(f"queries not using their index: {', '.join(missing)}")
@@ -0,0 +1,37 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from loan.ingestion import ingest_payments, read_payment_rows, APPLIED, DUPLICATE, FAILED
+from loan_backend.constants import PAYMENT_INGEST_BATCH_SIZE
+
+class Command(BaseCommand):
+    help = "Apply payments from a csv/jsonl reconciliation file with loan_id, payment_id, amount, payment_date columns"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=PAYMENT_INGEST_BATCH_SIZE)
+        parser.add_argument('--report', help='write one json result per row to this file')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        if file_format not in ['csv', 'jsonl']:
+            raise CommandError(f"unsupported file format {file_format}, use --format csv or jsonl")
+
+        summary = {APPLIED: 0, DUPLICATE: 0, FAILED: 0}
+        report = open(options['report'], 'w') if options['report'] else None
+        try:
+            with open(path, newline='') as f:
+                for result in ingest_payments(read_payment_rows(f, file_format), options['batch_size']):
+                    summary[result['status']] += 1
+                    if report:
+                        report.write(json.dumps(result) + '\n')
+                    if result['status'] == FAILED:
+                        self.stderr.write(f"line {result['line']}: payment {result['payment_id']} failed: {result['error']}")
+        finally:
+            if report:
+                report.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{summary[APPLIED]} payments applied, {summary[DUPLICATE]} duplicates skipped, {summary[FAILED]} failed"
+        ))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from loan.models import Installment
+
+class Command(BaseCommand):
+    help = "Rebuild Installment amount_paid and penalty_paid from the InstallmentDetail ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true', help='report out of sync installments without fixing them')
+
+    def handle(self, *args, **options):
+        mismatches = Installment.rebuild_balances(verify_only=options['verify_only'])
+        for installment_id, stored, ledger in mismatches[:20]:
+            self.stderr.write(f"installment {installment_id}: stored (amount, penalty) {stored} != ledger {ledger}")
+
+        if mismatches and options['verify_only']:
+            raise CommandError(f"{len(mismatches)} installments are out of sync with their ledger")
+
+        if mismatches:
+            self.stdout.write(self.style.WARNING(f"rebuilt balances of {len(mismatches)} installments"))
+        else:
+            self.stdout.write(self.style.SUCCESS("installment balances match the ledger"))
@@ -0,0 +1,56 @@
+import json
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from loan import tasks
+from loan_backend.constants import PENALTY_CHUNK_SIZE, PENALTY_BATCH_SIZE
+
+class Command(BaseCommand):
+    help = "Create penalties for every overdue installment up to the given date"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='final penalty date as YYYY-MM-DD, defaults to today')
+        parser.add_argument('--multiplier', type=float, help='daily penalty multiplier')
+        parser.add_argument('--chunk-size', type=int, default=PENALTY_CHUNK_SIZE)
+        parser.add_argument('--batch-size', type=int, default=PENALTY_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, help='shard by loanshare id over this many worker processes')
+        parser.add_argument('--shards', type=int, help='number of loanshare id shards, defaults to 4 per worker')
+        parser.add_argument('--loanshares', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                            help='only this loanshare id range, e.g. to rerun a failed shard')
+        parser.add_argument('--dry-run', action='store_true', help='report the rows every shard would write')
+
+    def handle(self, *args, **options):
+        final_date = None
+        if options['date']:
+            final_date = datetime.strptime(options['date'], '%Y-%m-%d').date()
+
+        if options['workers'] or options['shards'] or options['loanshares'] or options['dry_run']:
+            return self.run_sharded(final_date, options)
+
+        report = tasks.update_penalty(
+            final_date=final_date,
+            penalty_multiplier=options['multiplier'],
+            chunk_size=options['chunk_size'],
+            batch_size=options['batch_size'],
+            progress=lambda report: self.stdout.write(str(report))
+        )
+        self.stdout.write(self.style.SUCCESS(str(report)))
+
+    def run_sharded(self, final_date, options):
+        summary = tasks.update_penalty_parallel(
+            final_date=final_date,
+            penalty_multiplier=options['multiplier'],
+            workers=options['workers'] or 1,
+            shards=options['shards'],
+            chunk_size=options['chunk_size'],
+            batch_size=options['batch_size'],
+            loanshare_range=options['loanshares'],
+            dry_run=options['dry_run'],
+            progress=lambda result: self.stdout.write(json.dumps(result))
+        )
+        del summary['shards']
+        if summary['failed_shards']:
+            self.stderr.write(self.style.ERROR(
+                "failed shards, rerun each with --loanshares FIRST LAST: "
+                + ", ".join(f"{first} {last}" for first, last in summary['failed_shards'])
+            ))
+        self.stdout.write(self.style.SUCCESS(json.dumps(summary)))
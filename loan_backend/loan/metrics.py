@@ -0,0 +1,67 @@
+import os
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+# Business metrics of the loan operations, exposed at PATH_PREFIX + 'metrics'.
+# They are kept in process memory and never query the database. With several worker processes set
+# PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers, every process then writes its
+# samples there and the endpoint aggregates them. The penalty cron is a process of its own and needs the same
+# directory, or its samples are lost when it exits.
+
+LOANS_CREATED = Counter('loan_loans_created', 'Loans created')
+LOANS_APPROVED = Counter('loan_loans_approved', 'Loans approved')
+PAYMENTS_APPLIED = Counter('loan_payments_applied', 'Payments applied')
+PAYMENT_AMOUNT = Histogram(
+    'loan_payment_amount', 'Amount of applied payments',
+    buckets=(100, 500, 1000, 5000, 10000, 50000, 100000, 500000, float('inf'))
+)
+AMOUNT_ALLOCATED = Counter('loan_amount_allocated', 'Payment amount allocated to principal or penalty', ['allocation'])
+PENALTY_ROWS_WRITTEN = Counter('loan_penalty_rows_written', 'Penalty rows written by the penalty cron')
+PENALTY_CRON_DURATION = Histogram(
+    'loan_penalty_cron_duration_seconds', 'Duration of penalty cron runs',
+    buckets=(1, 5, 15, 60, 300, 900, 1800, 3600, 7200, float('inf'))
+)
+
+# operations are counted once their transaction commits, rolled back ones are not counted
+def loan_created():
+    transaction.on_commit(LOANS_CREATED.inc)
+
+def loans_approved(count=1):
+    if count:
+        transaction.on_commit(lambda: LOANS_APPROVED.inc(count))
+
+def payment_applied(principal, penalty):
+    def record():
+        PAYMENTS_APPLIED.inc()
+        PAYMENT_AMOUNT.observe(float(principal + penalty))
+        AMOUNT_ALLOCATED.labels('principal').inc(float(principal))
+        AMOUNT_ALLOCATED.labels('penalty').inc(float(penalty))
+
+    transaction.on_commit(record)
+
+def penalty_run(elapsed_seconds, rows_written):
+    PENALTY_CRON_DURATION.observe(elapsed_seconds)
+    PENALTY_ROWS_WRITTEN.inc(rows_written)
+
+# a scraper sending settings.METRICS_TOKEN as bearer token is let in without touching the database,
+# otherwise only staff users with an admin session
+def metrics_allowed(request):
+    token = settings.METRICS_TOKEN
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    return request.user.is_authenticated and request.user.is_staff
+
+def metrics_view(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 07:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loan', '0007_installmentdetail_penalty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PenaltySegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('daily_penalty', models.DecimalField(decimal_places=5, max_digits=20)),
+                ('amount', models.DecimalField(decimal_places=5, max_digits=20)),
+                ('installment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='loan.installment')),
+            ],
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2 on 2026-10-18 07:14
+
+from datetime import timedelta
+from itertools import groupby
+from django.db import migrations
+
+
+# frozen copy of loan.penalty.compact_penalty_rows as it was when this migration was written, so that the
+# migration does not change with the app code. rows are (date, amount) ordered by date, returns
+# (start_date, end_date, daily_penalty, amount) tuples
+def compact_penalty_rows(rows):
+    segments = []
+    last_date = None
+    last_amount = 0
+    for penalty_date, amount in rows:
+        daily_penalty = amount - last_amount
+        if segments and last_date + timedelta(days=1) == penalty_date and segments[-1][2] == daily_penalty:
+            start_date, _, _, _ = segments[-1]
+            segments[-1] = (start_date, penalty_date, daily_penalty, amount)
+        else:
+            segments.append((penalty_date, penalty_date, daily_penalty, amount))
+
+        last_date = penalty_date
+        last_amount = amount
+
+    return segments
+
+
+def compact_penalties(apps, schema_editor):
+    Penalty = apps.get_model('loan', 'Penalty')
+    PenaltySegment = apps.get_model('loan', 'PenaltySegment')
+    penalties = Penalty.objects.order_by('installment_id', 'date').values_list('installment_id', 'date', 'amount')
+    batch = []
+    for installment_id, rows in groupby(penalties.iterator(), key=lambda row: row[0]):
+        for start_date, end_date, daily_penalty, amount in compact_penalty_rows((row[1], row[2]) for row in rows):
+            batch.append(PenaltySegment(
+                installment_id=installment_id,
+                start_date=start_date,
+                end_date=end_date,
+                daily_penalty=daily_penalty,
+                amount=amount
+            ))
+
+        if len(batch) >= 1000:
+            PenaltySegment.objects.bulk_create(batch)
+            batch = []
+
+    PenaltySegment.objects.bulk_create(batch)
+
+
+def remove_segments(apps, schema_editor):
+    apps.get_model('loan', 'PenaltySegment').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loan', '0008_penaltysegment'),
+    ]
+
+    operations = [
+        migrations.RunPython(compact_penalties, remove_segments),
+    ]
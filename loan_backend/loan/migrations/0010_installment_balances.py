@@ -0,0 +1,37 @@
+# Generated by Django 4.2 on 2026-10-18 07:13
+
+from django.db import migrations, models
+
+
+def backfill_balances(apps, schema_editor):
+    Installment = apps.get_model('loan', 'Installment')
+    InstallmentDetail = apps.get_model('loan', 'InstallmentDetail')
+    installments = []
+    for row in InstallmentDetail.objects.values('installment').annotate(
+        amount=models.Sum('amount'),
+        penalty=models.Sum('penalty')
+    ).iterator():
+        installments.append(Installment(id=row['installment'], amount_paid=row['amount'], penalty_paid=row['penalty']))
+
+    Installment.objects.bulk_update(installments, ['amount_paid', 'penalty_paid'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loan', '0009_compact_penalties'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='installment',
+            name='amount_paid',
+            field=models.DecimalField(decimal_places=5, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='installment',
+            name='penalty_paid',
+            field=models.DecimalField(decimal_places=5, default=0, max_digits=20),
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 4.2 on 2026-10-18 07:28
+
+from decimal import Decimal
+from django.db import migrations, models
+
+
+# watermark from the latest daily penalty or penalty segment, whichever is later
+def backfill_watermarks(apps, schema_editor):
+    Installment = apps.get_model('loan', 'Installment')
+    Penalty = apps.get_model('loan', 'Penalty')
+    PenaltySegment = apps.get_model('loan', 'PenaltySegment')
+    last_penalty = Penalty.objects.filter(installment=models.OuterRef('pk')).order_by('-date')
+    last_segment = PenaltySegment.objects.filter(installment=models.OuterRef('pk')).order_by('-end_date')
+    places = Decimal(1).scaleb(-5)
+    installments = []
+    for row in Installment.objects.annotate(
+        penalty_date=models.Subquery(last_penalty.values('date')[:1]),
+        penalty_amount=models.Subquery(last_penalty.values('amount')[:1]),
+        segment_date=models.Subquery(last_segment.values('end_date')[:1]),
+        segment_amount=models.Subquery(last_segment.values('amount')[:1]),
+    ).values('id', 'penalty_date', 'penalty_amount', 'segment_date', 'segment_amount').iterator():
+        latest = [
+            (row['penalty_date'], row['penalty_amount']),
+            (row['segment_date'], row['segment_amount']),
+        ]
+        latest = [(accrued_through, amount) for accrued_through, amount in latest if accrued_through is not None]
+        if not latest:
+            continue
+
+        accrued_through, amount = max(latest, key=lambda watermark: watermark[0])
+        installments.append(Installment(
+            id=row['id'],
+            penalty_accrued_through=accrued_through,
+            penalty_accrued=Decimal(amount).quantize(places)
+        ))
+
+    Installment.objects.bulk_update(installments, ['penalty_accrued_through', 'penalty_accrued'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loan', '0010_installment_balances'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PenaltyCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('final_date', models.DateField()),
+                ('first_loanshare', models.IntegerField(blank=True, null=True)),
+                ('last_loanshare', models.IntegerField(blank=True, null=True)),
+                ('last_installment', models.IntegerField(default=0)),
+                ('installments_scanned', models.IntegerField(default=0)),
+                ('rows_written', models.IntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='installment',
+            name='penalty_accrued',
+            field=models.DecimalField(decimal_places=5, default=0, max_digits=20),
+        ),
+        migrations.AddField(
+            model_name='installment',
+            name='penalty_accrued_through',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
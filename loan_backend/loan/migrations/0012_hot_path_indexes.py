@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loan', '0011_penalty_watermarks'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='installment',
+            index=models.Index(condition=models.Q(('status__in', ['PAID', 'PAID_WITHOUT_PENALTY']), _negated=True), fields=['id', 'due_date'], name='installment_open_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='installmentdetail',
+            index=models.Index(fields=['installment', 'loan_repayment'], name='detail_installment_payment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='penalty',
+            index=models.Index(fields=['installment', 'date'], name='penalty_installment_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='penaltysegment',
+            index=models.Index(fields=['installment', 'end_date'], name='segment_installment_end_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='installment',
+            constraint=models.UniqueConstraint(fields=('loanshare', 'order'), name='installment_loanshare_order_uniq'),
+        ),
+    ]
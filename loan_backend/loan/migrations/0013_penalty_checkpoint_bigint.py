@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 08:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('loan', '0012_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='penaltycheckpoint',
+            name='first_loanshare',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='penaltycheckpoint',
+            name='last_installment',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='penaltycheckpoint',
+            name='last_loanshare',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,15 +1,100 @@
 from datetime import date, timedelta
 from decimal import Decimal
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator
 from django.db import models, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.forms.models import model_to_dict
-from lib.common import add_months
+from lib.common import add_months, chunked, to_date
 from lib.validators import validate_nonzero
-from loan_backend.config import Periodicity, LoanStatus, InstallmentStatus, CLOSED_LOAN_STATUS
-from loan_backend.constants import DEFAULT_PERIODICITY, DEFAULT_INTEREST, DEFAULT_PROCESSING_FEE, DEFAULT_DECIMAL_PLACES, DEFAULT_PENALTY_MULTIPLIER
-from loan import errors
+from loan_backend.config import Periodicity, LoanStatus, InstallmentStatus, PenaltyStorage, CLOSED_LOAN_STATUS, LOAN_LISTING_ORDER
+from loan_backend.constants import DEFAULT_PERIODICITY, DEFAULT_INTEREST, DEFAULT_PROCESSING_FEE, DEFAULT_DECIMAL_PLACES, LOAN_APPROVAL_CHUNK_SIZE, PENALTY_BATCH_SIZE
+from loan import errors, metrics
+from loan.accrual import accrue, daily_penalty
+from loan.cache import emi_preview_cache
+from loan.schedule import emi_schedule
+
+def penalty_segments_enabled():
+    return settings.PENALTY_STORAGE == PenaltyStorage.SEGMENT.name
+
+# sqlite hands back summed and annotated decimals with float precision
+def quantize_amount(amount):
+    return Decimal(amount).quantize(Decimal(1).scaleb(-DEFAULT_DECIMAL_PLACES))
+
+def amount_field():
+    return models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES)
+
+# sum of expression over the rows of queryset that belong to the outer loan, as a subquery so that
+# several of them can be annotated together without the joins multiplying each other's rows
+def loan_total(queryset, loan_lookup, expression):
+    totals = queryset.filter(**{loan_lookup: models.OuterRef('pk')}).order_by().values(loan_lookup).annotate(
+        total=models.Sum(expression, output_field=amount_field())
+    ).values('total')
+    return Coalesce(models.Subquery(totals, output_field=amount_field()), models.Value(Decimal(0)), output_field=amount_field())
+
+class LoanQuerySet(models.QuerySet):
+    def with_status_bucket(self):
+        return self.annotate(status_bucket=models.Case(
+            *[models.When(status__in=statuses, then=models.Value(bucket)) for bucket, statuses in enumerate(LOAN_LISTING_ORDER)],
+            output_field=models.IntegerField()
+        ))
+
+    # loanshares, their users and installments are fetched with one query each,
+    # so jsonify/emi_schedule on the loans do not hit the database
+    def with_schedule(self):
+        return self.prefetch_related(
+            models.Prefetch('loanshare_set', queryset=LoanShare.objects.select_related('user').order_by('id')),
+            models.Prefetch('loanshare_set__installment_set', queryset=Installment.objects.order_by('order')),
+        )
+
+    def listing(self, user, statuses=None, date_from=None, date_to=None):
+        loans = self.filter(loanshare__user=user)
+        if statuses:
+            loans = loans.filter(status__in=statuses)
+        if date_from:
+            loans = loans.filter(date_created__gte=date_from)
+        if date_to:
+            loans = loans.filter(date_created__lte=date_to)
+
+        return loans.with_status_bucket().order_by('status_bucket', 'id')
+
+    # EMI amount not paid yet over all installments of the loan
+    def with_outstanding_balance(self):
+        return self.annotate(outstanding_balance=loan_total(
+            Installment.objects, 'loanshare__loan', models.F('suggested_emi') - models.F('amount_paid')
+        ))
+
+    def with_total_paid(self):
+        return self.annotate(total_paid=loan_total(LoanRepayment.objects, 'loanshare__loan', 'amount'))
+
+    # penalty accrued and not paid yet, read from the accrual watermark of the installments which
+    # every penalty write keeps equal to the latest cumulative penalty
+    def with_penalty_due(self):
+        return self.annotate(penalty_due=loan_total(
+            Installment.objects, 'loanshare__loan', models.F('penalty_accrued') - models.F('penalty_paid')
+        ))
+
+    def with_balances(self):
+        return self.with_outstanding_balance().with_total_paid().with_penalty_due()
+
+    # what the jsonify payload of the loans depends on: the latest InstallmentDetail, i.e. the latest payment,
+    # and the cumulative penalty of the installments, read from the accrual watermark that every Penalty
+    # and PenaltySegment write keeps up to date, along with the status and approval date of the loan
+    def with_version(self):
+        details = InstallmentDetail.objects.filter(installment__loanshare__loan=models.OuterRef('pk')).order_by('-id')
+        return self.annotate(
+            last_installment_detail=models.Subquery(details.values('id')[:1]),
+            penalty_accrued=loan_total(Installment.objects, 'loanshare__loan', 'penalty_accrued'),
+        )
+
+    # keyset pagination on the listing order
+    def after(self, status_bucket, loan_id):
+        return self.filter(
+            models.Q(status_bucket__gt=status_bucket) | models.Q(status_bucket=status_bucket, id__gt=loan_id)
+        )
 
 class Loan(models.Model):
     amount = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES)
@@ -30,10 +115,20 @@ class Loan(models.Model):
     processing_fee = models.DecimalField(max_digits=6, decimal_places=DEFAULT_DECIMAL_PLACES, help_text='1 means 100%')
     date_created = models.DateField()
 
-    def jsonify(self):
-        data = model_to_dict(self, exclude=['interest', 'processing_fee'])
-        data['emis'] = self.emi_schedule()
+    objects = LoanQuerySet.as_manager()
+
+    JSON_EXCLUDE = ['interest', 'processing_fee']
+
+    # fields limits the loan fields in the output, emis are left out if include_emis is False
+    def jsonify(self, fields=None, include_emis=True):
+        data = model_to_dict(self, fields=fields, exclude=self.JSON_EXCLUDE)
+        if include_emis:
+            data['emis'] = self.emi_schedule()
         return data
+
+    @classmethod
+    def json_fields(cls):
+        return [f.name for f in cls._meta.fields if f.name not in cls.JSON_EXCLUDE] + ['emis']
     
     def is_active(self):
         if self.closing_date is None or self.status not in CLOSED_LOAN_STATUS or self.status != LoanStatus.PENDING.name:
@@ -57,24 +152,28 @@ class Loan(models.Model):
             loan.save()
 
             LoanShare.create_loanshare(loan, data, user)
+            metrics.loan_created()
 
         return loan
     
     def emi_schedule(self):
-        loanshares = self.loanshare_set.all()
+        loanshares = list(self.loanshare_set.all())
+        # sorted in python so that prefetched installments are used when available
+        installments = {ls.id: sorted(ls.installment_set.all(), key=lambda i: i.order) for ls in loanshares}
+        # loanshares without installments yet get the schedule they would get if approved today
+        previews = emi_preview_cache().schedules([ls for ls in loanshares if not installments[ls.id]], date.today())
         emis = []
         for ls in loanshares:
-            installments = Installment.objects.filter(loanshare=ls).order_by('order')
             user_emis = {
                 'user': ls.user.username,
                 'emis': []
             }
-            if installments:
-                for i in installments:
+            if installments[ls.id]:
+                for i in installments[ls.id]:
                     user_emis['emis'].append(i.jsonify())
 
             else:
-                user_emis['emis'] = ls.calculate_emis(date.today())
+                user_emis['emis'] = previews[ls.id]
             
             emis.append(user_emis)
 
@@ -115,22 +214,72 @@ class Loan(models.Model):
             self.full_clean()
             self.save()
 
-            for ls in self.loanshare_set.all():
+            loanshares = list(self.loanshare_set.all())
+            self.loanshare_set.update(status=LoanStatus.APPROVED.name)
+            installments = []
+            for ls in loanshares:
                 ls.status = LoanStatus.APPROVED.name
-                ls.full_clean()
-                ls.save()
-                ls.create_installments(approval_date)
+                installments.extend(ls.build_installments(self.approval_date))
+
+            Installment.objects.bulk_create(installments)
+            transaction.on_commit(lambda: emi_preview_cache().invalidate(loanshares, date.today()))
+            metrics.loans_approved()
+
+    # approves pending loans in chunks, one transaction per chunk. Loans locked by another transaction are
+    # skipped instead of waited for, and a loan that cannot be approved does not affect the others.
+    # returns {loan_id: error message or None when approved}
+    @classmethod
+    def approve_loans(cls, loan_ids, approval_date, chunk_size=LOAN_APPROVAL_CHUNK_SIZE):
+        results = {}
+        for chunk in chunked(dict.fromkeys(loan_ids), chunk_size):
+            with transaction.atomic():
+                loans = cls.objects.select_for_update(skip_locked=True, of=('self',)).filter(
+                    id__in=chunk,
+                    status=LoanStatus.PENDING.name
+                ).prefetch_related('loanshare_set')
+                approved = []
+                installments = []
+                for loan in loans:
+                    try:
+                        loan.status = LoanStatus.APPROVED.name
+                        loan.approval_date = approval_date
+                        loan.clean_fields()
+                        loan_installments = []
+                        for ls in loan.loanshare_set.all():
+                            loan_installments.extend(ls.build_installments(loan.approval_date))
+                    except (ValidationError, errors.InvalidPeriodicity) as e:
+                        results[loan.id] = str(e)
+                        continue
+
+                    approved.append(loan)
+                    installments.extend(loan_installments)
+                    results[loan.id] = None
+
+                cls.objects.bulk_update(approved, ['status', 'approval_date'])
+                LoanShare.objects.filter(loan__in=approved).update(status=LoanStatus.APPROVED.name)
+                Installment.objects.bulk_create(installments, batch_size=1000)
+                approved_loanshares = [ls for loan in approved for ls in loan.loanshare_set.all()]
+                transaction.on_commit(lambda loanshares=approved_loanshares: emi_preview_cache().invalidate(loanshares, date.today()))
+                metrics.loans_approved(len(approved))
+
+            skipped = [loan_id for loan_id in chunk if loan_id not in results]
+            statuses = dict(cls.objects.filter(id__in=skipped).values_list('id', 'status'))
+            for loan_id in skipped:
+                if loan_id not in statuses:
+                    results[loan_id] = "loan does not exist"
+                elif statuses[loan_id] != LoanStatus.PENDING.name:
+                    results[loan_id] = f"loan is {LoanStatus[statuses[loan_id]].value}, only pending loans can be approved"
+                else:
+                    results[loan_id] = "loan is being updated by another request"
+
+        return results
 
     @property
     def amount_pending(self):
-        loanshares = self.loanshare_set.all()
-        amount_pending = {}
-        for ls in loanshares:
-            installments = Installment.objects.filter(loanshare=ls)
-            user_amount_pending = sum([i.amount_remaining for i in installments])
-            amount_pending[ls.user.username] = user_amount_pending
-
-        return amount_pending
+        pending = self.loanshare_set.order_by().values_list('user__username').annotate(
+            pending=models.Sum(models.F('installment__suggested_emi') - models.F('installment__amount_paid'))
+        )
+        return {username: quantize_amount(amount or 0) for username, amount in pending}
     
     def update_loan_status(self):
         loanshares = LoanShare.objects.filter(loan=self)
@@ -164,37 +313,24 @@ class LoanShare(models.Model):
         return
     
     def calculate_emis(self, start_date):
-        total_amount = round(
-            self.share +
-            (self.share * self.loan.tenure * (self.loan.interest / self.loan.calculate_periodicity_factor())) +
-            (self.share * self.loan.processing_fee),
-            DEFAULT_DECIMAL_PLACES
-        )
-        int_total_amount = total_amount * (10 ** DEFAULT_DECIMAL_PLACES)
-        int_emi_amount = int_total_amount // self.loan.tenure
-        rem_amount = int_total_amount - (int_emi_amount * self.loan.tenure)
-        emis = []
-        for t in range(self.loan.tenure):
-            emi = {
-                'due_date': self.loan.effective_due_date(start_date, t),
-                'status': 'NOT_STARTED',
-                'paid_amount': 0
-            }
-            if rem_amount > 0:
-                suggested_emi = int_emi_amount + 1
-                rem_amount -= 1
-            else:
-                suggested_emi = int_emi_amount
-
-            emi['suggested_emi'] = suggested_emi / (10 ** DEFAULT_DECIMAL_PLACES)
-            emis.append(emi)
-
-        return emis
+        return emi_schedule(self.share, self.loan, start_date)
     
+    # unsaved installments of the emi schedule starting at start_date, validated in memory
+    def build_installments(self, start_date):
+        installments = [
+            Installment(
+                order=i + 1,
+                loanshare=self,
+                due_date=emi['due_date'],
+                suggested_emi=emi['suggested_emi']
+            )
+            for i, emi in enumerate(self.calculate_emis(start_date))
+        ]
+        Installment.validate_schedule(installments)
+        return installments
+
     def create_installments(self, start_date):
-        emis_data = self.calculate_emis(start_date)
-        for i, emi in enumerate(emis_data):
-            Installment.create_installment(self, emi, i + 1)
+        Installment.objects.bulk_create(self.build_installments(start_date))
 
     def add_payment(self, amount_paid, payment_id, payment_date):
         if not self.loan.is_active:
@@ -204,51 +340,101 @@ class LoanShare(models.Model):
         with transaction.atomic():
             loan_repayment = LoanRepayment.create_loan_repayment(self, payment_id, payment_date, amount_paid)
 
-            # fulfill remaining installments and penalty
-            # order of fullfilment
-            #   1. fulfill unpaid/partially_paid installments in chronological order
-            #   2. fulfill penalties in chronological order
-
-            # fulfill remaining installments in chronological order
-            installments = Installment.objects.filter(
-                loanshare=self
-            ).exclude(
-                status__in=[InstallmentStatus.PAID.name, InstallmentStatus.PAID_WITHOUT_PENALTY.name]
-            ).order_by('order')
-
-            for i in installments:
-                if amount_paid > 0:
-                    amount_paid = i.fulfill_loan_amount(amount_paid, loan_repayment)
-
-            if amount_paid > 0:
-                # fulfill penalties in chronological order
-                installments = Installment.objects.filter(
-                    loanshare=self,
-                    status=InstallmentStatus.PAID_WITHOUT_PENALTY.name,
-                ).order_by('order')
-                for i  in installments:
-                    if amount_paid > 0:
-                        amount_paid = i.fulfill_penalty(amount_paid, loan_repayment)
-
-            if amount_paid > 0:
-                #if any amount still left that means we got extra money
-                #so we will create InstallmentDetail obj with extra amount added
-                last_ins = Installment.objects.select_for_update(of=('self',)).filter(
-                    loanshare=self,
-                ).order_by('order').last()
-                InstallmentDetail.get_or_create_installment_details(
-                    last_ins,
-                    loan_repayment,
-                    additional_penalty=amount_paid
-                )
-
+            principal, penalty = self.allocate_payment(amount_paid, loan_repayment)
             self.update_loanshare_status()
+            metrics.payment_applied(principal, penalty)
 
         return
 
+    # fulfill remaining installments and penalty
+    # order of fullfilment
+    #   1. fulfill unpaid/partially_paid installments in chronological order
+    #   2. fulfill penalties in chronological order
+    #   3. anything left is added as extra penalty paid on the last installment
+    # open installments are locked with one query and the whole allocation is computed in memory,
+    # InstallmentDetail rows and installment balances are then written in bulk
+    # returns the amounts allocated to (principal, penalty)
+    def allocate_payment(self, amount_paid, loan_repayment):
+        payment_date = loan_repayment.payment_date
+        installments = list(Installment.objects.select_for_update(of=('self',)).filter(
+            loanshare=self
+        ).exclude(
+            status=InstallmentStatus.PAID.name
+        ).order_by('order'))
+        details = {}
+
+        def detail(installment):
+            if installment.pk not in details:
+                details[installment.pk] = InstallmentDetail(installment=installment, loan_repayment=loan_repayment)
+            return details[installment.pk]
+
+        # 1. installment amounts
+        paid_installments = []
+        for i in installments:
+            if amount_paid <= 0:
+                break
+            if i.installment_paid():
+                continue
+
+            amount_ddt = min(i.amount_remaining, amount_paid) if i.amount_remaining > 0 else 0
+            amount_paid -= amount_ddt
+            detail(i).amount = amount_ddt
+            i.amount_paid += amount_ddt
+            paid_installments.append(i)
+
+        if payment_date is not None:
+            Penalty.modify_penalties_after(paid_installments, payment_date)
+
+        penalties = Installment.latest_penalties([i.pk for i in installments if i.amount_remaining == 0])
+        for i in paid_installments:
+            i.status = i.next_status(penalties.get(i.pk, 0))
+
+        # 2. penalties
+        for i in installments:
+            if amount_paid <= 0:
+                break
+            if i.status != InstallmentStatus.PAID_WITHOUT_PENALTY.name:
+                continue
+
+            penalty_remaining = penalties.get(i.pk, 0) - i.penalty_paid
+            penalty_ddt = min(penalty_remaining, amount_paid) if penalty_remaining > 0 else 0
+            amount_paid -= penalty_ddt
+            detail(i).penalty = penalty_ddt
+            i.penalty_paid += penalty_ddt
+            i.status = i.next_status(penalties.get(i.pk, 0))
+
+        # 3. extra amount
+        if amount_paid > 0:
+            last_ins = Installment.objects.select_for_update(of=('self',)).filter(
+                loanshare=self,
+            ).order_by('order').last()
+            last_ins = next((i for i in installments if i.pk == last_ins.pk), last_ins)
+            if last_ins.pk not in penalties:
+                penalties.update(Installment.latest_penalties([last_ins.pk]))
+            if last_ins not in installments:
+                installments.append(last_ins)
+
+            last_detail = detail(last_ins)
+            last_detail.penalty = last_detail.penalty + amount_paid
+            last_ins.penalty_paid += amount_paid
+            last_ins.status = last_ins.next_status(penalties[last_ins.pk])
+
+        for d in details.values():
+            d.full_clean(exclude=['installment', 'loan_repayment'], validate_unique=False)
+
+        InstallmentDetail.objects.bulk_create(details.values())
+        Installment.objects.bulk_update(
+            [i for i in installments if i.pk in details],
+            ['status', 'amount_paid', 'penalty_paid']
+        )
+        return sum(d.amount for d in details.values()), sum(d.penalty for d in details.values())
+
     def update_loanshare_status(self):
-        installments = Installment.objects.filter(loanshare=self)
-        if len(installments) == len(installments.filter(status=InstallmentStatus.PAID.name)):
+        counts = Installment.objects.filter(loanshare=self).aggregate(
+            total=models.Count('id'),
+            paid=models.Count('id', filter=models.Q(status=InstallmentStatus.PAID.name))
+        )
+        if counts['total'] == counts['paid']:
             self.status = LoanStatus.COMPLETED.name
             self.full_clean()
             self.save()
@@ -257,14 +443,8 @@ class LoanShare(models.Model):
         return
     
     def total_paid(self):
-        loan_repayments = LoanRepayment.objects.filter(
-            loanshare=self
-        )
-        paid = 0
-        for lr in loan_repayments:
-            paid += lr.amount
-
-        return paid
+        paid = LoanRepayment.objects.filter(loanshare=self).aggregate(paid=models.Sum('amount'))['paid']
+        return quantize_amount(paid or 0)
 
     def __str__(self):
         return f"{str(self.loan.id)} : {str(self.id)} : {str(self.user.username)}"
@@ -279,16 +459,31 @@ class Installment(models.Model):
         choices=[(x.name, x.value) for x in InstallmentStatus],
         default = InstallmentStatus.UNPAID.name
     )
+    # running totals of InstallmentDetail amount and penalty, maintained by LoanShare.allocate_payment
+    amount_paid = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES, default=0)
+    penalty_paid = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES, default=0)
+    # penalty accrual watermark, penalty has been accrued up to penalty_accrued_through and penalty_accrued is
+    # the cumulative penalty on that date, kept up to date by every method writing penalties
+    penalty_accrued_through = models.DateField(null=True, blank=True)
+    penalty_accrued = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES, default=0)
+
+    class Meta:
+        constraints = [
+            # installments of a loanshare in schedule order
+            models.UniqueConstraint(fields=['loanshare', 'order'], name='installment_loanshare_order_uniq'),
+        ]
+        indexes = [
+            # open installments walked in id order by the penalty cron
+            models.Index(
+                fields=['id', 'due_date'],
+                name='installment_open_idx',
+                condition=~models.Q(status__in=[InstallmentStatus.PAID.name, InstallmentStatus.PAID_WITHOUT_PENALTY.name])
+            ),
+        ]
 
     @property
     def amount_remaining(self):
-        ins_details = InstallmentDetail.objects.filter(
-            installment=self
-        )
-        amount_paid = 0
-        for ins in ins_details:
-            amount_paid += ins.amount
-        return self.suggested_emi - amount_paid
+        return self.suggested_emi - self.amount_paid
     
     def installment_paid(self):
         if self.status in [InstallmentStatus.PAID.name, InstallmentStatus.PAID_WITHOUT_PENALTY.name]:
@@ -298,113 +493,146 @@ class Installment(models.Model):
 
     @property
     def penalty(self):
-        penalty = Penalty.objects.filter(installment=self).order_by('date').last()
-        return penalty.amount if penalty else 0
+        return self.penalty_on(None)
+
+    # latest penalty of many installments with one query, {installment id: penalty}
+    @classmethod
+    def latest_penalties(cls, installment_ids):
+        if not installment_ids:
+            return {}
+
+        if penalty_segments_enabled():
+            latest = PenaltySegment.objects.filter(installment=models.OuterRef('pk')).order_by('-end_date')
+        else:
+            latest = Penalty.objects.filter(installment=models.OuterRef('pk')).order_by('-date')
+
+        penalties = cls.objects.filter(pk__in=installment_ids).annotate(
+            latest_penalty=models.Subquery(latest.values('amount')[:1])
+        ).values_list('pk', 'latest_penalty')
+        return {pk: quantize_amount(penalty) if penalty is not None else 0 for pk, penalty in penalties}
+
+    # cumulative penalty as of on_date, latest penalty if on_date is None
+    def penalty_on(self, on_date):
+        if penalty_segments_enabled():
+            return PenaltySegment.penalty_on(self, on_date)
+
+        return Penalty.penalty_on(self, on_date)
     
     @property
     def penalty_remaining(self):
-        ins_details = InstallmentDetail.objects.filter(
-            installment=self
-        )
-        penalty_paid = 0
-        for ins in ins_details:
-            penalty_paid += ins.penalty
-        return self.penalty - penalty_paid
+        return self.penalty - self.penalty_paid
 
     def jsonify(self):
-        data = model_to_dict(self, exclude=['id', 'order', 'loanshare'])
-        data['paid_amount'] = self.suggested_emi - self.amount_remaining
+        data = model_to_dict(self, exclude=[
+            'id', 'order', 'loanshare', 'amount_paid', 'penalty_paid', 'penalty_accrued_through', 'penalty_accrued'
+        ])
+        data['paid_amount'] = self.amount_paid
         return data
 
+    # recomputes amount_paid and penalty_paid from the InstallmentDetail ledger
+    # returns (installment_id, (amount_paid, penalty_paid), (ledger_amount, ledger_penalty)) for every installment
+    # that was out of sync, those installments are corrected unless verify_only is set
     @classmethod
-    def create_installment(cls, loanshare, emi_data, order):
-        installment = cls(
-            order=order,
-            loanshare=loanshare,
-            due_date=emi_data['due_date'],
-            suggested_emi=emi_data['suggested_emi']
-        )
-        installment.full_clean()
-        installment.save()
-        return
-
-    # To mark payment against installment suggested emi
-    def fulfill_loan_amount(self, amount_paid, loan_repayment):
-        amount_ddt = 0
-        if self.installment_paid() or amount_paid <= 0:
-            return amount_paid
+    def rebuild_balances(cls, verify_only=False, batch_size=1000):
+        totals = {
+            row['installment']: (row['amount'], row['penalty'])
+            for row in InstallmentDetail.objects.values('installment').annotate(
+                amount=models.Sum('amount'),
+                penalty=models.Sum('penalty')
+            )
+        }
+        mismatches = []
+        stale = []
+        zero = Decimal(0)
+        for installment in cls.objects.only('id', 'amount_paid', 'penalty_paid').iterator():
+            amount_paid, penalty_paid = totals.get(installment.id, (zero, zero))
+            if installment.amount_paid != amount_paid or installment.penalty_paid != penalty_paid:
+                mismatches.append((
+                    installment.id,
+                    (installment.amount_paid, installment.penalty_paid),
+                    (amount_paid, penalty_paid)
+                ))
+                installment.amount_paid = amount_paid
+                installment.penalty_paid = penalty_paid
+                stale.append(installment)
+
+        if not verify_only:
+            cls.objects.bulk_update(stale, ['amount_paid', 'penalty_paid'], batch_size=batch_size)
+
+        return mismatches
+
+    # field validation without database lookups plus schedule level checks,
+    # used instead of full_clean on every installment before bulk_create
+    @classmethod
+    def validate_schedule(cls, installments):
+        for installment in installments:
+            installment.clean_fields(exclude=['loanshare'])
+
+        if [i.order for i in installments] != list(range(1, len(installments) + 1)):
+            raise ValidationError("installment orders should be consecutive starting from 1")
+
+        for previous, installment in zip(installments, installments[1:]):
+            if installment.due_date <= previous.due_date:
+                raise ValidationError("installment due dates should be increasing")
+
+    # status for the current balances, penalty is looked up unless given
+    def next_status(self, penalty=None):
+        amount_remaining = self.amount_remaining
+        if amount_remaining >= self.suggested_emi:
+            return InstallmentStatus.UNPAID.name
+        elif amount_remaining > 0 and amount_remaining < self.suggested_emi:
+            return InstallmentStatus.PARTIALLY_PAID.name
+        elif amount_remaining == 0:
+            penalty_remaining = (self.penalty if penalty is None else penalty) - self.penalty_paid
+            if penalty_remaining > 0:
+                return InstallmentStatus.PAID_WITHOUT_PENALTY.name
+            else:
+                return InstallmentStatus.PAID.name
 
-        locked_ins = Installment.objects.select_for_update(of=('self',)).get(pk=self.pk)
-        amount_remaining = locked_ins.amount_remaining
-        if amount_remaining > 0:
-            amount_ddt = min(amount_remaining, amount_paid)
-            amount_paid -= amount_ddt
+        return self.status
 
-        InstallmentDetail.get_or_create_installment_details(
-            locked_ins,
-            loan_repayment,
-            amount_ddt=amount_ddt
-        )
-        return amount_paid
-    
-    # To mark payment against installment penalty
-    def fulfill_penalty(self, amount_paid, loan_repayment):
-        penalty_ddt = 0
-        if self.status != InstallmentStatus.PAID_WITHOUT_PENALTY.name or amount_paid <= 0:
-            return amount_paid
-
-        locked_ins = Installment.objects.select_for_update(of=('self',)).get(pk=self.pk)
-        penalty_remaining = locked_ins.penalty_remaining
-        if penalty_remaining > 0:
-            penalty_ddt = min(penalty_remaining, amount_paid)
-            amount_paid -= penalty_ddt
+    # (date, cumulative penalty) accrual resumes from
+    def accrual_watermark(self):
+        if self.penalty_accrued_through is None:
+            return self.due_date, Decimal(0)
 
-        InstallmentDetail.get_or_create_installment_details(
-            locked_ins,
-            loan_repayment,
-            penalty_ddt=penalty_ddt
-        )
-        return amount_paid
-    
-    def update_installment_status(self, payment_date):
-        if self.amount_remaining >= self.suggested_emi:
-            self.status=InstallmentStatus.UNPAID.name
-        elif self.amount_remaining > 0 and self.amount_remaining < self.suggested_emi:
-            self.status=InstallmentStatus.PARTIALLY_PAID.name
-        elif self.amount_remaining == 0:
-            if self.penalty_remaining > 0:
-                self.status=InstallmentStatus.PAID_WITHOUT_PENALTY.name
-            else:
-                self.status=InstallmentStatus.PAID.name
+        return self.penalty_accrued_through, self.penalty_accrued
 
-        self.full_clean()
-        self.save()
+    # moves the watermark, accrued_through is left as it is when None
+    def record_accrual(self, accrued, accrued_through=None):
+        values = {'penalty_accrued': accrued}
+        if accrued_through is not None:
+            values['penalty_accrued_through'] = accrued_through
 
-        if payment_date is not None:
-            Penalty.modify_penalty_after(self, payment_date)
+        Installment.objects.filter(pk=self.pk).update(**values)
+        for field, value in values.items():
+            setattr(self, field, value)
 
-        return
+    # penalty that accrues from the watermark through final_date at the current balance, computed without
+    # any query, None when nothing accrues
+    def accrued_penalty(self, final_date, penalty_multiplier=None):
+        last_penalty_date, last_penalty_amount = self.accrual_watermark()
+        return accrue(self.amount_remaining, last_penalty_date, last_penalty_amount, final_date, penalty_multiplier)
 
     # cronjob will call this method once everyday for every unpaid installment to create penalty if any
     def update_penalty(self, final_date=None, penalty_multiplier=None):
         if not final_date:
             final_date = date.today()
 
-        if self.due_date >= final_date or self.installment_paid():
+        last_penalty_date, last_penalty_amount = self.accrual_watermark()
+        if last_penalty_date >= final_date or self.installment_paid():
             return
 
-        last_penalty = Penalty.objects.filter(installment=self).order_by('date').last()
-        if last_penalty:
-            last_penalty_date = last_penalty.date
-            last_penalty_amount = last_penalty.amount
-        else:
-            last_penalty_date = self.due_date
-            last_penalty_amount = 0
+        if penalty_segments_enabled():
+            PenaltySegment.accrue(self, final_date, penalty_multiplier)
+            return
 
-        while last_penalty_date < final_date:
-            last_penalty_date += timedelta(days=1)
-            last_penalty_amount = Penalty.create_penalty(self, last_penalty_date, last_penalty_amount, penalty_multiplier)
+        accrual = self.accrued_penalty(final_date, penalty_multiplier)
+        if accrual:
+            Penalty.objects.bulk_create(Penalty.materialize(self.pk, accrual))
+            last_penalty_amount = accrual.amount
 
+        self.record_accrual(last_penalty_amount, final_date)
         return
     
 class LoanRepayment(models.Model):
@@ -433,85 +661,334 @@ class InstallmentDetail(models.Model):
     penalty = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES, default=0)
     date_created = models.DateTimeField(auto_now_add=True)
 
-    @classmethod
-    def get_or_create_installment_details(
-        cls,
-        installment,
-        loan_repayment,
-        amount_ddt=None,
-        penalty_ddt=None,
-        additional_penalty=None
-    ):
-        ins_detail, created = cls.objects.get_or_create(
-            installment=installment,
-            loan_repayment=loan_repayment,
-        )
-        if amount_ddt is not None:
-            ins_detail.amount = amount_ddt
-        if penalty_ddt is not None:
-            ins_detail.penalty = penalty_ddt
-        if additional_penalty is not None:
-            ins_detail.penalty = ins_detail.penalty + additional_penalty if ins_detail.penalty else additional_penalty
-
-        ins_detail.full_clean()
-        ins_detail.save()
-        installment.update_installment_status(loan_repayment.payment_date)
-        return
+    class Meta:
+        indexes = [
+            models.Index(fields=['installment', 'loan_repayment'], name='detail_installment_payment_idx'),
+        ]
 
 class Penalty(models.Model):
     installment = models.ForeignKey(Installment, on_delete=models.CASCADE)
     date = models.DateField()
     amount = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES)
 
+    class Meta:
+        indexes = [
+            # latest penalty and penalties after a date of an installment
+            models.Index(fields=['installment', 'date'], name='penalty_installment_date_idx'),
+        ]
+
     @classmethod
-    def create_penalty(cls, installment, penalty_date, last_penalty_amount, penalty_multiplier):
-        balance_remaining = installment.amount_remaining
-        penalty_amount = cls.compute_penalty(balance_remaining, penalty_multiplier)
-        if balance_remaining > 0 and penalty_amount > 0:
-            penalty = cls(
-                installment=installment,
-                date=penalty_date,
-                amount=last_penalty_amount + penalty_amount
-            )
-            penalty.full_clean()
-            penalty.save()
-            return penalty.amount
-        
-        return last_penalty_amount
+    def penalty_on(cls, installment, on_date):
+        penalties = cls.objects.filter(installment=installment)
+        if on_date is not None:
+            penalties = penalties.filter(date__lte=on_date)
+
+        penalty = penalties.order_by('date').last()
+        return penalty.amount if penalty else 0
     
     # new penalty amount added everyday as a percentage of amount remaining in an installment
     @classmethod
     def compute_penalty(cls, remaining_amount, multiplier):
-        if not multiplier:
-            multiplier = DEFAULT_PENALTY_MULTIPLIER
+        return daily_penalty(remaining_amount, multiplier)
 
-        multiplier = Decimal(str(multiplier))
-        return Decimal(str(round(remaining_amount * multiplier, 5)))
+    # one unsaved cumulative penalty row per day of a PenaltyAccrual
+    @classmethod
+    def materialize(cls, installment_id, accrual):
+        return [
+            cls(installment_id=installment_id, date=penalty_date, amount=amount)
+            for penalty_date, amount in accrual.daily_amounts()
+        ]
     
-    # to delete penalty objects created after payment date, for payments which were marked after their actual payment date
-    # and caused additional penalty
+    # to correct penalty objects created after payment date, for payments which were marked after their actual payment date
+    # and caused additional penalty. penalties after the payment date are recomputed from the current balance of every
+    # installment. All later rows are read with one query, and the rows whose amount changed, the rows of installments
+    # that accrue no penalty anymore and the accrual watermarks are written with one query each, whatever the number
+    # of installments. returns the number of penalty rows touched
+    @classmethod
+    def modify_penalties_after(cls, installments, last_penalty_date):
+        if not installments:
+            return 0
+
+        if penalty_segments_enabled():
+            return PenaltySegment.modify_penalties_after(installments, last_penalty_date)
+
+        last_penalty_date = to_date(last_penalty_date)
+        rows = {}
+        for pk, installment_id, penalty_date, amount in cls.objects.filter(
+            installment__in=installments, date__gte=last_penalty_date
+        ).order_by('installment_id', 'date').values_list('id', 'installment_id', 'date', 'amount'):
+            rows.setdefault(installment_id, []).append((pk, penalty_date, amount))
+
+        corrected = []
+        deleted = []
+        accrued = []
+        for installment in installments:
+            if installment.pk not in rows:
+                continue
+
+            corrections, deletions, last_penalty_amount = cls.corrected_penalties(installment, rows[installment.pk], last_penalty_date)
+            corrected.extend(corrections)
+            deleted.extend(deletions)
+            if corrections or deletions:
+                installment.penalty_accrued = last_penalty_amount
+                accrued.append(installment)
+
+        if corrected:
+            cls.objects.bulk_update(corrected, ['amount'], batch_size=PENALTY_BATCH_SIZE)
+        if deleted:
+            cls.objects.filter(pk__in=deleted).delete()
+        if accrued:
+            Installment.objects.bulk_update(accrued, ['penalty_accrued'], batch_size=PENALTY_BATCH_SIZE)
+        return len(corrected) + len(deleted)
+
     @classmethod
     def modify_penalty_after(cls, installment, last_penalty_date):
-        successive_penalties = cls.objects.filter(installment=installment, date__gt=last_penalty_date).order_by('date')
-        if not successive_penalties:
+        return cls.modify_penalties_after([installment], last_penalty_date)
+
+    # rows are (id, date, amount) of the installment from last_penalty_date on, ordered by date.
+    # returns the unsaved corrected rows, the ids of the rows to delete and the corrected cumulative penalty
+    @classmethod
+    def corrected_penalties(cls, installment, rows, last_penalty_date):
+        last_penalty_amount = 0
+        if rows and rows[0][1] == last_penalty_date:
+            last_penalty_amount = rows[0][2]
+            rows = rows[1:]
+
+        if not rows:
+            return [], [], last_penalty_amount
+
+        accrual = accrue(installment.amount_remaining, last_penalty_date, last_penalty_amount, rows[-1][1], None)
+        if not accrual:
+            return [], [pk for pk, _, _ in rows], last_penalty_amount
+
+        corrected = []
+        for n, (pk, _, amount) in enumerate(rows, start=1):
+            last_penalty_amount = accrual.last_amount + n * accrual.daily_penalty
+            if amount != last_penalty_amount:
+                corrected.append(cls(id=pk, installment_id=installment.pk, amount=last_penalty_amount))
+
+        return corrected, [], last_penalty_amount
+
+# Penalty accrued by the same amount every day from start_date to end_date (both inclusive),
+# amount is the cumulative penalty of the installment on end_date.
+# Used instead of daily Penalty rows when settings.PENALTY_STORAGE is SEGMENT.
+class PenaltySegment(models.Model):
+    installment = models.ForeignKey(Installment, on_delete=models.CASCADE)
+    start_date = models.DateField()
+    end_date = models.DateField()
+    daily_penalty = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES)
+    amount = models.DecimalField(max_digits=20, decimal_places=DEFAULT_DECIMAL_PLACES)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['installment', 'end_date'], name='segment_installment_end_idx'),
+        ]
+
+    # valid for any date after the end of the previous segment
+    def amount_on(self, on_date):
+        on_date = max(to_date(on_date), self.start_date - timedelta(days=1))
+        if on_date >= self.end_date:
+            return self.amount
+
+        return self.amount - (self.end_date - on_date).days * self.daily_penalty
+
+    @classmethod
+    def penalty_on(cls, installment, on_date):
+        segments = cls.objects.filter(installment=installment)
+        if on_date is None:
+            segment = segments.order_by('end_date').last()
+            return segment.amount if segment else 0
+
+        segment = segments.filter(start_date__lte=on_date).order_by('start_date').last()
+        return segment.amount_on(on_date) if segment else 0
+
+    # materializes a PenaltyAccrual, last_segment is extended when penalty keeps accruing at the same daily
+    # amount, otherwise a new segment is started. returns unsaved segment and whether it is a new one
+    @classmethod
+    def accrued_segment(cls, installment_id, last_segment, accrual):
+        if (
+            last_segment and last_segment.end_date == accrual.last_date
+            and last_segment.daily_penalty == accrual.daily_penalty
+        ):
+            last_segment.end_date = accrual.final_date
+            last_segment.amount = accrual.amount
+            return last_segment, False
+
+        segment = cls(
+            installment_id=installment_id,
+            start_date=accrual.last_date + timedelta(days=1),
+            end_date=accrual.final_date,
+            daily_penalty=accrual.daily_penalty,
+            amount=accrual.amount
+        )
+        return segment, True
+
+    @classmethod
+    def accrue(cls, installment, final_date, penalty_multiplier):
+        last_penalty_date, last_penalty_amount = installment.accrual_watermark()
+        if last_penalty_date >= final_date:
             return
 
-        balance_remaining = installment.amount_remaining
-        penalty_amount = cls.compute_penalty(balance_remaining, None)
-        if balance_remaining <= 0 or penalty_amount <= 0:
-            successive_penalties.delete()
+        accrual = installment.accrued_penalty(final_date, penalty_multiplier)
+        if not accrual:
+            installment.record_accrual(last_penalty_amount, final_date)
             return
 
-        try:
-            last_penalty = cls.objects.get(installment=installment, date=last_penalty_date)
-            last_penalty_amount = last_penalty.amount
-        except Penalty.DoesNotExist:
-            last_penalty_amount = 0
+        last_segment = cls.objects.filter(installment=installment).order_by('end_date').last()
+        segment, _ = cls.accrued_segment(installment.pk, last_segment, accrual)
+        segment.full_clean()
+        segment.save()
+        installment.record_accrual(segment.amount, final_date)
+        return
 
-        for penalty in successive_penalties:
-            last_penalty_amount += penalty_amount
-            penalty.amount = last_penalty_amount
-            penalty.full_clean()
-            penalty.save()
+    # segment counterpart of Penalty.modify_penalties_after, penalty after last_penalty_date is recomputed
+    # from the current balance by truncating the segment covering that date and replacing the later ones.
+    # segments are read with one query and written with one bulk_update, delete and bulk_create.
+    # returns the number of segments touched
+    @classmethod
+    def modify_penalties_after(cls, installments, last_penalty_date):
+        last_penalty_date = to_date(last_penalty_date)
+        segments = {}
+        for segment in cls.objects.filter(
+            installment__in=installments, end_date__gt=last_penalty_date
+        ).order_by('installment_id', 'start_date'):
+            segments.setdefault(segment.installment_id, []).append(segment)
+
+        updated = []
+        deleted = []
+        created = []
+        accrued = []
+        touched = 0
+        for installment in installments:
+            if installment.pk not in segments:
+                continue
+
+            correction = cls.corrected_segments(installment, segments[installment.pk], last_penalty_date)
+            if correction is None:
+                continue
+
+            segment_updates, segment_deletions, segment, last_penalty_amount = correction
+            updated.extend(segment_updates)
+            deleted.extend(segment_deletions)
+            if segment is not None and segment.pk is None:
+                created.append(segment)
+            touched += len(segments[installment.pk]) + (1 if segment is not None and segment.pk is None else 0)
+            installment.penalty_accrued = last_penalty_amount
+            accrued.append(installment)
+
+        for segment in updated + created:
+            segment.full_clean(exclude=['installment'], validate_unique=False)
+        if updated:
+            cls.objects.bulk_update(updated, ['end_date', 'amount'], batch_size=PENALTY_BATCH_SIZE)
+        if deleted:
+            cls.objects.filter(pk__in=deleted).delete()
+        if created:
+            cls.objects.bulk_create(created, batch_size=PENALTY_BATCH_SIZE)
+        if accrued:
+            Installment.objects.bulk_update(accrued, ['penalty_accrued'], batch_size=PENALTY_BATCH_SIZE)
+        return touched
+
+    @classmethod
+    def modify_penalty_after(cls, installment, last_penalty_date):
+        return cls.modify_penalties_after([installment], last_penalty_date)
+
+    # segments are the segments of the installment ending after last_penalty_date, ordered by start date.
+    # returns None when they already accrue at the current balance, otherwise the segments to update, the ids of
+    # the segments to delete, the segment accruing from last_penalty_date (unsaved when new, None when no penalty
+    # accrues anymore) and the corrected cumulative penalty
+    @classmethod
+    def corrected_segments(cls, installment, segments, last_penalty_date):
+        first_segment = segments[0]
+        final_date = segments[-1].end_date
+        last_penalty_amount = first_segment.amount_on(last_penalty_date)
+        accrual = accrue(installment.amount_remaining, last_penalty_date, last_penalty_amount, final_date, None)
+        # a single segment already accruing at the current balance since last_penalty_date
+        if (
+            accrual and len(segments) == 1 and first_segment.start_date <= last_penalty_date + timedelta(days=1)
+            and first_segment.daily_penalty == accrual.daily_penalty
+        ):
+            return None
+
+        updated = []
+        if first_segment.start_date <= last_penalty_date:
+            first_segment.end_date = last_penalty_date
+            first_segment.amount = last_penalty_amount
+            updated.append(first_segment)
+            segments = segments[1:]
+        else:
+            first_segment = None
+
+        deleted = [s.pk for s in segments]
+        if not accrual:
+            return updated, deleted, None, last_penalty_amount
+
+        segment, _ = cls.accrued_segment(installment.pk, first_segment, accrual)
+        return updated, deleted, segment, segment.amount
+
+# Progress of a penalty cron run over all installments or a loanshare id range. The last installment of
+# every chunk is recorded in the transaction that writes the chunk, so a run that failed part way resumes
+# after it instead of starting over.
+class PenaltyCheckpoint(models.Model):
+    final_date = models.DateField()
+    first_loanshare = models.BigIntegerField(null=True, blank=True)
+    last_loanshare = models.BigIntegerField(null=True, blank=True)
+    last_installment = models.BigIntegerField(default=0)
+    installments_scanned = models.IntegerField(default=0)
+    rows_written = models.IntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    # unfinished checkpoint of an earlier run with the same final date and range, or a new one
+    @classmethod
+    def resume(cls, final_date, loanshare_range=None):
+        first_loanshare, last_loanshare = loanshare_range or (None, None)
+        checkpoint = cls.objects.filter(
+            final_date=final_date,
+            first_loanshare=first_loanshare,
+            last_loanshare=last_loanshare,
+            completed_at__isnull=True
+        ).order_by('id').last()
+        if checkpoint:
+            return checkpoint
+
+        return cls.objects.create(
+            final_date=final_date,
+            first_loanshare=first_loanshare,
+            last_loanshare=last_loanshare
+        )
+
+    # (first, last) loanshare ranges of unfinished shard checkpoints with the final date, within loanshare_range
+    # when given. A retried parallel run splits the remaining candidates differently, so it runs these ranges
+    # again as they are to resume them. Ranges overlapping an earlier one are left out.
+    @classmethod
+    def unfinished_ranges(cls, final_date, loanshare_range=None):
+        checkpoints = cls.objects.filter(
+            final_date=final_date,
+            first_loanshare__isnull=False,
+            completed_at__isnull=True
+        )
+        if loanshare_range is not None:
+            first, last = loanshare_range
+            checkpoints = checkpoints.filter(first_loanshare__gte=first, last_loanshare__lte=last)
+
+        ranges = []
+        for first, last in checkpoints.order_by('first_loanshare', 'last_loanshare').values_list(
+            'first_loanshare', 'last_loanshare'
+        ).distinct():
+            if not ranges or first > ranges[-1][1]:
+                ranges.append((first, last))
+        return ranges
+
+    def advance(self, last_installment, scanned, rows_written):
+        PenaltyCheckpoint.objects.filter(pk=self.pk).update(
+            last_installment=last_installment,
+            installments_scanned=models.F('installments_scanned') + scanned,
+            rows_written=models.F('rows_written') + rows_written,
+            updated_at=timezone.now()
+        )
+        self.last_installment = last_installment
 
-        return
\ No newline at end of file
+    def complete(self):
+        self.completed_at = timezone.now()
+        self.save(update_fields=['completed_at', 'updated_at'])
@@ -0,0 +1,435 @@
+import logging
+import time
+import django
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import groupby
+from datetime import date, timedelta
+from django.db import connection, connections, transaction
+from django.db.models import OuterRef, Q, Subquery
+from lib.common import chunked
+from loan_backend.config import LoanStatus, InstallmentStatus
+from loan_backend.constants import PENALTY_CHUNK_SIZE, PENALTY_BATCH_SIZE, PENALTY_SHARDS_PER_WORKER
+from loan.models import Installment, Penalty, PenaltyCheckpoint, PenaltySegment, penalty_segments_enabled
+
+logger = logging.getLogger(__name__)
+
+class PenaltyRunReport:
+    def __init__(self, final_date):
+        self.final_date = final_date
+        self.chunks = 0
+        self.installments_scanned = 0
+        self.installments_penalised = 0
+        self.rows_written = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        return self.installments_scanned / elapsed if elapsed > 0 else 0.0
+
+    def add_chunk(self, scanned, penalised, rows_written):
+        self.chunks += 1
+        self.installments_scanned += scanned
+        self.installments_penalised += penalised
+        self.rows_written += rows_written
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+
+    def as_dict(self):
+        return {
+            'final_date': str(self.final_date),
+            'chunks': self.chunks,
+            'installments_scanned': self.installments_scanned,
+            'installments_penalised': self.installments_penalised,
+            'rows_written': self.rows_written,
+            'elapsed_seconds': round(self.elapsed, 3),
+            'installments_per_second': round(self.throughput, 1),
+        }
+
+    def __str__(self):
+        return (
+            f"chunk {self.chunks}: {self.installments_scanned} installments scanned, "
+            f"{self.installments_penalised} penalised, {self.rows_written} penalty rows written "
+            f"in {self.elapsed:.2f}s ({self.throughput:.1f} installments/s)"
+        )
+
+# Set based replacement for calling Installment.update_penalty on every candidate installment.
+# Balances and accrual watermarks of a whole chunk of installments are read in one query, the accrual
+# since the watermark is computed in closed form and the daily rows are written with bulk_create. With
+# segment storage the last segment is extended or a new one is created. Installments already accrued
+# through final_date are not candidates, and progress is checkpointed per chunk so a failed run resumes
+# where it stopped.
+class BulkPenaltyEngine:
+    def __init__(
+        self,
+        final_date=None,
+        penalty_multiplier=None,
+        chunk_size=PENALTY_CHUNK_SIZE,
+        batch_size=PENALTY_BATCH_SIZE,
+        progress=None,
+        loanshare_range=None,
+        dry_run=False,
+        resume=True
+    ):
+        self.final_date = final_date or date.today()
+        self.penalty_multiplier = penalty_multiplier
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.progress = progress
+        # (first, last) loanshare ids, both inclusive, to run a single shard
+        self.loanshare_range = loanshare_range
+        # compute and count the rows without writing them
+        self.dry_run = dry_run
+        # continue an unfinished run with the same final date and range from its checkpoint
+        self.resume = resume and not dry_run
+        self.segments = penalty_segments_enabled()
+
+    def candidates(self):
+        queryset = Installment.objects.filter(
+            loanshare__status=LoanStatus.APPROVED.name,
+            due_date__lt=self.final_date,
+        ).filter(
+            Q(penalty_accrued_through__isnull=True) | Q(penalty_accrued_through__lt=self.final_date)
+        ).exclude(
+            status__in=[InstallmentStatus.PAID.name, InstallmentStatus.PAID_WITHOUT_PENALTY.name]
+        )
+        if self.loanshare_range is not None:
+            first, last = self.loanshare_range
+            queryset = queryset.filter(loanshare_id__gte=first, loanshare_id__lte=last)
+        return queryset
+
+    # balances and the accrual watermark are columns of installment, with segment storage the last
+    # segment is looked up as well so that it can be extended
+    def with_balances(self, queryset):
+        if self.segments:
+            last_segment = PenaltySegment.objects.filter(installment=OuterRef('pk')).order_by('-end_date')
+            return queryset.annotate(
+                last_segment_id=Subquery(last_segment.values('id')[:1]),
+                last_segment_daily_penalty=Subquery(last_segment.values('daily_penalty')[:1]),
+                last_segment_end_date=Subquery(last_segment.values('end_date')[:1]),
+                last_segment_amount=Subquery(last_segment.values('amount')[:1]),
+            )
+
+        return queryset
+
+    def compute_penalties(self, installment):
+        accrual = installment.accrued_penalty(self.final_date, self.penalty_multiplier)
+        if not accrual:
+            return []
+
+        return Penalty.materialize(installment.pk, accrual)
+
+    # returns (segment, created) or None when no penalty is due
+    def compute_segment(self, installment):
+        accrual = installment.accrued_penalty(self.final_date, self.penalty_multiplier)
+        if not accrual:
+            return None
+
+        last_segment = None
+        if installment.last_segment_id is not None:
+            last_segment = PenaltySegment(
+                id=installment.last_segment_id,
+                installment_id=installment.pk,
+                end_date=installment.last_segment_end_date,
+                daily_penalty=installment.last_segment_daily_penalty,
+                amount=installment.last_segment_amount
+            )
+
+        return PenaltySegment.accrued_segment(installment.pk, last_segment, accrual)
+
+    def write_penalties(self, installments):
+        penalties = []
+        penalised = 0
+        for i in installments:
+            rows = self.compute_penalties(i)
+            if rows:
+                penalised += 1
+                penalties.extend(rows)
+                i.penalty_accrued = rows[-1].amount
+
+        if not self.dry_run:
+            Penalty.objects.bulk_create(penalties, batch_size=self.batch_size)
+        return penalised, len(penalties)
+
+    def write_segments(self, installments):
+        created = []
+        extended = []
+        for i in installments:
+            result = self.compute_segment(i)
+            if result is None:
+                continue
+
+            segment, is_new = result
+            (created if is_new else extended).append(segment)
+            i.penalty_accrued = segment.amount
+
+        if not self.dry_run:
+            PenaltySegment.objects.bulk_create(created, batch_size=self.batch_size)
+            PenaltySegment.objects.bulk_update(extended, ['end_date', 'amount'], batch_size=self.batch_size)
+        written = len(created) + len(extended)
+        return written, written
+
+    # every installment of the chunk is now accrued through final_date, penalised or not
+    def advance_watermarks(self, installments):
+        for i in installments:
+            i.penalty_accrued_through = self.final_date
+
+        Installment.objects.bulk_update(
+            installments, ['penalty_accrued_through', 'penalty_accrued'], batch_size=self.batch_size
+        )
+
+    def run_chunk(self, last_pk, checkpoint=None):
+        with transaction.atomic():
+            queryset = self.with_balances(self.candidates().filter(pk__gt=last_pk))
+            if not self.dry_run:
+                queryset = queryset.select_for_update(of=('self',))
+            installments = list(queryset.order_by('pk')[:self.chunk_size])
+            if self.segments:
+                penalised, rows_written = self.write_segments(installments)
+            else:
+                penalised, rows_written = self.write_penalties(installments)
+
+            if installments and not self.dry_run:
+                self.advance_watermarks(installments)
+                if checkpoint:
+                    checkpoint.advance(installments[-1].pk, len(installments), rows_written)
+
+        return installments, penalised, rows_written
+
+    def run(self):
+        report = PenaltyRunReport(self.final_date)
+        checkpoint = None
+        last_pk = 0
+        if self.resume:
+            checkpoint = PenaltyCheckpoint.resume(self.final_date, self.loanshare_range)
+            last_pk = checkpoint.last_installment
+            if last_pk:
+                logger.info("penalty run %s: resuming after installment %s", self.final_date, last_pk)
+
+        while True:
+            installments, penalised, rows_written = self.run_chunk(last_pk, checkpoint)
+            if not installments:
+                break
+
+            last_pk = installments[-1].pk
+            report.add_chunk(len(installments), penalised, rows_written)
+            logger.info("penalty run %s: %s", self.final_date, report)
+            if self.progress:
+                self.progress(report)
+
+        if checkpoint:
+            checkpoint.complete()
+        report.finish()
+        return report
+
+
+# splits the loanshares of the candidate installments into at most `shards` contiguous id ranges
+# holding about the same number of loanshares, returns (first, last) tuples with both ends inclusive.
+# loanshares within the `exclude` ranges are left out
+def shard_ranges(final_date, shards, loanshare_range=None, exclude=()):
+    queryset = BulkPenaltyEngine(final_date=final_date, loanshare_range=loanshare_range).candidates()
+    for first, last in exclude:
+        queryset = queryset.exclude(loanshare_id__gte=first, loanshare_id__lte=last)
+    loanshare_ids = list(
+        queryset.order_by('loanshare_id').values_list('loanshare_id', flat=True).distinct()
+    )
+    if not loanshare_ids:
+        return []
+
+    size = -(-len(loanshare_ids) // max(shards, 1))
+    return [(ids[0], ids[-1]) for ids in chunked(loanshare_ids, size)]
+
+def init_shard_worker():
+    django.setup()
+
+# runs in a worker process, every chunk commits on its own so a failed shard can simply be run again,
+# installments that were already penalised up to the final date are skipped by the engine
+def run_penalty_shard(shard, loanshare_range, options):
+    try:
+        report = BulkPenaltyEngine(loanshare_range=loanshare_range, **options).run()
+        return {'shard': shard, 'loanshare_range': list(loanshare_range), 'error': None, **report.as_dict()}
+    except Exception as e:
+        logger.exception("penalty shard %s %s failed", shard, loanshare_range)
+        return {'shard': shard, 'loanshare_range': list(loanshare_range), 'error': str(e)}
+    finally:
+        connections.close_all()
+
+# Runs BulkPenaltyEngine over loanshare id shards in a process pool, every worker has its own database
+# connection. With a single worker, or on SQLite which allows a single writer, the shards run one after
+# another in this process.
+class ParallelPenaltyRunner:
+    def __init__(
+        self,
+        final_date=None,
+        penalty_multiplier=None,
+        workers=1,
+        shards=None,
+        chunk_size=PENALTY_CHUNK_SIZE,
+        batch_size=PENALTY_BATCH_SIZE,
+        loanshare_range=None,
+        dry_run=False,
+        progress=None
+    ):
+        self.final_date = final_date or date.today()
+        self.workers = max(workers, 1)
+        self.shards = shards or self.workers * PENALTY_SHARDS_PER_WORKER
+        self.loanshare_range = loanshare_range
+        self.progress = progress
+        self.options = {
+            'final_date': self.final_date,
+            'penalty_multiplier': penalty_multiplier,
+            'chunk_size': chunk_size,
+            'batch_size': batch_size,
+            'dry_run': dry_run,
+        }
+
+    # shards of an earlier run that did not complete are run with their stored range so that they resume
+    # from their checkpoints, the candidates outside of them are split into new shards
+    def shard_plan(self):
+        resumed = []
+        if not self.options['dry_run']:
+            resumed = PenaltyCheckpoint.unfinished_ranges(self.final_date, self.loanshare_range)
+        ranges = shard_ranges(self.final_date, max(self.shards - len(resumed), 1), self.loanshare_range, exclude=resumed)
+        return sorted(resumed + ranges)
+
+    def run(self):
+        started_at = time.monotonic()
+        ranges = self.shard_plan()
+        results = []
+        if self.workers > 1 and connection.vendor == 'sqlite' and not self.options['dry_run']:
+            logger.warning("sqlite allows a single writer, running %s penalty shards in one process", len(ranges))
+            self.workers = 1
+
+        if self.workers == 1:
+            for shard, loanshare_range in enumerate(ranges):
+                results.append(self.shard_done(run_penalty_shard(shard, loanshare_range, self.options)))
+        else:
+            # forked workers must not share the connection of this process
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_shard_worker) as executor:
+                futures = [
+                    executor.submit(run_penalty_shard, shard, loanshare_range, self.options)
+                    for shard, loanshare_range in enumerate(ranges)
+                ]
+                for future in as_completed(futures):
+                    results.append(self.shard_done(future.result()))
+
+        results.sort(key=lambda result: result['shard'])
+        return self.summary(results, time.monotonic() - started_at)
+
+    def shard_done(self, result):
+        if result['error']:
+            logger.error("penalty shard %s %s failed: %s", result['shard'], result['loanshare_range'], result['error'])
+        else:
+            logger.info("penalty shard %s %s: %s rows", result['shard'], result['loanshare_range'], result['rows_written'])
+        if self.progress:
+            self.progress(result)
+        return result
+
+    def summary(self, results, elapsed):
+        succeeded = [result for result in results if not result['error']]
+        scanned = sum(result['installments_scanned'] for result in succeeded)
+        return {
+            'final_date': str(self.final_date),
+            'dry_run': self.options['dry_run'],
+            'workers': self.workers,
+            'shards': results,
+            'failed_shards': [result['loanshare_range'] for result in results if result['error']],
+            'installments_scanned': scanned,
+            'installments_penalised': sum(result['installments_penalised'] for result in succeeded),
+            'rows_written': sum(result['rows_written'] for result in succeeded),
+            'elapsed_seconds': round(elapsed, 3),
+            'installments_per_second': round(scanned / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+# Lossless compaction of daily cumulative penalty rows into accrual segments.
+# rows are (date, amount) ordered by date, returns (start_date, end_date, daily_penalty, amount) tuples
+def compact_penalty_rows(rows):
+    segments = []
+    last_date = None
+    last_amount = 0
+    for penalty_date, amount in rows:
+        daily_penalty = amount - last_amount
+        if segments and last_date + timedelta(days=1) == penalty_date and segments[-1][2] == daily_penalty:
+            start_date, _, _, _ = segments[-1]
+            segments[-1] = (start_date, penalty_date, daily_penalty, amount)
+        else:
+            segments.append((penalty_date, penalty_date, daily_penalty, amount))
+
+        last_date = penalty_date
+        last_amount = amount
+
+    return segments
+
+# queryset must be ordered by installment_id first
+def group_by_installment(queryset):
+    for installment_id, group in groupby(queryset.iterator(), key=lambda obj: obj.installment_id):
+        yield installment_id, list(group)
+
+def compact_penalties(installment_ids=None, batch_size=PENALTY_BATCH_SIZE):
+    penalties = Penalty.objects.all()
+    segments = PenaltySegment.objects.all()
+    if installment_ids is not None:
+        penalties = penalties.filter(installment_id__in=installment_ids)
+        segments = segments.filter(installment_id__in=installment_ids)
+
+    created = 0
+    with transaction.atomic():
+        segments.delete()
+        batch = []
+        for installment_id, rows in group_by_installment(penalties.order_by('installment_id', 'date')):
+            for start_date, end_date, daily_penalty, amount in compact_penalty_rows((p.date, p.amount) for p in rows):
+                batch.append(PenaltySegment(
+                    installment_id=installment_id,
+                    start_date=start_date,
+                    end_date=end_date,
+                    daily_penalty=daily_penalty,
+                    amount=amount
+                ))
+
+            if len(batch) >= batch_size:
+                PenaltySegment.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+
+        PenaltySegment.objects.bulk_create(batch)
+        created += len(batch)
+
+    return created
+
+# returns (installment_id, date, penalty_amount, segment_amount) for every daily row the segments disagree with
+def verify_penalty_segments(installment_ids=None):
+    penalties = Penalty.objects.all()
+    segments = PenaltySegment.objects.all()
+    if installment_ids is not None:
+        penalties = penalties.filter(installment_id__in=installment_ids)
+        segments = segments.filter(installment_id__in=installment_ids)
+
+    segments_by_installment = {}
+    for installment_id, group in group_by_installment(segments.order_by('installment_id', 'start_date')):
+        segments_by_installment[installment_id] = group
+
+    mismatches = []
+    for installment_id, rows in group_by_installment(penalties.order_by('installment_id', 'date')):
+        installment_segments = segments_by_installment.get(installment_id, [])
+        index = 0
+        for row in rows:
+            while index + 1 < len(installment_segments) and installment_segments[index + 1].start_date <= row.date:
+                index += 1
+
+            if installment_segments and installment_segments[index].start_date <= row.date:
+                amount = installment_segments[index].amount_on(row.date)
+            else:
+                amount = 0
+
+            if amount != row.amount:
+                mismatches.append((installment_id, row.date, row.amount, amount))
+
+    return mismatches
@@ -0,0 +1,71 @@
+from datetime import date
+from django.db import connection
+from loan_backend.config import InstallmentStatus
+from loan.models import Installment, InstallmentDetail, Penalty, PenaltySegment
+from loan.penalty import BulkPenaltyEngine
+
+# hot query shapes of payments, penalty accrual and the penalty cron with the index each one should use
+def hot_queries():
+    return [
+        {
+            'query': 'open installments of a loanshare in order',
+            'queryset': Installment.objects.filter(loanshare_id=1).exclude(
+                status=InstallmentStatus.PAID.name
+            ).order_by('order'),
+            'index': 'installment_loanshare_order_uniq',
+            'unique': True,
+        },
+        {
+            'query': 'latest penalty of an installment',
+            'queryset': Penalty.objects.filter(installment_id=1).order_by('-date')[:1],
+            'index': 'penalty_installment_date_idx',
+        },
+        {
+            'query': 'penalties of an installment after a date',
+            'queryset': Penalty.objects.filter(installment_id=1, date__gte=date.today()).order_by('date'),
+            'index': 'penalty_installment_date_idx',
+        },
+        {
+            'query': 'latest penalty segment of an installment',
+            'queryset': PenaltySegment.objects.filter(installment_id=1).order_by('-end_date')[:1],
+            'index': 'segment_installment_end_idx',
+        },
+        {
+            'query': 'payment details of an installment',
+            'queryset': InstallmentDetail.objects.filter(installment_id=1, loan_repayment_id=1),
+            'index': 'detail_installment_payment_idx',
+        },
+        {
+            'query': 'chunk of open installments for the penalty cron',
+            'queryset': BulkPenaltyEngine(final_date=date.today(), resume=False).candidates().filter(
+                pk__gt=0
+            ).order_by('pk')[:100],
+            'index': 'installment_open_idx',
+            'partial': True,
+        },
+    ]
+
+def plan_uses_index(plan, query):
+    if query['index'] in plan:
+        return True
+    # sqlite creates the index of a unique constraint with the table
+    if query.get('unique') and connection.vendor == 'sqlite':
+        return f"sqlite_autoindex_{query['queryset'].model._meta.db_table}_" in plan
+
+    return False
+
+# EXPLAIN of every hot query and whether its plan uses the expected index. sqlite cannot match the
+# condition of a partial index against bound parameters, so those are only used on postgresql.
+def explain_hot_queries():
+    report = []
+    for query in hot_queries():
+        plan = query['queryset'].explain()
+        report.append({
+            'query': query['query'],
+            'index': query['index'],
+            'uses_index': plan_uses_index(plan, query),
+            'expected': not (query.get('partial') and connection.vendor == 'sqlite'),
+            'plan': plan,
+        })
+
+    return report
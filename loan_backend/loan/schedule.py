@@ -0,0 +1,79 @@
+from datetime import timedelta
+from decimal import Decimal
+from functools import lru_cache
+from lib.common import add_months
+from loan import errors
+from loan_backend.config import Periodicity
+from loan_backend.constants import DEFAULT_DECIMAL_PLACES
+
+PERIODICITY_FACTORS = {
+    Periodicity.daily.name: 365,
+    Periodicity.weekly.name: 52,
+    Periodicity.monthly.name: 12,
+}
+
+PERIODICITY_DAYS = {
+    Periodicity.daily.name: 1,
+    Periodicity.weekly.name: 7,
+}
+
+# due dates of all installments of a schedule, shared by every loanshare with the same terms and start date
+@lru_cache(maxsize=1024)
+def due_dates(periodicity, start_date, tenure):
+    if periodicity in PERIODICITY_DAYS:
+        step = timedelta(days=PERIODICITY_DAYS[periodicity])
+        return tuple(start_date + step * n for n in range(1, tenure + 1))
+    if periodicity == Periodicity.monthly.name:
+        return tuple(add_months(start_date, n) for n in range(1, tenure + 1))
+
+    raise errors.InvalidPeriodicity()
+
+# total repayable amount in the smallest unit (10 ** -DEFAULT_DECIMAL_PLACES) as an int
+def total_units(share, tenure, interest, processing_fee, periodicity):
+    if periodicity not in PERIODICITY_FACTORS:
+        raise errors.InvalidPeriodicity()
+
+    total_amount = round(
+        share +
+        (share * tenure * (interest / PERIODICITY_FACTORS[periodicity])) +
+        (share * processing_fee),
+        DEFAULT_DECIMAL_PLACES
+    )
+    return int(total_amount.scaleb(DEFAULT_DECIMAL_PLACES))
+
+# splits total units into tenure emis, the remainder goes one unit at a time to the earliest emis
+def emi_amounts(units, tenure):
+    emi_units, remainder = divmod(units, tenure)
+    larger = Decimal(emi_units + 1).scaleb(-DEFAULT_DECIMAL_PLACES)
+    regular = Decimal(emi_units).scaleb(-DEFAULT_DECIMAL_PLACES)
+    return [larger] * remainder + [regular] * (tenure - remainder)
+
+def emi_schedule(share, loan, start_date):
+    dates = due_dates(loan.periodicity, start_date, loan.tenure)
+    amounts = emi_amounts(
+        total_units(share, loan.tenure, loan.interest, loan.processing_fee, loan.periodicity),
+        loan.tenure
+    )
+    return [
+        {
+            'due_date': due_date,
+            'status': 'NOT_STARTED',
+            'paid_amount': 0,
+            'suggested_emi': amount,
+        }
+        for due_date, amount in zip(dates, amounts)
+    ]
+
+# schedules of many loanshares at once, loanshares with the same terms share one computation
+# returns {loanshare id: emis}
+def emi_schedules(loanshares, start_date):
+    computed = {}
+    schedules = {}
+    for ls in loanshares:
+        loan = ls.loan
+        key = (ls.share, loan.tenure, loan.interest, loan.processing_fee, loan.periodicity)
+        if key not in computed:
+            computed[key] = emi_schedule(ls.share, loan, start_date)
+        schedules[ls.id] = [dict(emi) for emi in computed[key]]
+
+    return schedules
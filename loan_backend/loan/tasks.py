@@ -1,13 +1,49 @@
-from loan_backend.config import InstallmentStatus, LoanStatus
-from loan.models import Installment
+from loan import metrics
+from loan.penalty import BulkPenaltyEngine, ParallelPenaltyRunner
+from loan_backend.constants import PENALTY_CHUNK_SIZE, PENALTY_BATCH_SIZE
 
-def update_penalty():
-    installments = Installment.objects.filter(
-        loanshare__status=LoanStatus.APPROVED.name
-    ).exclude(
-        status=InstallmentStatus.PAID.name
-    ).exclude(
-        status=InstallmentStatus.PAID_WITHOUT_PENALTY.name
+def update_penalty(
+    final_date=None,
+    penalty_multiplier=None,
+    chunk_size=PENALTY_CHUNK_SIZE,
+    batch_size=PENALTY_BATCH_SIZE,
+    progress=None
+):
+    engine = BulkPenaltyEngine(
+        final_date=final_date,
+        penalty_multiplier=penalty_multiplier,
+        chunk_size=chunk_size,
+        batch_size=batch_size,
+        progress=progress
     )
-    for i in installments:
-        i.update_penalty()
+    report = engine.run()
+    metrics.penalty_run(report.elapsed, report.rows_written)
+    return report
+
+# shards the penalty cron by loanshare id over a pool of worker processes
+def update_penalty_parallel(
+    final_date=None,
+    penalty_multiplier=None,
+    workers=1,
+    shards=None,
+    chunk_size=PENALTY_CHUNK_SIZE,
+    batch_size=PENALTY_BATCH_SIZE,
+    loanshare_range=None,
+    dry_run=False,
+    progress=None
+):
+    runner = ParallelPenaltyRunner(
+        final_date=final_date,
+        penalty_multiplier=penalty_multiplier,
+        workers=workers,
+        shards=shards,
+        chunk_size=chunk_size,
+        batch_size=batch_size,
+        loanshare_range=loanshare_range,
+        dry_run=dry_run,
+        progress=progress
+    )
+    summary = runner.run()
+    if not dry_run:
+        metrics.penalty_run(summary['elapsed_seconds'], summary['rows_written'])
+    return summary
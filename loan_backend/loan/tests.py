@@ -1,10 +1,40 @@
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+from unittest import mock, skipUnless
 from datetime import date, timedelta
 from decimal import Decimal
+from io import StringIO
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, connection, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 from loan_backend.config import LoanStatus, InstallmentStatus
-from loan import errors
-from loan.models import Loan, LoanShare, Installment, Penalty
+from loan import errors, tasks
+from loan.models import Loan, LoanShare, Installment, InstallmentDetail, Penalty, PenaltyCheckpoint, PenaltySegment
+from loan.query_plans import explain_hot_queries
+from loan.penalty import BulkPenaltyEngine, ParallelPenaltyRunner, compact_penalties, shard_ranges, verify_penalty_segments
+from loan.accrual import accrue
+from loan.benchmarks.accrual import legacy_update_penalty
+from loan.benchmarks.data import seed_loans
+from lib.instrumentation import QueryRecorder
+from lib.pagination import encode_cursor
+from prometheus_client import REGISTRY
+from loan.cache import emi_preview_cache
+from loan.ingestion import ingest_payments
+from loan.views import BulkAddPayment
+from loan.schedule import emi_schedules
+from loan.benchmarks.payments import legacy_add_payment
+from loan.benchmarks.schedule import legacy_calculate_emis
 
 class LoanTestCase(TestCase):
     def setUp(self):
@@ -49,6 +79,19 @@ class LoanTestCase(TestCase):
             self.assertEqual(installment.status, InstallmentStatus.UNPAID.name)
             self.assertEqual(installment.amount_remaining, installment.suggested_emi)
             
+    # Test case when approval inserts installments in bulk whatever the tenure
+    def test_approve_loan_query_count(self):
+        queries = []
+        for tenure in [4, 60]:
+            loan = Loan.create_loan({'amount': 1000, 'tenure': tenure, 'periodicity': 'daily'}, self.user)
+            with CaptureQueriesContext(connection) as captured:
+                loan.approve_loan(date.today())
+            queries.append(len(captured))
+            self.assertEqual(Installment.objects.filter(loanshare__loan=loan).count(), tenure)
+            self.assertEqual(LoanShare.objects.get(loan=loan).status, LoanStatus.APPROVED.name)
+
+        self.assertEqual(queries[0], queries[1])
+
     # Test case when payment is made.
     def test_add_payment(self):
         approval_date = date.today()
@@ -134,6 +177,34 @@ class LoanTestCase(TestCase):
         loan = Loan.objects.get(pk=self.loan.pk)
         self.assertEqual(loan.status, LoanStatus.COMPLETED.name)
 
+    # Test case when balances are aggregated by the database
+    def test_balance_aggregates(self):
+        self.loan.approve_loan(date.today())
+        loanshare = LoanShare.objects.get(loan=self.loan, user=self.user)
+        installments = Installment.objects.filter(loanshare=loanshare).order_by('order')
+        self.create_penalty(installments[0], 3)
+        loanshare.add_payment(400, 'PAYMENT_AGG.0', installments[0].due_date + timedelta(days=3))
+        loanshare.add_payment(50.5, 'PAYMENT_AGG.1', installments[0].due_date + timedelta(days=3))
+        other = Loan.create_loan({'amount': 500, 'tenure': 2, 'interest': 0, 'processing_fee': 0}, self.user)
+
+        installments = Installment.objects.filter(loanshare__loan=self.loan)
+        outstanding = sum(i.amount_remaining for i in installments)
+        penalty_due = sum(i.penalty_remaining for i in installments)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.loan.amount_pending, {self.user.username: outstanding})
+        with self.assertNumQueries(1):
+            self.assertEqual(loanshare.total_paid(), Decimal('450.5'))
+        self.assertEqual(LoanShare.objects.get(loan=other).total_paid(), 0)
+        self.assertEqual(other.amount_pending, {self.user.username: 0})
+
+        with self.assertNumQueries(1):
+            loans = {loan.id: loan for loan in Loan.objects.filter(pk__in=[self.loan.pk, other.pk]).with_balances()}
+        self.assertEqual(loans[self.loan.pk].outstanding_balance, outstanding)
+        self.assertEqual(loans[self.loan.pk].total_paid, Decimal('450.5'))
+        self.assertGreater(penalty_due, 0)
+        self.assertEqual(loans[self.loan.pk].penalty_due, penalty_due)
+        self.assertEqual((loans[other.pk].outstanding_balance, loans[other.pk].total_paid, loans[other.pk].penalty_due), (0, 0, 0))
+
     # Test case when payment is marked on a later date with penalty
     def test_post_facto_add_payment_with_penalty(self):
         approval_date = date.today()
@@ -151,3 +222,1111 @@ class LoanTestCase(TestCase):
         installments = Installment.objects.filter(loanshare=loanshare).order_by('order')
         self.assertEqual(installments[0].amount_remaining, 0)
         self.assertEqual(installments[0].penalty_remaining, last_actual_penalty_amount)
+
+class BulkPenaltyEngineTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy2', password='testpass')
+        self.approval_date = date(2023, 1, 2)
+        self.loanshares = []
+        for amount in [1000, 2500]:
+            loan = Loan.create_loan({'amount': amount, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, self.user)
+            loan.approve_loan(self.approval_date)
+            self.loanshares.append(LoanShare.objects.get(loan=loan))
+
+        # partial payment on the first installment and an already started penalty sequence on another
+        first = Installment.objects.get(loanshare=self.loanshares[0], order=1)
+        self.loanshares[0].add_payment(100, 'PAYMENT5', first.due_date)
+        started = Installment.objects.get(loanshare=self.loanshares[1], order=2)
+        started.update_penalty(final_date=started.due_date + timedelta(days=3), penalty_multiplier=0.01)
+        self.final_date = self.approval_date + timedelta(days=40)
+
+    def snapshot(self):
+        return list(Penalty.objects.order_by('installment_id', 'date').values_list('installment_id', 'date', 'amount'))
+
+    # penalty rows and accrual watermarks as they were before a run
+    def saved_penalties(self):
+        existing = set(Penalty.objects.values_list('id', flat=True))
+        watermarks = list(Installment.objects.all())
+        def restore():
+            Penalty.objects.exclude(id__in=existing).delete()
+            Installment.objects.bulk_update(watermarks, ['penalty_accrued_through', 'penalty_accrued'])
+        return existing, restore
+
+    def test_matches_per_installment_penalties(self):
+        existing, restore = self.saved_penalties()
+        installments = Installment.objects.filter(loanshare__in=self.loanshares).exclude(
+            status__in=[InstallmentStatus.PAID.name, InstallmentStatus.PAID_WITHOUT_PENALTY.name]
+        )
+        for i in installments:
+            i.update_penalty(final_date=self.final_date, penalty_multiplier=0.01)
+        expected = self.snapshot()
+        restore()
+
+        report = BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01, chunk_size=3).run()
+        self.assertEqual(self.snapshot(), expected)
+        self.assertEqual(report.rows_written, len(expected) - len(existing))
+        self.assertEqual(report.installments_scanned, len(installments))
+
+    def test_rerun_is_noop(self):
+        BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01).run()
+        expected = self.snapshot()
+        report = BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01).run()
+        self.assertEqual(report.rows_written, 0)
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_watermarks_skip_accrued_installments(self):
+        BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01).run()
+        for installment in Installment.objects.filter(penalty_accrued_through__isnull=False):
+            self.assertEqual(installment.penalty_accrued_through, self.final_date)
+            self.assertEqual(installment.penalty_accrued, installment.penalty)
+
+        with CaptureQueriesContext(connection) as captured:
+            report = BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01).run()
+            Installment.objects.get(loanshare=self.loanshares[1], order=2).update_penalty(final_date=self.final_date)
+        self.assertEqual(report.installments_scanned, 0)
+        self.assertFalse([q for q in captured.captured_queries if '"loan_penalty"' in q['sql']])
+
+        # a backdated payment moves the accrued penalty back with the rewritten penalties
+        installment = Installment.objects.get(loanshare=self.loanshares[1], order=1)
+        self.loanshares[1].add_payment(300, 'PAYMENT13', installment.due_date + timedelta(days=5))
+        installment.refresh_from_db()
+        self.assertEqual(installment.penalty_accrued, installment.penalty)
+        self.assertEqual(installment.penalty_accrued_through, self.final_date)
+
+    def test_failed_run_resumes_from_checkpoint(self):
+        existing, restore = self.saved_penalties()
+        BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01).run()
+        expected = self.snapshot()
+        restore()
+        PenaltyCheckpoint.objects.all().delete()
+
+        engine = BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01, chunk_size=2)
+        write_penalties = engine.write_penalties
+        calls = []
+        def failing_write(installments):
+            calls.append(installments)
+            if len(calls) == 2:
+                raise RuntimeError("connection lost")
+            return write_penalties(installments)
+        engine.write_penalties = failing_write
+        with self.assertRaises(RuntimeError):
+            engine.run()
+
+        checkpoint = PenaltyCheckpoint.objects.get()
+        self.assertEqual(checkpoint.last_installment, calls[0][-1].pk)
+        self.assertIsNone(checkpoint.completed_at)
+
+        report = BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01, chunk_size=2).run()
+        checkpoint.refresh_from_db()
+        self.assertIsNotNone(checkpoint.completed_at)
+        self.assertEqual(checkpoint.installments_scanned, 2 + report.installments_scanned)
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_retried_sharded_run_resumes_checkpoints(self):
+        existing, restore = self.saved_penalties()
+        BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01).run()
+        expected = self.snapshot()
+        restore()
+        PenaltyCheckpoint.objects.all().delete()
+
+        # the only shard fails once the first loanshare is done, the retry splits the rest differently
+        [loanshare_range] = shard_ranges(self.final_date, 1)
+        chunk_size = BulkPenaltyEngine(final_date=self.final_date).candidates().filter(loanshare=self.loanshares[0]).count()
+        engine = BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01, chunk_size=chunk_size, loanshare_range=loanshare_range)
+        write_penalties = engine.write_penalties
+        calls = []
+        def failing_write(installments):
+            calls.append(installments)
+            if len(calls) == 2:
+                raise RuntimeError("connection lost")
+            return write_penalties(installments)
+        engine.write_penalties = failing_write
+        with self.assertRaises(RuntimeError):
+            engine.run()
+        self.assertNotEqual(shard_ranges(self.final_date, 1), [loanshare_range])
+
+        summary = ParallelPenaltyRunner(final_date=self.final_date, penalty_multiplier=0.01, shards=1, chunk_size=chunk_size).run()
+        self.assertEqual([shard['loanshare_range'] for shard in summary['shards']], [list(loanshare_range)])
+        checkpoint = PenaltyCheckpoint.objects.get()
+        self.assertIsNotNone(checkpoint.completed_at)
+        self.assertEqual(checkpoint.installments_scanned, chunk_size + summary['installments_scanned'])
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_sharded_run_matches_single_run(self):
+        ranges = shard_ranges(self.final_date, 2)
+        self.assertEqual(ranges, [(ls.id, ls.id) for ls in self.loanshares])
+
+        existing, restore = self.saved_penalties()
+        report = BulkPenaltyEngine(final_date=self.final_date, penalty_multiplier=0.01).run()
+        expected = self.snapshot()
+        restore()
+
+        dry_run = ParallelPenaltyRunner(final_date=self.final_date, penalty_multiplier=0.01, shards=2, dry_run=True).run()
+        self.assertEqual(dry_run['rows_written'], report.rows_written)
+        self.assertEqual(len(dry_run['shards']), 2)
+        self.assertEqual(Penalty.objects.count(), len(existing))
+
+        # a shard that is run again after the others only writes what is missing
+        runner = ParallelPenaltyRunner(final_date=self.final_date, penalty_multiplier=0.01, loanshare_range=ranges[1])
+        self.assertEqual(runner.run()['failed_shards'], [])
+        summary = ParallelPenaltyRunner(final_date=self.final_date, penalty_multiplier=0.01, shards=2).run()
+        self.assertEqual(summary['rows_written'], dry_run['shards'][0]['rows_written'])
+        self.assertEqual(self.snapshot(), expected)
+
+class PenaltySegmentTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy3', password='testpass')
+
+    # late penalty, a backdated partial payment and more penalty afterwards
+    def run_scenario(self, payment_id):
+        loan = Loan.create_loan({'amount': 1000, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, self.user)
+        loan.approve_loan(date(2023, 1, 2))
+        loanshare = LoanShare.objects.get(loan=loan)
+        installment = Installment.objects.get(loanshare=loanshare, order=1)
+        installment.update_penalty(final_date=installment.due_date + timedelta(days=6), penalty_multiplier=0.01)
+        loanshare.add_payment(100, payment_id, installment.due_date + timedelta(days=2))
+        installment = Installment.objects.get(pk=installment.pk)
+        installment.update_penalty(final_date=installment.due_date + timedelta(days=10), penalty_multiplier=0.01)
+        return installment
+
+    def penalties(self, installment):
+        return [installment.penalty_on(installment.due_date + timedelta(days=d)) for d in range(-1, 12)]
+
+    def test_segments_match_daily_rows(self):
+        installment = self.run_scenario('PAYMENT6.0')
+        expected = self.penalties(installment)
+        expected_penalty = installment.penalty
+        with override_settings(PENALTY_STORAGE='SEGMENT'):
+            segment_installment = self.run_scenario('PAYMENT6.1')
+            self.assertEqual(self.penalties(segment_installment), expected)
+            self.assertEqual(segment_installment.penalty, expected_penalty)
+            self.assertEqual(PenaltySegment.objects.filter(installment=segment_installment).count(), 3)
+            self.assertFalse(Penalty.objects.filter(installment=segment_installment).exists())
+
+    def test_compaction(self):
+        installment = self.run_scenario('PAYMENT7')
+        expected = self.penalties(installment)
+        created = compact_penalties()
+        self.assertEqual(created, 3)
+        self.assertEqual(verify_penalty_segments(), [])
+        with override_settings(PENALTY_STORAGE='SEGMENT'):
+            self.assertEqual(self.penalties(installment), expected)
+
+        PenaltySegment.objects.filter(installment=installment).update(amount=0)
+        self.assertNotEqual(verify_penalty_segments(), [])
+
+    @override_settings(PENALTY_STORAGE='SEGMENT')
+    def test_bulk_engine_extends_segments(self):
+        installment = self.run_scenario('PAYMENT8')
+        expected = installment.penalty + 5 * Penalty.compute_penalty(installment.amount_remaining, 0.01)
+        report = BulkPenaltyEngine(final_date=installment.due_date + timedelta(days=15), penalty_multiplier=0.01).run()
+        self.assertEqual(Installment.objects.get(pk=installment.pk).penalty, expected)
+        self.assertEqual(PenaltySegment.objects.filter(installment=installment).count(), 3)
+        self.assertGreater(report.rows_written, 0)
+
+class InstallmentBalanceTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy4', password='testpass')
+        loan = Loan.create_loan({'amount': 1000, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, self.user)
+        loan.approve_loan(date(2023, 1, 2))
+        self.loanshare = LoanShare.objects.get(loan=loan)
+
+    def test_balances_follow_ledger(self):
+        self.loanshare.add_payment(300, 'PAYMENT9.0', date(2023, 1, 9))
+        self.loanshare.add_payment(800, 'PAYMENT9.1', date(2023, 1, 9))
+        installments = Installment.objects.filter(loanshare=self.loanshare).order_by('order')
+        self.assertEqual([i.amount_paid for i in installments], [250, 250, 250, 250])
+        self.assertEqual(installments.last().penalty_paid, 100)
+        self.assertEqual(Installment.rebuild_balances(verify_only=True), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(installments[1].amount_remaining, 0)
+
+    def test_rebuild_command(self):
+        self.loanshare.add_payment(300, 'PAYMENT10', date(2023, 1, 9))
+        Installment.objects.filter(loanshare=self.loanshare).update(amount_paid=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_installment_balances', '--verify-only', stdout=StringIO(), stderr=StringIO())
+
+        call_command('rebuild_installment_balances', stdout=StringIO(), stderr=StringIO())
+        installments = Installment.objects.filter(loanshare=self.loanshare).order_by('order')
+        self.assertEqual([i.amount_paid for i in installments], [250, 50, 0, 0])
+        self.assertEqual(Installment.rebuild_balances(verify_only=True), [])
+
+class LoanListingTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy5', password='testpass')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_loans(self, count):
+        loans = []
+        for n in range(count):
+            loan = Loan.create_loan({'amount': 1000 + n, 'tenure': 6, 'interest': 0, 'processing_fee': 0}, self.user)
+            if n % 3 == 0:
+                loan.approve_loan(date(2023, 1, 2))
+            elif n % 3 == 1:
+                loan.status = LoanStatus.REJECTED.name
+                loan.save()
+            loans.append(loan)
+        return loans
+
+    def get_listing(self, **params):
+        response = self.client.get(reverse('loan_view'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_keyset_pagination(self):
+        self.create_loans(7)
+        expected = [loan['id'] for loan in self.get_listing()]
+        ids = []
+        params = {'limit': 3}
+        while True:
+            response = self.client.get(reverse('loan_view'), params)
+            ids.extend(loan['id'] for loan in response.data)
+            if 'X-Next-Cursor' not in response:
+                break
+            self.assertIn('rel="next"', response['Link'])
+            params = {'limit': 3, 'cursor': response['X-Next-Cursor']}
+
+        self.assertEqual(ids, expected)
+
+    def test_listing_filters(self):
+        loans = self.create_loans(6)
+        Loan.objects.filter(pk=loans[3].pk).update(date_created=date(2022, 1, 1))
+        data = self.get_listing(status='APPROVED,REJECTED', date_from='2023-01-01')
+        self.assertEqual([loan['status'] for loan in data], [LoanStatus.APPROVED.name, LoanStatus.REJECTED.name, LoanStatus.REJECTED.name])
+
+        with self.assertNumQueries(1):
+            data = self.get_listing(fields='id,status', include_emis='false')
+        self.assertEqual(set(data[0].keys()), {'id', 'status'})
+
+        for params in [{'status': 'UNKNOWN'}, {'cursor': 'not-a-cursor'}, {'limit': 0}, {'date_from': '01-01-2023'}, {'fields': 'interest'}]:
+            self.assertEqual(self.client.get(reverse('loan_view'), params).status_code, 400)
+
+        # well formed cursors with values out of range
+        for cursor in [[0, 10 ** 20], [0, 0], [-1, 1], [9, 1], [True, 1], [0, False], [0, '1']]:
+            self.assertEqual(self.client.get(reverse('loan_view'), {'cursor': encode_cursor(cursor)}).status_code, 400)
+
+    def test_listing_order(self):
+        self.create_loans(6)
+        statuses = [loan['status'] for loan in self.get_listing()]
+        self.assertEqual(statuses, [LoanStatus.APPROVED.name] * 2 + [LoanStatus.PENDING.name] * 2 + [LoanStatus.REJECTED.name] * 2)
+
+    def test_listing_query_count_is_constant(self):
+        self.create_loans(1)
+        with self.assertNumQueries(3):
+            self.assertEqual(len(self.get_listing()), 1)
+
+        self.create_loans(9)
+        with self.assertNumQueries(3):
+            data = self.get_listing()
+
+        self.assertEqual(len(data), 10)
+        self.assertEqual(len(data[0]['emis'][0]['emis']), 6)
+        self.assertEqual(data[0]['emis'][0]['user'], self.user.username)
+
+class BatchApprovalTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy6', password='testpass')
+        self.staff = User.objects.create_user(username='staff1', password='testpass', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+        self.loans = [
+            Loan.create_loan({'amount': 1000, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, self.user)
+            for _ in range(5)
+        ]
+
+    def test_batch_approval(self):
+        self.loans[1].approve_loan(date(2023, 1, 2))
+        loan_ids = [loan.id for loan in self.loans] + [0]
+        response = self.client.post(
+            reverse('batch_approve_loan_view'),
+            {'loan_ids': loan_ids, 'approval_date': '2023-02-01'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['approved'], 4)
+        self.assertEqual(response.data['failed'], 2)
+        results = {r['loan_id']: r for r in response.data['results']}
+        self.assertFalse(results[self.loans[1].id]['approved'])
+        self.assertFalse(results[0]['approved'])
+        for loan in [self.loans[0]] + self.loans[2:]:
+            self.assertTrue(results[loan.id]['approved'])
+            loan.refresh_from_db()
+            self.assertEqual(loan.status, LoanStatus.APPROVED.name)
+            self.assertEqual(loan.approval_date, date(2023, 2, 1))
+            installments = Installment.objects.filter(loanshare__loan=loan, loanshare__status=LoanStatus.APPROVED.name)
+            self.assertEqual(installments.count(), 4)
+
+    def test_batch_approval_chunks_and_validation(self):
+        results = Loan.approve_loans([loan.id for loan in self.loans], date(2023, 2, 1), chunk_size=2)
+        self.assertEqual(list(results.values()), [None] * 5)
+        self.assertEqual(Installment.objects.count(), 20)
+
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.post(reverse('batch_approve_loan_view'), {'loan_ids': [1]}, format='json').status_code, 403)
+        self.client.force_authenticate(self.staff)
+        for data in [{}, {'loan_ids': []}, {'loan_ids': ['a']}, {'loan_ids': [1], 'approval_date': '2023/01/01'}]:
+            self.assertEqual(self.client.post(reverse('batch_approve_loan_view'), data, format='json').status_code, 400)
+
+class ScheduleEngineTestCase(SimpleTestCase):
+    def test_matches_legacy_loop(self):
+        rng = random.Random(7)
+        loanshares = []
+        for n in range(300):
+            loan = Loan(
+                tenure=rng.randint(1, 60),
+                periodicity=rng.choice(['daily', 'weekly', 'monthly']),
+                interest=Decimal(str(rng.choice([0, 0.26, 0.33333]))),
+                processing_fee=Decimal(str(rng.choice([0, 0.02, 0.01234]))),
+            )
+            loanshares.append(LoanShare(id=n, loan=loan, share=Decimal(str(round(rng.uniform(1, 10 ** 6), 5)))))
+
+        for start_date in [date(2023, 1, 31), date(2024, 2, 29), date(2023, 6, 15)]:
+            schedules = emi_schedules(loanshares, start_date)
+            for ls in loanshares:
+                self.assertEqual(schedules[ls.id], legacy_calculate_emis(ls, start_date))
+
+    def test_invalid_periodicity(self):
+        ls = LoanShare(id=1, share=Decimal(100), loan=Loan(tenure=2, periodicity='yearly', interest=Decimal(0), processing_fee=Decimal(0)))
+        with self.assertRaises(errors.InvalidPeriodicity):
+            emi_schedules([ls], date(2023, 1, 1))
+
+class EmiPreviewCacheTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy7', password='testpass')
+
+    def create_loan(self, amount):
+        return Loan.create_loan({'amount': amount, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, self.user)
+
+    @override_settings(EMI_PREVIEW_CACHE={'BACKEND': 'loan.cache.LRUCacheBackend', 'MAX_SIZE': 2})
+    def test_hits_misses_and_eviction(self):
+        loans = [self.create_loan(amount) for amount in [1000, 2000, 3000]]
+        cache = emi_preview_cache()
+        first = loans[0].emi_schedule()
+        self.assertEqual(loans[0].emi_schedule(), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        first[0]['emis'][0]['status'] = 'CHANGED'
+        self.assertEqual(loans[0].emi_schedule()[0]['emis'][0]['status'], 'NOT_STARTED')
+
+        loans[1].emi_schedule()
+        loans[2].emi_schedule()
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 2)
+        loans[0].emi_schedule()
+        self.assertEqual(cache.misses, 4)
+
+    @override_settings(
+        EMI_PREVIEW_CACHE={'BACKEND': 'loan.cache.DjangoCacheBackend', 'ALIAS': 'default'},
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    )
+    def test_django_cache_backend_and_invalidation(self):
+        loan = self.create_loan(1000)
+        loanshare = LoanShare.objects.get(loan=loan)
+        cache = emi_preview_cache()
+        preview = loan.emi_schedule()
+        loan.emi_schedule()
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.stats()['size'], None)
+        self.assertIsNotNone(cache.backend.get(cache.key(loanshare, date.today())))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            loan.approve_loan(date.today())
+        self.assertIsNone(cache.backend.get(cache.key(loanshare, date.today())))
+        self.assertEqual(len(loan.emi_schedule()[0]['emis']), len(preview[0]['emis']))
+
+class PaymentAllocationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy8', password='testpass')
+
+    def create_loanshare(self, tenure=6):
+        loan = Loan.create_loan({'amount': 1200, 'tenure': tenure, 'interest': 0, 'processing_fee': 0}, self.user)
+        loan.approve_loan(date(2023, 1, 2))
+        return LoanShare.objects.get(loan=loan)
+
+    # late installments with penalty, partial, backdated, penalty and extra payments
+    def run_payments(self, add_payment, prefix):
+        loanshare = self.create_loanshare()
+        installments = list(Installment.objects.filter(loanshare=loanshare).order_by('order'))
+        for i in installments[:3]:
+            i.update_penalty(final_date=date(2023, 2, 10), penalty_multiplier=0.01)
+
+        payments = [
+            (150, date(2023, 1, 12)),
+            (330, date(2023, 2, 1)),
+            (30, date(2023, 2, 10)),
+            (300, date(2023, 2, 12)),
+            (700, date(2023, 3, 1)),
+        ]
+        for n, (amount, payment_date) in enumerate(payments):
+            add_payment(loanshare, amount, f'{prefix}{n}', payment_date)
+
+        details = list(InstallmentDetail.objects.filter(loan_repayment__loanshare=loanshare).order_by('loan_repayment_id', 'installment__order'))
+        installments = Installment.objects.filter(loanshare=loanshare).order_by('order')
+        # paid amounts from the ledger, the baseline does not keep the running totals on installment
+        ledger = {i.pk: (0, 0) for i in installments}
+        for d in details:
+            amount, penalty = ledger[d.installment_id]
+            ledger[d.installment_id] = (amount + d.amount, penalty + d.penalty)
+        return (
+            [(d.loan_repayment.payment[len(prefix):], d.installment.order, d.amount, d.penalty) for d in details],
+            [(i.status, *ledger[i.pk], i.penalty) for i in installments],
+            [(i.amount_paid, i.penalty_paid) == ledger[i.pk] for i in installments],
+        )
+
+    def test_matches_per_installment_allocation(self):
+        details, installments, _ = self.run_payments(legacy_add_payment, 'LEGACY')
+        for prefix, storage in [('SINGLE', 'DAILY'), ('SEGMENT', 'SEGMENT')]:
+            with override_settings(PENALTY_STORAGE=storage):
+                result = self.run_payments(LoanShare.add_payment, prefix)
+            self.assertEqual(result[:2], (details, installments))
+            self.assertTrue(all(result[2]))
+
+    def test_query_count_is_bounded(self):
+        queries = []
+        for installments_paid in [1, 5]:
+            loanshare = self.create_loanshare(tenure=12)
+            with CaptureQueriesContext(connection) as captured:
+                loanshare.add_payment(100 * installments_paid, f'PAYMENT11.{installments_paid}', date(2023, 1, 5))
+            queries.append(len(captured))
+            self.assertEqual(Installment.objects.filter(loanshare=loanshare, status=InstallmentStatus.PAID.name).count(), installments_paid)
+
+        self.assertEqual(queries[0], queries[1])
+
+class PaymentIngestionTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy9', password='testpass')
+        self.staff = User.objects.create_user(username='staff9', password='testpass', is_staff=True)
+        self.loanshares = []
+        for n in range(2):
+            loan = Loan.create_loan({'amount': 400, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, self.user)
+            loan.approve_loan(date(2023, 1, 2))
+            self.loanshares.append(LoanShare.objects.get(loan=loan))
+        self.client = APIClient()
+
+    def rows(self):
+        first, second = self.loanshares
+        return [
+            {'loan_id': first.id, 'payment_id': 'BANK2', 'amount': '100', 'payment_date': '2023-02-09'},
+            {'loan_id': second.id, 'payment_id': 'BANK3', 'amount': '400', 'payment_date': '2023-01-05'},
+            {'loan_id': first.id, 'payment_id': 'BANK1', 'amount': '100', 'payment_date': '2023-01-09'},
+            {'loan_id': first.id, 'payment_id': 'BANK1', 'amount': '100', 'payment_date': '2023-01-09'},
+            {'loan_id': 0, 'payment_id': 'BANK4', 'amount': '100'},
+            {'loan_id': first.id, 'payment_id': 'BANK5', 'amount': '-1'},
+            {'loan_id': second.id, 'payment_id': 'BANK6', 'amount': '100', 'payment_date': '2023/01/06'},
+        ]
+
+    def test_ingest_payments(self):
+        # BANK1 is dated before BANK2 but comes after it in a later batch
+        results = list(ingest_payments(enumerate(self.rows(), start=1), batch_size=2))
+        self.assertEqual(
+            [r['status'] for r in results],
+            ['applied', 'applied', 'applied', 'duplicate', 'failed', 'failed', 'failed']
+        )
+        self.assertIn('invalid loan id', results[4]['error'])
+
+        # payments of a loanshare are applied in payment date order
+        first, second = self.loanshares
+        installments = Installment.objects.filter(loanshare=first).order_by('order')
+        self.assertEqual([i.status for i in installments[:2]], [InstallmentStatus.PAID.name] * 2)
+        first_installment = InstallmentDetail.objects.get(installment=installments[0])
+        self.assertEqual(first_installment.loan_repayment.payment, 'BANK1')
+        second.refresh_from_db()
+        self.assertEqual(second.status, LoanStatus.COMPLETED.name)
+
+        # ingesting the same file again is a no-op
+        results = list(ingest_payments(enumerate(self.rows(), start=1)))
+        self.assertEqual([r['status'] for r in results][:4], ['duplicate'] * 4)
+        self.assertEqual(InstallmentDetail.objects.filter(installment__loanshare=first).count(), 2)
+
+    def test_duplicate_detection(self):
+        rows = list(enumerate(self.rows()[:3], start=1))
+        list(ingest_payments(rows))
+
+        # a payment id recorded after the batch was read fails full_clean and is still a duplicate
+        with mock.patch('loan.ingestion.recorded_payments', return_value=set()):
+            results = list(ingest_payments(rows))
+        self.assertEqual([r['status'] for r in results], ['duplicate'] * 3)
+
+        # other integrity errors are failures
+        rows = [(1, {'loan_id': self.loanshares[0].id, 'payment_id': 'BANK8', 'amount': '100'})]
+        with mock.patch.object(LoanShare, 'add_payment', side_effect=IntegrityError('CHECK constraint failed')):
+            results = list(ingest_payments(rows))
+        self.assertEqual((results[0]['status'], results[0]['error']), ('failed', 'CHECK constraint failed'))
+
+    def test_bulk_payment_endpoint(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.post(reverse('bulk_add_payment_view'), {'payments': self.rows()}, format='json').status_code, 403)
+
+        self.client.force_authenticate(self.staff)
+        self.assertEqual(self.client.post(reverse('bulk_add_payment_view'), {'payments': []}, format='json').status_code, 400)
+        response = self.client.post(reverse('bulk_add_payment_view'), {'payments': self.rows()}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['applied'], response.data['duplicate'], response.data['failed']), (3, 1, 3))
+
+        upload = StringIO('loan_id,payment_id,amount,payment_date\n%s,BANK7,100,2023-03-09\n' % self.loanshares[0].id)
+        upload.name = 'payments.csv'
+        response = self.client.post(reverse('bulk_add_payment_view'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0], {'line': 2, 'payment_id': 'BANK7', 'status': 'applied', 'error': None})
+
+    def test_bulk_payment_rows_should_be_objects(self):
+        self.client.force_authenticate(self.staff)
+        response = self.client.post(reverse('bulk_add_payment_view'), {'payments': [1, 'x', None, self.rows()[0]]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in response.data['results']], ['failed'] * 3 + ['applied'])
+        self.assertEqual(response.data['results'][0]['error'], "row should be a json object")
+
+        response = self.client.post(reverse('bulk_add_payment_view'), self.rows(), format='json')
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('loan.views.MAX_BULK_PAYMENTS', 2)
+    def test_bulk_payment_limit(self):
+        self.client.force_authenticate(self.staff)
+        upload = StringIO('loan_id,payment_id,amount\n' + ''.join('%s,BANK%s,10\n' % (self.loanshares[0].id, n) for n in range(3)))
+        upload.name = 'payments.csv'
+        response = self.client.post(reverse('bulk_add_payment_view'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('at most 2 payments', str(response.data))
+        self.assertFalse(InstallmentDetail.objects.exists())
+
+        # the rows are not read past the limit
+        endless = ((line, {}) for line in itertools.count(1))
+        with self.assertRaises(errors.InvalidBulkPayment):
+            list(BulkAddPayment().limited_rows(endless))
+        self.assertEqual(next(endless)[0], 4)
+
+    def test_ingest_payments_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'payments.jsonl')
+            with open(path, 'w') as f:
+                for row in self.rows():
+                    f.write(json.dumps(row) + '\n')
+                f.write('not json\n')
+
+            report = os.path.join(directory, 'report.jsonl')
+            out = StringIO()
+            call_command('ingest_payments', path, '--report', report, stdout=out, stderr=StringIO())
+            self.assertIn('3 payments applied, 1 duplicates skipped, 4 failed', out.getvalue())
+            with open(report) as f:
+                self.assertEqual(len(f.readlines()), 8)
+
+            with self.assertRaises(CommandError):
+                call_command('ingest_payments', os.path.join(directory, 'payments.txt'))
+
+class PenaltyAccrualTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy10', password='testpass')
+
+    # closed form against adding the daily penalty once per day
+    def test_matches_daily_addition(self):
+        rng = random.Random(14)
+        for _ in range(500):
+            balance = Decimal(rng.randint(1, 10 ** 9)) / 100
+            multiplier = rng.choice([None, 0.001, 0.01, 0.0375, rng.random() / 10])
+            last_date = date(2023, 1, 1) + timedelta(days=rng.randint(0, 400))
+            last_amount = Decimal(rng.randint(0, 10 ** 7)) / 1000
+            final_date = last_date + timedelta(days=rng.randint(1, 200))
+
+            accrual = accrue(balance, last_date, last_amount, final_date, multiplier)
+            penalty_amount = Penalty.compute_penalty(balance, multiplier)
+            expected = []
+            amount = last_amount
+            day = last_date
+            while day < final_date:
+                day += timedelta(days=1)
+                amount += penalty_amount
+                expected.append((day, amount))
+
+            self.assertEqual(list(accrual.daily_amounts()), expected)
+            self.assertEqual(accrual.amount, amount)
+            probe = last_date + timedelta(days=rng.randint(0, accrual.days))
+            self.assertEqual(accrual.amount_on(probe), dict(expected).get(probe, last_amount))
+
+        self.assertIsNone(accrue(0, date(2023, 1, 1), 0, date(2023, 2, 1), None))
+        self.assertIsNone(accrue(100, date(2023, 2, 1), 0, date(2023, 2, 1), None))
+
+    def test_update_penalty_matches_daily_loop(self):
+        rng = random.Random(41)
+        approval_date = date(2023, 1, 2)
+        results = []
+        for update_penalty in [legacy_update_penalty, Installment.update_penalty]:
+            rng.seed(41)
+            rows = []
+            for n in range(8):
+                loan = Loan.create_loan({
+                    'amount': rng.randint(100, 100000), 'tenure': 4, 'interest': 0, 'processing_fee': 0
+                }, self.user)
+                loan.approve_loan(approval_date)
+                loanshare = LoanShare.objects.get(loan=loan)
+                installments = list(Installment.objects.filter(loanshare=loanshare).order_by('order'))
+                final_date = approval_date
+                for run in range(3):
+                    final_date += timedelta(days=rng.randint(1, 60))
+                    multiplier = rng.choice([None, 0.01])
+                    for i in installments:
+                        i.refresh_from_db()
+                        update_penalty(i, final_date, multiplier)
+                    if rng.random() < 0.5:
+                        loanshare.add_payment(rng.randint(1, 500), f'ACCRUAL{len(results)}.{n}.{run}', final_date)
+
+                rows.append([
+                    list(Penalty.objects.filter(installment=i).order_by('date').values_list('date', 'amount'))
+                    for i in installments
+                ])
+            results.append(rows)
+
+        self.assertTrue(any(penalties for rows in results[1] for penalties in rows))
+        self.assertEqual(results[0], results[1])
+
+class PenaltyCorrectionTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dummy11', password='testpass')
+        loan = Loan.create_loan({'amount': 1000, 'tenure': 2, 'interest': 0, 'processing_fee': 0}, self.user)
+        loan.approve_loan(date(2023, 1, 2))
+        self.installment = Installment.objects.get(loanshare__loan=loan, order=1)
+        self.payment_date = self.installment.due_date + timedelta(days=10)
+        self.final_date = self.installment.due_date + timedelta(days=200)
+
+    def backdated_payment(self):
+        self.installment.update_penalty(final_date=self.final_date, penalty_multiplier=0.01)
+        Installment.objects.filter(pk=self.installment.pk).update(amount_paid=100)
+        self.installment.refresh_from_db()
+
+    def test_correction_is_batched_and_skipped_when_unchanged(self):
+        self.backdated_payment()
+        expected = self.installment.penalty_on(self.payment_date)
+        with CaptureQueriesContext(connection) as captured:
+            touched = Penalty.modify_penalty_after(self.installment, self.payment_date)
+        self.assertEqual(touched, 190)
+        self.assertLessEqual(len(captured), 5)
+
+        daily_penalty = Penalty.compute_penalty(self.installment.amount_remaining, None)
+        amounts = Penalty.objects.filter(installment=self.installment, date__gt=self.payment_date).order_by('date')
+        for n, penalty in enumerate(amounts, start=1):
+            self.assertEqual(penalty.amount, expected + n * daily_penalty)
+        self.installment.refresh_from_db()
+        self.assertEqual(self.installment.penalty_accrued, self.installment.penalty)
+
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(Penalty.modify_penalty_after(self.installment, self.payment_date), 0)
+        self.assertEqual(len(captured), 1)
+
+    # Test case when a backdated payment covering k penalised installments corrects them with the same queries
+    def test_backdated_payment_query_count(self):
+        for storage in ['DAILY', 'SEGMENT']:
+            with override_settings(PENALTY_STORAGE=storage):
+                queries = []
+                for covered in [2, 5]:
+                    loan = Loan.create_loan({'amount': 1200, 'tenure': 6, 'interest': 0, 'processing_fee': 0}, self.user)
+                    loan.approve_loan(date(2023, 1, 2))
+                    loanshare = LoanShare.objects.select_related('loan').get(loan=loan)
+                    installments = list(Installment.objects.filter(loanshare=loanshare).order_by('order'))
+                    for i in installments:
+                        i.update_penalty(final_date=date(2023, 4, 1), penalty_multiplier=0.01)
+
+                    payment_date = installments[covered - 1].due_date + timedelta(days=1)
+                    with CaptureQueriesContext(connection) as captured:
+                        loanshare.add_payment(200 * covered, f'BACKDATED-{storage}-{covered}', payment_date)
+                    queries.append(len(captured))
+
+                    for i in Installment.objects.filter(loanshare=loanshare, order__lte=covered):
+                        self.assertEqual(i.penalty_accrued, i.penalty)
+                        self.assertEqual(i.penalty, i.penalty_on(payment_date))
+
+                self.assertEqual(queries[0], queries[1])
+
+    def test_segment_correction_is_skipped_when_unchanged(self):
+        with override_settings(PENALTY_STORAGE='SEGMENT'):
+            self.backdated_payment()
+            self.assertEqual(Penalty.modify_penalty_after(self.installment, self.payment_date), 2)
+            self.assertEqual(PenaltySegment.objects.filter(installment=self.installment).count(), 2)
+            self.assertEqual(Penalty.modify_penalty_after(self.installment, self.payment_date), 0)
+
+# select_for_update only locks on a server database, sqlite serializes the whole database instead
+@skipUnless(connection.vendor == 'postgresql', "concurrent payments need a database with row locks")
+class ConcurrentPaymentTestCase(TransactionTestCase):
+    def test_concurrent_payments_are_allocated_once(self):
+        user = User.objects.create_user(username='dummy12', password='testpass')
+        loan = Loan.create_loan({'amount': 2400, 'tenure': 12, 'interest': 0, 'processing_fee': 0}, user)
+        loan.approve_loan(date(2023, 1, 2))
+        loanshare_id = LoanShare.objects.get(loan=loan).id
+        errors_raised = []
+
+        def pay(n):
+            try:
+                LoanShare.objects.get(id=loanshare_id).add_payment(150, f'CONCURRENT{n}', date(2023, 1, 5))
+            except Exception as e:
+                errors_raised.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=pay, args=(n,)) for n in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors_raised, [])
+        self.assertEqual(Installment.rebuild_balances(verify_only=True), [])
+        installments = Installment.objects.filter(loanshare_id=loanshare_id)
+        self.assertEqual(sum(i.amount_paid for i in installments), 1800)
+        self.assertTrue(all(i.amount_paid <= i.suggested_emi for i in installments))
+        self.assertEqual(installments.filter(status=InstallmentStatus.PAID.name).count(), 9)
+
+# worker processes open their own connections, they only see committed data of a server database
+@skipUnless(connection.vendor == 'postgresql', "penalty worker processes need a database that allows concurrent writers")
+class ParallelPenaltyRunnerTestCase(TransactionTestCase):
+    def test_worker_processes_match_single_process(self):
+        user = User.objects.create_user(username='dummy26', password='testpass')
+        for amount in [1000, 2500, 4000, 5500]:
+            loan = Loan.create_loan({'amount': amount, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, user)
+            loan.approve_loan(date(2023, 1, 2))
+        final_date = date(2023, 3, 1)
+
+        expected = ParallelPenaltyRunner(final_date=final_date, penalty_multiplier=0.01, dry_run=True).run()
+        summary = ParallelPenaltyRunner(final_date=final_date, penalty_multiplier=0.01, workers=2, shards=4).run()
+        self.assertEqual(summary['workers'], 2)
+        self.assertEqual(summary['failed_shards'], [])
+        self.assertEqual(len(summary['shards']), 4)
+        self.assertEqual(summary['rows_written'], expected['rows_written'])
+        self.assertEqual(Penalty.objects.count(), expected['rows_written'])
+        self.assertEqual(BulkPenaltyEngine(final_date=final_date, penalty_multiplier=0.01).run().rows_written, 0)
+
+class QueryPlanTestCase(TestCase):
+    def test_hot_queries_use_their_indexes(self):
+        for row in explain_hot_queries():
+            if row['expected']:
+                self.assertTrue(row['uses_index'], row)
+
+        out = StringIO()
+        call_command('explain_queries', stdout=out)
+        self.assertIn('uses penalty_installment_date_idx', out.getvalue())
+
+class SQLitePerformanceModeTestCase(SimpleTestCase):
+    def get_wrapper(self, name, options=None):
+        from lib.sqlite.base import DatabaseWrapper
+        settings_dict = connections.configure_settings({
+            'default': {'ENGINE': 'lib.sqlite', 'NAME': name, 'OPTIONS': options or {}}
+        })['default']
+        wrapper = DatabaseWrapper(settings_dict, 'sqlite_test')
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_pragmas_and_immediate_transactions(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, 'performance.sqlite3')
+            writer = self.get_wrapper(name)
+            with writer.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                self.assertEqual(cursor.fetchone()[0], 'wal')
+                cursor.execute("PRAGMA synchronous")
+                self.assertEqual(cursor.fetchone()[0], 1)
+                cursor.execute("CREATE TABLE t (id integer)")
+
+            # the write lock is taken when the transaction starts, before any statement ran
+            other = self.get_wrapper(name, {'pragmas': {'busy_timeout': 0}})
+            writer._start_transaction_under_autocommit()
+            other.ensure_connection()
+            with self.assertRaisesMessage(OperationalError, 'database is locked'):
+                other._start_transaction_under_autocommit()
+            writer.cursor().execute("ROLLBACK")
+
+class AdminTestCase(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', password='testpass')
+        self.client.force_login(self.admin)
+
+    def create_loans(self, count, tenure=4):
+        start = Loan.objects.count()
+        for n in range(start, start + count):
+            user = User.objects.create_user(username=f'admin-borrower-{tenure}-{n}', password='testpass')
+            loan = Loan.create_loan({'amount': 1000, 'tenure': tenure, 'interest': 0, 'processing_fee': 0}, user)
+            loan.approve_loan(date(2023, 1, 1))
+            loan.loanshare_set.get().add_payment(100, f'ADMIN{tenure}-{n}', date(2023, 1, 5))
+
+    def changelist_queries(self, view):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse(view))
+        self.assertEqual(response.status_code, 200)
+        return len(captured)
+
+    # Test case when the changelist query count does not grow with the rows on the page
+    def test_changelist_query_count(self):
+        self.create_loans(2)
+        queries = [self.changelist_queries('admin:loan_loan_changelist'), self.changelist_queries('admin:loan_installment_changelist')]
+        self.create_loans(10)
+        self.assertEqual(self.changelist_queries('admin:loan_loan_changelist'), queries[0])
+        self.assertEqual(self.changelist_queries('admin:loan_installment_changelist'), queries[1])
+
+        response = self.client.get(reverse('admin:loan_loan_changelist'))
+        self.assertContains(response, 'admin-borrower-4-11')
+        self.assertContains(response, '<td class="field-outstanding_balance">900.00000</td>', html=True)
+
+    # Test case when the installment inline shows one page of installments
+    def test_installment_inline_pagination(self):
+        self.create_loans(1, tenure=60)
+        loanshare = LoanShare.objects.get()
+        url = reverse('admin:loan_loanshare_change', args=[loanshare.id])
+        response = self.client.get(url)
+        self.assertEqual(response.context['inline_admin_formsets'][0].formset.initial_form_count(), 25)
+        self.assertContains(response, 'Installments 1 - 25 of 60')
+
+        response = self.client.get(url, {'installment_page': 3})
+        orders = [form.instance.order for form in response.context['inline_admin_formsets'][0].formset.forms]
+        self.assertEqual(orders, list(range(51, 61)))
+
+        response = self.client.get(reverse('admin:loan_loan_change', args=[loanshare.loan_id]))
+        self.assertContains(response, 'all installments of admin-borrower-60-0')
+
+class SyntheticDataTestCase(TestCase):
+    def test_seed_is_repeatable(self):
+        schedules = []
+        for prefix in ['first', 'second']:
+            data = seed_loans(3, 2, max_tenure=6, seed=7, prefix=prefix)
+            self.assertEqual(len(data['loanshares']), 6)
+            self.assertTrue(all(ls.status == LoanStatus.APPROVED.name for ls in data['loanshares']))
+            schedules.append([
+                list(Installment.objects.filter(loanshare=ls).order_by('order').values_list('due_date', 'suggested_emi'))
+                for ls in data['loanshares']
+            ])
+
+        self.assertEqual(schedules[0], schedules[1])
+
+class RequestInstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='instrumented', password='testpass')
+        for _ in range(3):
+            Loan.create_loan({'amount': 1000, 'tenure': 4}, self.user)
+
+    def get_loans(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as captured:
+            response = client.get(reverse('loan_view'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(captured)
+
+    @override_settings(REQUEST_INSTRUMENTATION={'ENABLED': True, 'SAMPLE_RATE': 1})
+    def test_server_timing_and_log_line(self):
+        with self.assertLogs('lib.instrumentation', 'INFO') as logs:
+            response, queries = self.get_loans()
+
+        self.assertIn(f'queries;desc="{queries}"', response['Server-Timing'])
+        self.assertRegex(response['Server-Timing'], r'total;dur=[\d.]+, db;dur=[\d.]+')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['view'], record['status'], record['queries']), ('loan_view', 200, queries))
+        self.assertEqual(record['duplicate_queries'], 0)
+
+    def test_disabled_and_unsampled_requests(self):
+        for config in [{'ENABLED': False}, {'ENABLED': True, 'SAMPLE_RATE': 0}]:
+            with override_settings(REQUEST_INSTRUMENTATION=config):
+                response, queries = self.get_loans()
+                self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_duplicate_queries(self):
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            for loan in Loan.objects.all():
+                list(LoanShare.objects.filter(loan=loan))
+            list(LoanShare.objects.filter(loan=loan))
+
+        self.assertEqual((recorder.queries, recorder.duplicates, recorder.similar), (5, 1, 3))
+
+class MetricsTestCase(TestCase):
+    SAMPLES = [
+        ('loan_loans_created_total', None),
+        ('loan_loans_approved_total', None),
+        ('loan_payments_applied_total', None),
+        ('loan_amount_allocated_total', {'allocation': 'principal'}),
+        ('loan_amount_allocated_total', {'allocation': 'penalty'}),
+        ('loan_penalty_rows_written_total', None),
+        ('loan_penalty_cron_duration_seconds_count', None),
+    ]
+
+    def samples(self):
+        return [REGISTRY.get_sample_value(name, labels) or 0 for name, labels in self.SAMPLES]
+
+    def test_operations_are_counted_on_commit(self):
+        user = User.objects.create_user(username='metrics', password='testpass')
+        before = self.samples()
+        with self.captureOnCommitCallbacks(execute=True):
+            loan = Loan.create_loan({'amount': 1000, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, user)
+        with self.captureOnCommitCallbacks(execute=True):
+            loan.approve_loan(date(2023, 1, 1))
+        loanshare = LoanShare.objects.get(loan=loan)
+        report = tasks.update_penalty(final_date=date(2023, 1, 20), penalty_multiplier=0.01)
+        penalty = sum(i.penalty for i in Installment.objects.filter(loanshare=loanshare))
+        with self.captureOnCommitCallbacks(execute=True):
+            loanshare.add_payment(600, 'METRICS1', date(2023, 1, 20))
+        with self.assertRaises(errors.InvalidPayment), self.captureOnCommitCallbacks(execute=True):
+            try:
+                loanshare.add_payment(10, 'METRICS1', date(2023, 1, 20))
+            except Exception as e:
+                raise errors.InvalidPayment(e)
+        with self.captureOnCommitCallbacks(execute=True):
+            loanshare.add_payment(400 + penalty, 'METRICS2', date(2023, 1, 20))
+
+        delta = [after - earlier for after, earlier in zip(self.samples(), before)]
+        self.assertEqual(delta[:3], [1, 1, 2])
+        self.assertAlmostEqual(delta[3], 1000)
+        self.assertGreater(penalty, 0)
+        self.assertAlmostEqual(delta[4], float(penalty), places=5)
+        self.assertEqual(delta[5:], [report.rows_written, 1])
+
+    @override_settings(METRICS_TOKEN='scraper-token')
+    def test_metrics_endpoint_needs_token_or_staff(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scraper-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'loan_payments_applied_total', response.content)
+
+        user = User.objects.create_user(username='metrics3', password='testpass')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+        # without a configured token no authorization header is accepted
+        self.client.logout()
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+
+    def test_penalty_command_is_counted(self):
+        user = User.objects.create_user(username='metrics2', password='testpass')
+        loan = Loan.create_loan({'amount': 1000, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, user)
+        loan.approve_loan(date(2023, 1, 1))
+        loanshare = LoanShare.objects.get(loan=loan)
+
+        before = self.samples()
+        call_command('update_penalty', '--date', '2023-01-20', '--multiplier', '0.01', stdout=StringIO())
+        rows_written = Penalty.objects.count()
+        call_command(
+            'update_penalty', '--date', '2023-01-25', '--multiplier', '0.01',
+            '--loanshares', str(loanshare.id), str(loanshare.id), stdout=StringIO()
+        )
+        call_command('update_penalty', '--date', '2023-01-30', '--dry-run', stdout=StringIO())
+
+        delta = [after - earlier for after, earlier in zip(self.samples(), before)]
+        self.assertGreater(rows_written, 0)
+        self.assertEqual(delta[5:], [Penalty.objects.count(), 2])
+
+@override_settings(ROOT_URLCONF='loan_backend.async_urls')
+class AsyncLoanViewTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='async', password='testpass')
+        self.other = User.objects.create_user(username='async-other', password='testpass')
+        for tenure in [4, 6, 8]:
+            Loan.create_loan({'amount': 1000, 'tenure': tenure}, self.user)
+        Loan.objects.order_by('id').first().approve_loan(date(2023, 1, 1))
+        self.other_loan = Loan.create_loan({'amount': 1000, 'tenure': 4}, self.other)
+        self.headers = {'AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def sync_response(self, url, params=None):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with override_settings(ROOT_URLCONF='loan_backend.urls'):
+            return client.get(url, params)
+
+    async def test_listing_matches_sync_view(self):
+        url = reverse('loan_view')
+        for params in [{}, {'limit': 2}, {'status': 'APPROVED', 'include_emis': 'false'}]:
+            response = await self.async_client.get(url, params, headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            expected = await sync_to_async(self.sync_response)(url, params)
+            self.assertEqual(response.json(), expected.json())
+            self.assertEqual(response.get('X-Next-Cursor'), expected.get('X-Next-Cursor'))
+
+    async def test_loan_detail(self):
+        loan = await Loan.objects.filter(loanshare__user=self.user, status=LoanStatus.APPROVED.name).afirst()
+        response = await self.async_client.get(reverse('loan_detail_view', args=[loan.id]), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        expected = await sync_to_async(self.sync_response)(reverse('loan_detail_view', args=[loan.id]))
+        self.assertEqual(response.json(), expected.json())
+        self.assertEqual(len(response.json()['emis'][0]['emis']), 4)
+
+        response = await self.async_client.get(reverse('loan_detail_view', args=[self.other_loan.id]), headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+        response = await self.async_client.get(reverse('loan_detail_view', args=[loan.id]))
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('Bearer', response['WWW-Authenticate'])
+
+    async def test_create_loan_through_sync_view(self):
+        response = await self.async_client.post(
+            reverse('loan_view'), {'amount': 500, 'tenure': 2}, content_type='application/json', headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(await Loan.objects.filter(loanshare__user=self.user).acount(), 4)
+
+class LoanDetailTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='detail', password='testpass')
+        self.loan = Loan.create_loan({'amount': 1000, 'tenure': 4, 'interest': 0, 'processing_fee': 0}, self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('loan_detail_view', args=[self.loan.id])
+
+    def get(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(self.url, **headers)
+
+    # Test case when the loan is served again only after it changed
+    def test_conditional_get(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], self.loan.id)
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.get(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        etags = [etag]
+        self.loan.approve_loan(date(2023, 1, 1))
+        loanshare = LoanShare.objects.get(loan=self.loan)
+        installment = Installment.objects.get(loanshare=loanshare, order=1)
+        for change in [
+            lambda: installment.update_penalty(final_date=date(2023, 1, 12), penalty_multiplier=0.01),
+            lambda: loanshare.add_payment(100, 'DETAIL1', date(2023, 1, 12)),
+            lambda: loanshare.add_payment(1000, 'DETAIL2', date(2023, 1, 12)),
+        ]:
+            change()
+            response = self.get(etags[-1])
+            self.assertEqual(response.status_code, 200)
+            etags.append(response['ETag'])
+            self.assertEqual(self.get(etags[-1]).status_code, 304)
+
+        self.assertEqual(len(set(etags)), 4)
+        self.assertEqual(response.json()['status'], LoanStatus.COMPLETED.name)
+
+    # Test case when a loan column is edited without a status change
+    def test_edited_loan_is_served_again(self):
+        etag = self.get()['ETag']
+        for field, value in [('amount', 2000), ('tenure', 6), ('periodicity', 'monthly'), ('closing_date', date(2023, 6, 1))]:
+            Loan.objects.filter(pk=self.loan.id).update(**{field: value})
+            response = self.get(etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
+    def test_other_users_loan(self):
+        other = User.objects.create_user(username='detail-other', password='testpass')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.get().status_code, 400)
+
+    @override_settings(ROOT_URLCONF='loan_backend.async_urls')
+    async def test_async_conditional_get(self):
+        headers = {'AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+        response = await self.async_client.get(self.url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        expected = await sync_to_async(self.get)()
+        self.assertEqual(etag, expected['ETag'])
+        response = await self.async_client.get(self.url, headers={**headers, 'IF_NONE_MATCH': etag})
+        self.assertEqual(response.status_code, 304)
@@ -4,6 +4,9 @@ from loan import views
 
 urlpatterns = [
     path('loan/', views.LoanView.as_view(), name='loan_view'),
+    path('loan/<int:loan_id>/', views.LoanDetailView.as_view(), name='loan_detail_view'),
     path('approve/', views.ApproveLoan.as_view(), name='approve_loan_view'),
+    path('approve/batch/', views.BatchApproveLoan.as_view(), name='batch_approve_loan_view'),
     path('add-payment/', views.AddPayment.as_view(), name='add_payment_view'),
+    path('add-payment/bulk/', views.BulkAddPayment.as_view(), name='bulk_add_payment_view'),
 ]
\ No newline at end of file
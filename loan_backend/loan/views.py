@@ -1,12 +1,117 @@
+import csv
+import hashlib
+import io
+import time
 from datetime import date, datetime
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from lib.async_views import AsyncAPIView
+from lib.pagination import encode_cursor, decode_cursor
 from loan import errors
+from loan.ingestion import ingest_payments, payment_row, read_payment_rows, summarize_results
 from loan.models import Loan, LoanShare
 from loan.permissions import IsStaffUser
-from loan_backend.config import LoanStatus, CLOSED_LOAN_STATUS
+from loan_backend.config import LoanStatus, LOAN_LISTING_ORDER
+from loan_backend.constants import MAX_LOAN_PAGE_SIZE, MAX_BATCH_APPROVAL_SIZE, MAX_BULK_PAYMENTS
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-class LoanView(APIView):
+# loan listing shared by the sync and async loan views
+class LoanListingMixin:
+    # approved, pending, completed and then rejected loans, with a fixed number of queries
+    # query params (all optional):
+    #   status - comma separated loan statuses, date_from/date_to - YYYY-MM-DD bounds on date_created
+    #   fields - comma separated loan fields, include_emis=false - skip the emi schedules
+    #   limit/cursor - keyset pagination, the cursor of the next page is returned in X-Next-Cursor header
+    def listing_queryset(self, user, params):
+        loans = Loan.objects.listing(
+            user,
+            statuses=params['statuses'],
+            date_from=params['date_from'],
+            date_to=params['date_to']
+        )
+        if params['cursor']:
+            loans = loans.after(*params['cursor'])
+        if params['include_emis']:
+            loans = loans.with_schedule()
+        if params['limit']:
+            loans = loans[:params['limit'] + 1]
+
+        return loans
+
+    # loans of the page and the cursor of the next page, if any
+    def listing_page(self, loans, params):
+        limit = params['limit']
+        next_cursor = None
+        if limit and len(loans) > limit:
+            loans = loans[:limit]
+            next_cursor = encode_cursor([loans[-1].status_bucket, loans[-1].id])
+
+        return [loan.jsonify(fields=params['fields'], include_emis=params['include_emis']) for loan in loans], next_cursor
+
+    def add_next_page_headers(self, response, request, query, next_cursor):
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+            next_query = query.copy()
+            next_query['cursor'] = next_cursor
+            response['Link'] = f'<{request.build_absolute_uri(request.path)}?{next_query.urlencode()}>; rel="next"'
+
+        return response
+
+    def listing_params(self, query):
+        try:
+            statuses = self.split(query.get('status'))
+            invalid = [s for s in statuses or [] if s not in LoanStatus.__members__]
+            if invalid:
+                raise ValueError(f"unknown status {', '.join(invalid)}")
+
+            fields = self.split(query.get('fields'))
+            invalid = [f for f in fields or [] if f not in Loan.json_fields()]
+            if invalid:
+                raise ValueError(f"unknown field {', '.join(invalid)}")
+
+            include_emis = query.get('include_emis', 'true').lower() not in ['false', '0']
+            if fields is not None:
+                include_emis = include_emis and 'emis' in fields
+
+            limit = None
+            cursor = None
+            if query.get('cursor'):
+                cursor = decode_cursor(query['cursor'], 2)
+                # (listing bucket, loan id), values out of range would only fail in the database
+                if any(isinstance(v, bool) or not isinstance(v, int) for v in cursor):
+                    raise ValueError("malformed cursor")
+                bucket, loan_id = cursor
+                if not 0 <= bucket < len(LOAN_LISTING_ORDER) or not 0 < loan_id < 2 ** 63:
+                    raise ValueError("malformed cursor")
+            if query.get('limit') or cursor:
+                limit = int(query.get('limit', MAX_LOAN_PAGE_SIZE))
+                if limit <= 0 or limit > MAX_LOAN_PAGE_SIZE:
+                    raise ValueError(f"limit should be between 1 and {MAX_LOAN_PAGE_SIZE}")
+
+            return {
+                'statuses': statuses,
+                'date_from': self.parse_date(query.get('date_from')),
+                'date_to': self.parse_date(query.get('date_to')),
+                'fields': fields,
+                'include_emis': include_emis,
+                'limit': limit,
+                'cursor': cursor,
+            }
+        except ValueError as e:
+            raise errors.InvalidListingParams(e)
+
+    def split(self, value):
+        if not value:
+            return None
+        return [v.strip() for v in value.split(',') if v.strip()]
+
+    def parse_date(self, value):
+        if not value:
+            return None
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    
+class LoanView(LoanListingMixin, APIView):
     def post(self, request):
         data = request.data
         user = request.user
@@ -16,21 +121,80 @@ class LoanView(APIView):
             raise errors.LoanInvalidDetails(e)
 
         return Response(loan.jsonify())
-    
+
     def get(self, request):
-        loans = Loan.objects.filter(loanshare__user=request.user)
-        approved_loans = loans.filter(status__in=[LoanStatus.APPROVED.name, LoanStatus.HOLD.name])
-        completed_loans = loans.filter(status__in=CLOSED_LOAN_STATUS)
-        pending_loans = loans.filter(status=LoanStatus.PENDING.name)
-        rejected_loans = loans.filter(status=LoanStatus.REJECTED.name)
-
-        all_loans = []
-        for loans in [approved_loans, pending_loans, completed_loans, rejected_loans]:
-            for loan in loans:
-                all_loans.append(loan.jsonify())
-
-        return Response(all_loans)
-    
+        params = self.listing_params(request.query_params)
+        data, next_cursor = self.listing_page(list(self.listing_queryset(request.user, params)), params)
+        return self.add_next_page_headers(Response(data), request, request.query_params, next_cursor)
+
+# served instead of LoanView under ASGI, the loans are fetched with the async ORM and loan creation
+# is handed to LoanView
+class AsyncLoanView(LoanListingMixin, AsyncAPIView):
+    sync_views = {'post': LoanView.as_view()}
+
+    async def get(self, request):
+        params = self.listing_params(request.GET)
+        loans = [loan async for loan in self.listing_queryset(request.user, params)]
+        data, next_cursor = self.listing_page(loans, params)
+        return self.add_next_page_headers(self.render(data), request, request.GET, next_cursor)
+
+# a loan of the user with its emi schedule, served with an ETag computed from the loan version with
+# one query, so that a client polling with If-None-Match gets 304 without the schedule being built
+class LoanDetailMixin:
+    # every loan column of the payload, interest and processing fee shape the schedule, then what the
+    # installments add to it. status stays first, see etag
+    VERSION_FIELDS = [
+        'status', 'approval_date', 'closing_date', 'amount', 'tenure', 'periodicity', 'interest', 'processing_fee',
+        'date_created', 'last_installment_detail', 'penalty_accrued',
+    ]
+
+    def loan_queryset(self, user, loan_id):
+        return Loan.objects.filter(pk=loan_id, loanshare__user=user).distinct().with_schedule()
+
+    def version_queryset(self, user, loan_id):
+        return Loan.objects.filter(pk=loan_id, loanshare__user=user).with_version().values_list(*self.VERSION_FIELDS)
+
+    def etag(self, version):
+        # schedules of pending loans are previews starting today
+        if version[0] == LoanStatus.PENDING.name:
+            version = version + (date.today(),)
+        return quote_etag(hashlib.sha1(repr(version).encode()).hexdigest())
+
+    def not_modified(self, request, etag):
+        etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        return '*' in etags or etag in etags
+
+    def add_cache_headers(self, response, etag):
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+class LoanDetailView(LoanDetailMixin, APIView):
+    def get(self, request, loan_id):
+        version = self.version_queryset(request.user, loan_id).first()
+        if version is None:
+            raise errors.InvalidLoanID("get loan", loan_id)
+
+        etag = self.etag(version)
+        if self.not_modified(request, etag):
+            return self.add_cache_headers(Response(status=304), etag)
+
+        loan = self.loan_queryset(request.user, loan_id).first()
+        return self.add_cache_headers(Response(loan.jsonify()), etag)
+
+class AsyncLoanDetailView(LoanDetailMixin, AsyncAPIView):
+    async def get(self, request, loan_id):
+        version = await self.version_queryset(request.user, loan_id).afirst()
+        if version is None:
+            raise errors.InvalidLoanID("get loan", loan_id)
+
+        etag = self.etag(version)
+        if self.not_modified(request, etag):
+            return self.add_cache_headers(HttpResponseNotModified(), etag)
+
+        loan = await self.loan_queryset(request.user, loan_id).afirst()
+        return self.add_cache_headers(self.render(loan.jsonify()), etag)
+
 class ApproveLoan(APIView):
     permission_classes=[IsStaffUser]
     def post(self, request):
@@ -43,6 +207,38 @@ class ApproveLoan(APIView):
         loan.approve_loan(data.get('approval_date', date.today()))
         return Response(f"loan {loan.id} approved")
     
+class BatchApproveLoan(APIView):
+    permission_classes=[IsStaffUser]
+    def post(self, request):
+        data = request.data
+        loan_ids = data.get('loan_ids')
+        if not isinstance(loan_ids, list) or not loan_ids or not all(isinstance(i, int) for i in loan_ids):
+            raise errors.InvalidBatchApproval("loan_ids should be a non empty list of loan ids")
+        if len(loan_ids) > MAX_BATCH_APPROVAL_SIZE:
+            raise errors.InvalidBatchApproval(f"at most {MAX_BATCH_APPROVAL_SIZE} loans can be approved at once")
+
+        approval_date = date.today()
+        if data.get('approval_date', None):
+            try:
+                approval_date = datetime.strptime(data['approval_date'], '%Y-%m-%d').date()
+            except (TypeError, ValueError) as e:
+                raise errors.InvalidBatchApproval(e)
+
+        started_at = time.perf_counter()
+        results = Loan.approve_loans(loan_ids, approval_date)
+        elapsed = time.perf_counter() - started_at
+        approved = len([error for error in results.values() if error is None])
+        return Response({
+            'approved': approved,
+            'failed': len(results) - approved,
+            'elapsed_seconds': round(elapsed, 3),
+            'loans_per_second': round(len(results) / elapsed, 1) if elapsed > 0 else None,
+            'results': [
+                {'loan_id': loan_id, 'approved': error is None, 'error': error}
+                for loan_id, error in results.items()
+            ],
+        })
+
 class AddPayment(APIView):
     def post(self, request):
         data=request.data
@@ -65,3 +261,44 @@ class AddPayment(APIView):
         except Exception as e:
             raise errors.InvalidPayment(e)
         return Response("payment added")
+
+# reconciliation of bank payments, either {"payments": [{loan_id, payment_id, amount, payment_date}, ...]}
+# or a csv/jsonl file uploaded as "file" (format taken from the "format" field or the file extension)
+class BulkAddPayment(APIView):
+    permission_classes=[IsStaffUser]
+
+    # rows are checked as ingestion reads them, an upload over the limit is rejected as soon as the row past
+    # the limit is read and before any payment is applied, since ingestion parses every row first
+    def limited_rows(self, rows):
+        try:
+            for count, row in enumerate(rows, start=1):
+                if count > MAX_BULK_PAYMENTS:
+                    raise errors.InvalidBulkPayment(f"at most {MAX_BULK_PAYMENTS} payments can be added at once")
+                yield row
+        except (ValueError, csv.Error) as e:
+            raise errors.InvalidBulkPayment(e)
+
+    def post(self, request):
+        if not isinstance(request.data, dict):
+            raise errors.InvalidBulkPayment("payments should be a non empty list or a csv/jsonl file")
+
+        upload = request.FILES.get('file')
+        if upload is not None:
+            file_format = request.data.get('format') or upload.name.rsplit('.', 1)[-1].lower()
+            if file_format not in ['csv', 'jsonl']:
+                raise errors.InvalidBulkPayment(f"unsupported file format {file_format}, use csv or jsonl")
+            rows = read_payment_rows(io.TextIOWrapper(upload.file, encoding='utf-8'), file_format)
+        else:
+            payments = request.data.get('payments')
+            if not isinstance(payments, list) or not payments:
+                raise errors.InvalidBulkPayment("payments should be a non empty list or a csv/jsonl file")
+            rows = ((line, payment_row(row)) for line, row in enumerate(payments, start=1))
+
+        started_at = time.perf_counter()
+        results = list(ingest_payments(self.limited_rows(rows)))
+        elapsed = time.perf_counter() - started_at
+        return Response({
+            **summarize_results(results),
+            'elapsed_seconds': round(elapsed, 3),
+            'results': results,
+        })
@@ -9,8 +9,19 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'loan_backend.settings')
 
-application = get_asgi_application()
+
+# requests served under ASGI are routed with loan_backend.async_urls, so the loan read path runs on
+# the async views while the WSGI application keeps the sync ones
+class AsyncURLConfRequest(ASGIRequest):
+    urlconf = 'loan_backend.async_urls'
+
+class AsyncURLConfHandler(ASGIHandler):
+    request_class = AsyncURLConfRequest
+
+django.setup(set_prefix=False)
+application = AsyncURLConfHandler()
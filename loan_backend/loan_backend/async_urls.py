@@ -0,0 +1,9 @@
+from django.urls import path, include
+from loan_backend.settings import PATH_PREFIX
+from loan_backend.urls import urlpatterns as sync_urlpatterns
+
+# url configuration of the ASGI application, the async loan views come first and the rest is shared
+# with the WSGI application
+urlpatterns = [
+    path(PATH_PREFIX + 'loan/', include('loan.async_urls')),
+] + sync_urlpatterns
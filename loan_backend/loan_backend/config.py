@@ -20,8 +20,20 @@ CLOSED_LOAN_STATUS = [
     LoanStatus.SETTLED.name
 ]
 
+# order in which loans of a user are listed
+LOAN_LISTING_ORDER = [
+    [LoanStatus.APPROVED.name, LoanStatus.HOLD.name],
+    [LoanStatus.PENDING.name],
+    CLOSED_LOAN_STATUS,
+    [LoanStatus.REJECTED.name],
+]
+
 class InstallmentStatus(Enum):
     UNPAID = 'unpaid'
     PARTIALLY_PAID = 'partially paid'
     PAID_WITHOUT_PENALTY = 'paid without penalty'
-    PAID = 'paid'
\ No newline at end of file
+    PAID = 'paid'
+
+class PenaltyStorage(Enum):
+    DAILY = 'one cumulative row per day'
+    SEGMENT = 'accrual segments'
\ No newline at end of file
@@ -4,4 +4,22 @@ DEFAULT_PROCESSING_FEE = 0.02
 DEFAULT_PENALTY_MULTIPLIER = 0.001
 
 # changing this require running migrations
-DEFAULT_DECIMAL_PLACES = 5
\ No newline at end of file
+DEFAULT_DECIMAL_PLACES = 5
+MAX_LOAN_PAGE_SIZE = 100
+
+# loans locked and approved per transaction by batch approval and max loans per request
+LOAN_APPROVAL_CHUNK_SIZE = 200
+MAX_BATCH_APPROVAL_SIZE = 10000
+
+# payments applied per transaction by bulk payment ingestion and max payments per request
+PAYMENT_INGEST_BATCH_SIZE = 500
+MAX_BULK_PAYMENTS = 20000
+
+# installments read per query and penalty rows written per insert by the penalty cron
+PENALTY_CHUNK_SIZE = 2000
+PENALTY_BATCH_SIZE = 1000
+# loanshare id shards per worker of the parallel penalty cron, more shards balance uneven shards better
+PENALTY_SHARDS_PER_WORKER = 4
+
+# installments per page of the admin installment inline and of the installments shown on the loan page
+ADMIN_INSTALLMENTS_PER_PAGE = 25
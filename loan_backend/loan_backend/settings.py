@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from datetime import timedelta
 from pathlib import Path
+from loan_backend.config import PenaltyStorage
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -50,6 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'lib.instrumentation.RequestInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -121,12 +123,41 @@ CORS_ORIGIN_ALLOW_ALL = True
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# sqlite by default, DB_ENGINE=postgresql for production with DB_NAME, DB_USER, DB_PASSWORD, DB_HOST and DB_PORT
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'loan'),
+            'USER': os.environ.get('DB_USER', 'loan'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            # persistent connections reused across requests, checked before reuse so that a connection
+            # dropped by the server or a restart is replaced instead of failing the request
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            # server side cursors do not work behind a transaction pooling pgbouncer
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('DB_POOLER') == 'pgbouncer',
+            'OPTIONS': {
+                'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5)),
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            # SQLITE_PERFORMANCE_MODE=1 applies WAL and the other PRAGMAs of lib/sqlite and starts transactions
+            # with BEGIN IMMEDIATE, for single node deployments with concurrent writes
+            'ENGINE': 'lib.sqlite' if os.environ.get('SQLITE_PERFORMANCE_MODE') == '1' else 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+            # the test and benchmark database is in memory unless DB_TEST_NAME names a file, concurrent
+            # load tests need a file as the in memory database locks whole tables
+            'TEST': {'NAME': os.environ.get('DB_TEST_NAME')},
+        }
     }
-}
 
 
 # Password validation
@@ -162,6 +193,37 @@ USE_TZ = True
 
 PATH_PREFIX = f"aspire-loan/"
 
+# DAILY stores one cumulative Penalty row per overdue day, SEGMENT stores PenaltySegment accrual segments
+PENALTY_STORAGE = os.environ.get('PENALTY_STORAGE', PenaltyStorage.DAILY.name)
+
+# emi schedule previews of pending loans, kept in process with LRU eviction by default
+# use 'BACKEND': 'loan.cache.DjangoCacheBackend' with 'ALIAS' and 'TIMEOUT' to keep them in one of CACHES
+EMI_PREVIEW_CACHE = {
+    'BACKEND': 'loan.cache.LRUCacheBackend',
+    'MAX_SIZE': 10000,
+}
+
+# per request wall time, database time, query count and duplicate queries as a Server-Timing header and a
+# JSON log line of lib.instrumentation, for SAMPLE_RATE of the requests
+REQUEST_INSTRUMENTATION = {
+    'ENABLED': os.environ.get('REQUEST_INSTRUMENTATION') == '1',
+    'SAMPLE_RATE': float(os.environ.get('REQUEST_INSTRUMENTATION_SAMPLE_RATE', 1)),
+}
+
+# bearer token a metrics scraper sends to read PATH_PREFIX + 'metrics', staff users logged in to the admin can read them as well
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'lib.instrumentation': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
 
@@ -16,10 +16,12 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from loan.metrics import metrics_view
 from loan_backend.settings import PATH_PREFIX
 
 urlpatterns = [
     path(PATH_PREFIX + 'admin/', admin.site.urls),
     path(PATH_PREFIX + 'user/', include('user.urls')),
     path(PATH_PREFIX + 'loan/', include('loan.urls')),
+    path(PATH_PREFIX + 'metrics', metrics_view, name='metrics'),
 ]